@@ -1,4 +1,5 @@
 from bitboard import BitBoard
+from constants import COLOR
 
 diagonal_pattern = [(1, 1), (-1, 1), (1, -1), (-1, -1)]
 straight_pattern = [(1, 0), (-1, 0), (0, 1), (0, -1)]
@@ -15,6 +16,8 @@ class MovePatterns:
     rook_moves = [BitBoard() for _ in range(64)]
     bishop_moves = [BitBoard() for _ in range(64)]
 
+    pawn_attacks = {color: [BitBoard() for _ in range(64)] for color in COLOR}
+
 
 def adjacent(patterns):
     res = []
@@ -56,4 +59,95 @@ MovePatterns.king_moves = adjacent(king_pattern)
 MovePatterns.rook_moves = sliding(straight_pattern)
 MovePatterns.bishop_moves = sliding(diagonal_pattern)
 
-MovePatterns.queen_moves = [x | y for x, y in zip(MovePatterns.rook_moves, MovePatterns.bishop_moves)]
\ No newline at end of file
+MovePatterns.queen_moves = [x | y for x, y in zip(MovePatterns.rook_moves, MovePatterns.bishop_moves)]
+
+MovePatterns.pawn_moves = {
+    COLOR.WHITE: adjacent([(0, 1)]),
+    COLOR.BLACK: adjacent([(0, -1)]),
+}
+MovePatterns.pawn_attacks = {
+    COLOR.WHITE: adjacent([(-1, 1), (1, 1)]),
+    COLOR.BLACK: adjacent([(-1, -1), (1, -1)]),
+}
+
+
+def ray(square: int, direction) -> int:
+    """
+    Squares reached by sliding from square in direction on an empty board, square excluded.
+    """
+    file, rank = square % 8 + direction[0], square // 8 + direction[1]
+    res = 0
+    while 0 <= file <= 7 and 0 <= rank <= 7:
+        res |= 1 << (file + rank * 8)
+        file += direction[0]
+        rank += direction[1]
+    return res
+
+
+def between_squares():
+    """
+    between[a][b] holds the squares strictly between a and b if they share a line or a diagonal, 0 otherwise.
+    """
+    res = [[0] * 64 for _ in range(64)]
+    for starting_square in range(64):
+        for pattern in straight_pattern + diagonal_pattern:
+            path = 0
+            file_a = starting_square % 8 + pattern[0]
+            rank_a = starting_square // 8 + pattern[1]
+            while 0 <= file_a <= 7 and 0 <= rank_a <= 7:
+                res[starting_square][file_a + rank_a * 8] = path
+                path |= 1 << (file_a + rank_a * 8)
+                file_a += pattern[0]
+                rank_a += pattern[1]
+    return res
+
+
+between = between_squares()
+rays = {direction: [ray(square, direction) for square in range(64)] for direction in straight_pattern + diagonal_pattern}
+
+# directions along which square indices increase: the first blocker is the lsb of the blockers, otherwise the msb
+positive_directions = {(1, 0), (0, 1), (1, 1), (-1, 1)}
+
+
+def sliding_attacks(square: int, occupancy: int, directions) -> int:
+    """
+    Classical ray attacks: take the ray on an empty board and cut it after the first blocker.
+    """
+    attacks = 0
+    for direction in directions:
+        r = rays[direction][square]
+        blockers = r & occupancy
+        if blockers:
+            if direction in positive_directions:
+                first = (blockers & -blockers).bit_length() - 1
+            else:
+                first = blockers.bit_length() - 1
+            r ^= rays[direction][first]
+        attacks |= r
+    return attacks
+
+
+def bishop_attacks(square: int, occupancy: int) -> int:
+    """
+    Squares attacked by a bishop on square, given the occupied squares. Blockers are included.
+    """
+    return sliding_attacks(square, occupancy, diagonal_pattern)
+
+
+def rook_attacks(square: int, occupancy: int) -> int:
+    """
+    Squares attacked by a rook on square, given the occupied squares. Blockers are included.
+    """
+    return sliding_attacks(square, occupancy, straight_pattern)
+
+
+def compute_rays(square: int, attackers: int) -> int:
+    """
+    Union of the squares strictly between square and each of the (aligned) attackers.
+    """
+    res = 0
+    while attackers:
+        attacker = attackers & -attackers
+        res |= between[square][attacker.bit_length() - 1]
+        attackers ^= attacker
+    return res
@@ -0,0 +1,120 @@
+from typing import Dict, List
+
+from constants import COLOR, PieceType, byte_pieces
+
+# squares are indexed as rank * 8 + file, like in the zobrist table.
+diagonal_pattern = [(1, 1), (-1, 1), (1, -1), (-1, -1)]
+straight_pattern = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+knight_pattern = [(1, 2), (2, 1), (-1, 2), (2, -1), (1, -2), (-2, 1), (-1, -2), (-2, -1)]
+king_pattern = [(1, 0), (0, 1), (-1, 0), (0, -1), (1, 1), (-1, 1), (1, -1), (-1, -1)]
+
+directions = straight_pattern + diagonal_pattern
+opposite = [directions.index((-d[0], -d[1])) for d in directions]
+
+
+def _offsets(square: int, pattern) -> List[int]:
+    file, rank = square % 8, square // 8
+    return [
+        (rank + d[1]) * 8 + file + d[0] for d in pattern if 0 <= file + d[0] < 8 and 0 <= rank + d[1] < 8
+    ]
+
+
+def _ray(square: int, direction) -> List[int]:
+    res = []
+    file, rank = square % 8 + direction[0], square // 8 + direction[1]
+    while 0 <= file < 8 and 0 <= rank < 8:
+        res.append(rank * 8 + file)
+        file += direction[0]
+        rank += direction[1]
+    return res
+
+
+knight_targets = [_offsets(sq, knight_pattern) for sq in range(64)]
+king_targets = [_offsets(sq, king_pattern) for sq in range(64)]
+pawn_targets = {
+    COLOR.WHITE: [_offsets(sq, [(-1, 1), (1, 1)]) for sq in range(64)],
+    COLOR.BLACK: [_offsets(sq, [(-1, -1), (1, -1)]) for sq in range(64)],
+}
+rays = [[_ray(sq, d) for d in directions] for sq in range(64)]  # rays[square][direction index]
+
+slider_directions = {
+    PieceType.BISHOP: range(4, 8),
+    PieceType.ROOK: range(0, 4),
+    PieceType.QUEEN: range(0, 8),
+}
+
+
+class AttackMap:
+    """
+    Number of pieces of each color attacking each square, with sliders blocked by the first piece on their rays.
+    It is updated incrementally: placing or removing a piece changes the attacks of that piece and those of the
+    sliders whose rays go through its square, and nothing else.
+    The rest of the board must be up to date when add_piece and remove_piece are called; the square itself is
+    never looked at.
+    """
+
+    def __init__(self):
+        self.counts: Dict[COLOR, List[int]] = {color: [0] * 64 for color in COLOR}
+
+    def is_attacked(self, square: int, attacker_color: COLOR) -> bool:
+        return self.counts[attacker_color][square] > 0
+
+    def add_piece(self, board, piece: PieceType, color: COLOR, square: int):
+        self._update_through(board, square, -1)
+        self._update_own(board, piece, color, square, 1)
+
+    def remove_piece(self, board, piece: PieceType, color: COLOR, square: int):
+        self._update_own(board, piece, color, square, -1)
+        self._update_through(board, square, 1)
+
+    def _update_own(self, board, piece: PieceType, color: COLOR, square: int, delta: int):
+        counts = self.counts[color]
+        if piece == PieceType.PAWN:
+            targets = pawn_targets[color][square]
+        elif piece == PieceType.KNIGHT:
+            targets = knight_targets[square]
+        elif piece == PieceType.KING:
+            targets = king_targets[square]
+        else:
+            targets = []
+            mailbox = board.mailbox
+            for d in slider_directions[piece]:
+                for sq in rays[square][d]:
+                    targets.append(sq)
+                    if mailbox[sq]:
+                        break
+        for sq in targets:
+            counts[sq] += delta
+
+    def _update_through(self, board, square: int, delta: int):
+        """
+        Sliders looking at square see their rays beyond it change: shortened when a piece lands there (delta=-1),
+        extended when it leaves (delta=1).
+        """
+        mailbox = board.mailbox
+        for d in range(8):
+            # the first piece behind square, looking from the opposite direction
+            for sq in rays[square][opposite[d]]:
+                if mailbox[sq]:
+                    piece, color = byte_pieces[mailbox[sq]]
+                    break
+            else:
+                continue
+            if d not in slider_directions.get(piece, ()):
+                continue
+            counts = self.counts[color]
+            for sq in rays[square][d]:
+                counts[sq] += delta
+                if mailbox[sq]:
+                    break
+
+    @classmethod
+    def from_board(cls, board) -> "AttackMap":
+        """
+        Build the attack map from scratch. Useful to check the incremental updates.
+        """
+        attack_map = cls()
+        for (piece, color), squares in board.piece_to_squares.items():
+            for square in squares:
+                attack_map._update_own(board, piece, color, square, 1)
+        return attack_map
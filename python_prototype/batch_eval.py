@@ -0,0 +1,178 @@
+"""
+Vectorized static evaluation of many positions at once, for dataset scoring and tuning.
+
+A batch of positions is encoded as an (N, 12, 64) occupancy tensor, one plane per (color, piece) and squares indexed
+as rank * 8 + file. Material and piece-square tables are then two tensor contractions, the pawn structure terms are
+computed with shifts and cumulative ors of the pawn planes, and the taper by number of pieces is one more array
+operation. The scores are the same as Board.static_evaluation.
+"""
+import argparse
+import sys
+from typing import Iterable, Iterator, List, TextIO, Tuple
+
+import numpy as np
+
+import board
+import pawn_structure
+from constants import COLOR, PieceType, piece_bytes
+
+# planes: white pawn..king, then black pawn..king
+planes = [(piece, color) for color in (COLOR.WHITE, COLOR.BLACK) for piece in PieceType]
+plane_of_char = {
+    (piece.to_char().upper() if color == COLOR.WHITE else piece.to_char()): i for i, (piece, color) in enumerate(planes)
+}
+
+# signed middlegame and endgame score of each plane on each square, rows of the flat tables of board
+mg_table = np.array([board.mg_table[piece_bytes[key] << 6:(piece_bytes[key] + 1) << 6] for key in planes], dtype=np.int64)
+eg_table = np.array([board.eg_table[piece_bytes[key] << 6:(piece_bytes[key] + 1) << 6] for key in planes], dtype=np.int64)
+
+
+def encode(fens: List[str]) -> np.ndarray:
+    """
+    Occupancy tensor of a batch of positions.
+    :param fens: positions in FEN or EPD format. Only the piece placement field is read.
+    :return: (N, 12, 64) uint8 array.
+    """
+    batch, plane_idx, square_idx = [], [], []
+    for n, fen in enumerate(fens):
+        rank, file = 7, 0
+        for c in fen.split(maxsplit=1)[0]:
+            if c == "/":
+                rank -= 1
+                file = 0
+            elif c.isdigit():
+                file += int(c)
+            else:
+                batch.append(n)
+                plane_idx.append(plane_of_char[c])
+                square_idx.append(rank * 8 + file)
+                file += 1
+
+    occupancy = np.zeros((len(fens), len(planes), 64), dtype=np.uint8)
+    occupancy[batch, plane_idx, square_idx] = 1
+    return occupancy
+
+
+def _shift_files(a: np.ndarray, df: int) -> np.ndarray:
+    """
+    Move the last axis, files, by df, filling with False.
+    """
+    res = np.zeros_like(a)
+    if df > 0:
+        res[..., df:] = a[..., :-df]
+    else:
+        res[..., :df] = a[..., -df:]
+    return res
+
+
+def _pawn_terms(own: np.ndarray, enemy: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pawn structure terms of one side, as in pawn_structure.pawn_structure_scores.
+    :param own: (N, 8, 8) pawns of the side, by rank then file, ranks seen from the side so that its pawns move up.
+    :param enemy: (N, 8, 8) pawns of the other side, same orientation.
+    :return: (N,) middlegame and endgame scores of the side.
+    """
+    counts = own.sum(axis=1, dtype=np.int64)  # (N, 8) pawns per file
+    doubled = np.maximum(counts - 1, 0).sum(axis=1)
+    adjacent = own.any(axis=1)
+    isolated_files = ~(_shift_files(adjacent, 1) | _shift_files(adjacent, -1))
+    isolated = (counts * isolated_files).sum(axis=1)
+
+    # enemy pawns strictly ahead on each file, then on the file or its neighbours. A pawn with an own pawn ahead on
+    # its file is not counted: only the front one of doubled passed pawns is
+    ahead = np.zeros_like(enemy)
+    ahead[:, :-1] = np.logical_or.accumulate(enemy[:, :0:-1], axis=1)[:, ::-1]
+    blocked = ahead | _shift_files(ahead, 1) | _shift_files(ahead, -1)
+    own_ahead = np.zeros_like(own)
+    own_ahead[:, :-1] = np.logical_or.accumulate(own[:, :0:-1], axis=1)[:, ::-1]
+    passed = (own & ~blocked & ~own_ahead).sum(axis=2, dtype=np.int64)  # (N, 8) passed pawns per rank
+
+    # own pawns level or behind on the adjacent files, enemy pawns attacking the square in front
+    behind = np.logical_or.accumulate(own, axis=1)
+    supported = _shift_files(behind, 1) | _shift_files(behind, -1)
+    enemy_attacks = _shift_files(enemy, 1) | _shift_files(enemy, -1)
+    stop_attacked = np.zeros_like(own)
+    stop_attacked[:, :-2] = enemy_attacks[:, 2:]
+    backward = (own & ~isolated_files[:, np.newaxis, :] & ~supported & stop_attacked).sum(axis=(1, 2))
+
+    mg = doubled * pawn_structure.doubled_penalty[0] + isolated * pawn_structure.isolated_penalty[0] + \
+        backward * pawn_structure.backward_penalty[0] + passed @ np.array(pawn_structure.passed_bonus_mg)
+    eg = doubled * pawn_structure.doubled_penalty[1] + isolated * pawn_structure.isolated_penalty[1] + \
+        backward * pawn_structure.backward_penalty[1] + passed @ np.array(pawn_structure.passed_bonus_eg)
+    return mg, eg
+
+
+def pawn_structure_scores(occupancy: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pawn structure of a batch of positions.
+    :param occupancy: (N, 12, 64) tensor, see encode.
+    :return: (N,) middlegame and endgame scores, from white's point of view.
+    """
+    white = occupancy[:, plane_of_char["P"]].reshape(-1, 8, 8).astype(bool)
+    black = occupancy[:, plane_of_char["p"]].reshape(-1, 8, 8).astype(bool)
+    white_mg, white_eg = _pawn_terms(white, black)
+    black_mg, black_eg = _pawn_terms(black[:, ::-1], white[:, ::-1])
+    return white_mg - black_mg, white_eg - black_eg
+
+
+def evaluate(occupancy: np.ndarray) -> np.ndarray:
+    """
+    Static evaluation of a batch of positions, from white's point of view.
+    :param occupancy: (N, 12, 64) tensor, see encode.
+    :return: (N,) float64 array of scores.
+    """
+    occupancy = occupancy.astype(np.int64)
+    mg = np.einsum("nps,ps->n", occupancy, mg_table)
+    eg = np.einsum("nps,ps->n", occupancy, eg_table)
+    pawns_mg, pawns_eg = pawn_structure_scores(occupancy)
+    mg += pawns_mg
+    eg += pawns_eg
+    n_pieces = occupancy.sum(axis=(1, 2))
+    return (mg * n_pieces + eg * (32 - n_pieces)) / 32
+
+
+def evaluate_fens(fens: List[str]) -> np.ndarray:
+    return evaluate(encode(fens))
+
+
+def read_chunks(lines: Iterable[str], chunk_size: int) -> Iterator[List[str]]:
+    """
+    Group the non-empty lines of a FEN or EPD stream in lists of at most chunk_size positions.
+    """
+    chunk = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def evaluate_stream(f: TextIO, chunk_size: int = 65536) -> Iterator[np.ndarray]:
+    """
+    Evaluate a FEN or EPD file chunk by chunk, so that memory stays bounded whatever the size of the file.
+    :param f: open text file, one position per line.
+    :param chunk_size: number of positions evaluated per batch.
+    :return: iterator over the arrays of scores of each chunk, in file order.
+    """
+    for chunk in read_chunks(f, chunk_size):
+        yield evaluate_fens(chunk)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="FEN or EPD file, one position per line ('-' for stdin)")
+    parser.add_argument("--chunk-size", type=int, default=65536, help="positions per batch (default 65536)")
+    args = parser.parse_args()
+
+    f = sys.stdin if args.path == "-" else open(args.path)
+    try:
+        for scores in evaluate_stream(f, args.chunk_size):
+            np.savetxt(sys.stdout, scores, fmt="%.4f")
+    finally:
+        if f is not sys.stdin:
+            f.close()
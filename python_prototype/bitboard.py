@@ -20,7 +20,7 @@ class BitBoard:
         self.val ^= (1 << square)
 
     def count_ones(self):
-        self.val.bit_count()
+        return self.val.bit_count()
 
     def __str__(self):
         return bin(self.val)[2:].zfill(64)
@@ -1,45 +1,357 @@
-import copy
 from typing import List, Tuple, Optional, Set, Dict, Iterable
 
 import constants
-from move import Move
-from constants import PieceType, COLOR, Square
+from attack_map import AttackMap, directions, king_targets, knight_targets, pawn_targets, rays, slider_directions
+from nnue import Accumulator, Network
+from pawn_structure import PawnHashTable, pawn_structure_scores
+from move import Move, CAPTURE_MASK, CASTLING, DOUBLE_PUSH, EN_PASSANT, code_pieces, piece_codes
+from constants import PieceType, COLOR, Square, byte_pieces, color_bits, piece_bytes
 
+import functools
 import random
 
 sliding_pieces = [PieceType.BISHOP, PieceType.ROOK, PieceType.QUEEN]
 sliding_diagonal = [PieceType.BISHOP, PieceType.QUEEN]
 sliding_straight = [PieceType.ROOK, PieceType.QUEEN]
 
-diagonal_pattern = [(1, 1), (-1, 1), (1, -1), (-1, -1)]
-straight_pattern = [(1, 0), (-1, 0), (0, 1), (0, -1)]
-knight_pattern = [(1, 2), (2, 1), (-1, 2), (2, -1), (1, -2), (-2, 1), (-1, -2), (-2, -1)]
-king_pattern = [(1, 0), (0, 1), (-1, 0), (0, -1), (1, 1), (-1, 1), (1, -1), (-1, -1)]
-
+diagonal_directions = slider_directions[PieceType.BISHOP]
+straight_directions = slider_directions[PieceType.ROOK]
+promotion_pieces = (PieceType.KNIGHT, PieceType.BISHOP, PieceType.ROOK, PieceType.QUEEN)
+
+
+def board_to_fen(board) -> str:
+    """
+    FEN of the position on a board of either backend.
+    """
+    rows = []
+    for rank in range(7, -1, -1):
+        row, empty = "", 0
+        for file in range(8):
+            piece, color = board.piece_at(rank * 8 + file)
+            if piece is None:
+                empty += 1
+                continue
+            if empty:
+                row += str(empty)
+                empty = 0
+            row += piece.to_char().upper() if color == COLOR.WHITE else piece.to_char()
+        rows.append(row + (str(empty) if empty else ""))
+    en_passant = "-" if board.en_passant is None else \
+        Square(board.en_passant & 7, board.en_passant >> 3).to_string_algebraic()
+    return " ".join([
+        "/".join(rows),
+        "w" if board.color_to_move == COLOR.WHITE else "b",
+        CastlingRights.to_string(board.castling_rights),
+        en_passant,
+        str(board.move_50_rule),
+        str(1 + (board.start_ply + board.ply) // 2),
+    ])
+
+
+def resolve_exchange(gains: List[int]) -> int:
+    """
+    Minimax a sequence of captures on one square, where either side may stop capturing.
+    :param gains: gains[i] is the material won by the side making the i-th capture, assuming it is not recaptured,
+    minus what the opponent won so far. It is overwritten.
+    :return: material won by the first capture.
+    """
+    for i in range(len(gains) - 1, 0, -1):
+        gains[i - 1] = -max(-gains[i - 1], gains[i])
+    return gains[0]
+
+
+def _phase_entry(piece: PieceType, color: COLOR, square: int) -> Tuple[int, int]:
+    rank = square >> 3 if color == COLOR.BLACK else 7 - (square >> 3)
+    value = constants.values[piece]
+    return (color.value * (value + constants.complete_table[piece][rank][square & 7]),
+            color.value * (value + constants.complete_table_endgame[piece][rank][square & 7]))
+
+
+def _build_phase_table() -> List[Tuple[int, int]]:
+    table = [(0, 0)] * (32 << 6)
+    for (piece, color), byte in piece_bytes.items():
+        for square in range(64):
+            table[byte << 6 | square] = _phase_entry(piece, color, square)
+    return table
+
+
+# middlegame and endgame contribution of each piece on each square: value plus piece-square table entry, signed by
+# color, with the tables mirrored for black. Indexed by piece byte << 6 | square; empty bytes score 0.
+phase_table = _build_phase_table()
+mg_table = [mg for mg, _ in phase_table]
+eg_table = [eg for _, eg in phase_table]
+
+
+def phase_scores(piece: PieceType, color: COLOR, square: int) -> Tuple[int, int]:
+    """
+    Contribution of a piece to the middlegame and endgame scores: its value plus its piece-square table entry,
+    signed by color.
+    """
+    return phase_table[piece_bytes[(piece, color)] << 6 | square]
+
+
+class BaseBoard:
+    """
+    State and methods shared by the board backends, board.Board and board_bitboard.Board: side to move, castling and
+    en passant rights, undo stack and repetitions, zobrist hash, incremental evaluation with the pawn hash table,
+    and the NNUE accumulators.
+    A backend keeps its own piece placement, updated by its put_piece and make_move, and provides piece_at,
+    pawn_bitboards and least_valuable_attacker.
+    """
+    debug = False  # check the incremental state against a full recomputation after every make and unmake
 
-# note: we ignore three-fold repetition for now.
-class Board:
     def __init__(self):
-        self.piece_to_squares: Dict[Tuple[PieceType, COLOR]: Square] = {
-            (x, y): [] for x in PieceType for y in COLOR
-        }
-        self.bitboard: List[List[Tuple[Optional[PieceType], Optional[COLOR]]]] = [
-            [(None, None) for _ in range(8)] for _ in range(8)
-        ]
-
         self.zobrist = ZobristHashHandler()
 
-        self.move_history_stack = []
-        self.castling_rights_stack = []
-        self.en_passant_stack = []
-        self.move_50_rule_stack = []
-        self.zobrist_history = []
+        # running scores of the pieces on the board, blended by static_evaluation
+        self.mg_score = 0
+        self.eg_score = 0
+        self.n_pieces = 0
+        self.pawn_table = PawnHashTable()
+        self.accumulator: Optional[Accumulator] = None  # network inputs, kept up to date once set_network is called
+
+        # undo_stack[i] describes the i-th move made on the board and the position before it
+        self.undo_stack = [UndoRecord() for _ in range(MAX_GAME_PLY)]
+        self.ply = 0  # number of moves made on the board
+        self.start_ply = 0  # game ply of the position the board was set up with
+        # number of positions in the undo stack by the low bits of their hash. Zero means the current position
+        # cannot be a repetition
+        self.repetition_filter = [0] * (REPETITION_FILTER_MASK + 1)
 
         self.move_50_rule = 0  # half-moves since last irreversible move
-        self.castling_rights = CastlingRights()
-        self.en_passant: Optional[Square] = None  # square where capturable pawn is
+        self.castling_rights = 0  # bits of CastlingRights
+        self.en_passant: Optional[int] = None  # square where capturable pawn is
         self.color_to_move = COLOR.WHITE
 
+    @classmethod
+    def from_startpos(cls):
+        return cls.from_fen("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
+
+    def to_fen(self) -> str:
+        return board_to_fen(self)
+
+    def push_undo_record(self, move: int) -> "UndoRecord":
+        """
+        First step of make_move: save the state that the move changes in the undo stack, then update the castling
+        rights and reset the en passant square. The 50-move counter is incremented, the backend resets it on
+        captures and pawn moves.
+        :return: the record of the move.
+        """
+        if self.ply == len(self.undo_stack):
+            self.undo_stack.append(UndoRecord())
+        record = self.undo_stack[self.ply]
+        record.move = move
+        record.castling_rights = self.castling_rights
+        record.en_passant = self.en_passant
+        record.move_50_rule = self.move_50_rule
+        record.hash = self.zobrist.hash
+        record.pawn_hash = self.zobrist.pawn_hash
+        self.repetition_filter[record.hash & REPETITION_FILTER_MASK] += 1
+        self.ply += 1
+
+        self.castling_rights = CastlingRights.update_rights(self.castling_rights, move)
+        self.move_50_rule += 1
+        self.en_passant = None
+        return record
+
+    def finish_move(self, record: "UndoRecord", us: COLOR):
+        """
+        Last step of make_move, once the pieces are moved: pass the move to the other side and update the hash and
+        the accumulators.
+        :param record: record returned by push_undo_record.
+        :param us: color that made the move.
+        """
+        self.color_to_move = us.flip()
+        self.zobrist.update_hash(record.move, us, record.castling_rights, self.castling_rights, record.en_passant,
+                                 self.en_passant)
+        if self.accumulator is not None:
+            self.accumulator.update(self, record.move, us)
+        if self.debug:
+            self.check_consistency()
+
+    def pop_undo_record(self) -> int:
+        """
+        First step of unmake_move: restore the state saved by push_undo_record and give the move back to the side
+        that made it. The backend then moves the pieces back.
+        :return: the move to unmake.
+        """
+        self.ply -= 1
+        record = self.undo_stack[self.ply]
+        self.repetition_filter[record.hash & REPETITION_FILTER_MASK] -= 1
+        self.move_50_rule = record.move_50_rule
+        self.en_passant = record.en_passant
+        self.castling_rights = record.castling_rights
+        self.zobrist.hash = record.hash
+        self.zobrist.pawn_hash = record.pawn_hash
+        self.color_to_move = self.color_to_move.flip()
+        if self.accumulator is not None:
+            self.accumulator.pop()
+        return record.move
+
+    def check_consistency(self):
+        """
+        Debug check of the incrementally updated state.
+        """
+        self.zobrist.verify_hash(self)
+        assert abs(self.static_evaluation() - self.static_evaluation_scan()) < 1e-6, "incremental evaluation out of sync"
+        if self.accumulator is not None:
+            self.accumulator.verify(self)
+
+    @staticmethod
+    def castle_rook_squares(king_to: int) -> Tuple[int, int]:
+        """
+        :param king_to: landing square of the castling king.
+        :return: starting and landing square of the castling rook.
+        """
+        if king_to & 7 == 2:
+            return king_to - 2, king_to + 1
+        return king_to + 1, king_to - 1
+
+    def is_3fold(self):
+        """
+        Threefold repetition, by the rules of the game: the current position occurred twice before.
+        """
+        return self.is_repetition(self.ply)
+
+    def is_repetition(self, root_ply: int = 0) -> bool:
+        """
+        Draw by repetition as seen by the search. Only the positions since the last irreversible move, with the same
+        side to move, can repeat the current one, and most calls return after a single lookup in repetition_filter.
+        :param root_ply: ply of the root of the search. A position already met after the root is a draw on its first
+        repetition (twofold), since either side could repeat it again; earlier positions need two (threefold).
+        """
+        h = self.zobrist.hash
+        if not self.repetition_filter[h & REPETITION_FILTER_MASK]:
+            return False
+        seen = 0
+        for i in range(self.ply - 2, max(self.ply - self.move_50_rule, 0) - 1, -2):
+            if self.undo_stack[i].hash == h:
+                if i >= root_ply:
+                    return True
+                seen += 1
+                if seen == 2:
+                    return True
+        return False
+
+    def see(self, move: int) -> int:
+        """
+        Static exchange evaluation: material won by move once all the captures on its target square are played
+        out, each side capturing with its least valuable piece and free to stop. Sliders behind a capturing piece
+        join in when it leaves (x-rays). Pins are ignored.
+        :param move: legal move of the side to move, packed.
+        :return: material balance in centipawns, negative for a losing capture.
+        """
+        values = constants.values
+        from_sq, to_sq = move & 63, (move >> 6) & 63
+        removed = 1 << from_sq
+        captured = code_pieces[(move >> 15) & 7]
+        gains = [values[captured] if captured is not None else 0]
+        if move & EN_PASSANT:
+            removed |= 1 << (to_sq - 8 * self.color_to_move.value)
+            gains[0] = values[PieceType.PAWN]
+        on_square = values[code_pieces[(move >> 12) & 7]]
+        promotion = code_pieces[(move >> 18) & 7]
+        if promotion is not None:
+            gains[0] += values[promotion] - values[PieceType.PAWN]
+            on_square = values[promotion]
+
+        side = self.color_to_move.flip()
+        while True:
+            piece, sq = self.least_valuable_attacker(to_sq, side, removed)
+            if piece is None:
+                break
+            if piece == PieceType.KING and self.least_valuable_attacker(to_sq, side.flip(), removed | 1 << sq)[0]:
+                break  # the king cannot capture a defended piece
+            gains.append(on_square - gains[-1])
+            on_square = values[piece]
+            removed |= 1 << sq
+            side = side.flip()
+        return resolve_exchange(gains)
+
+    def least_valuable_attacker(self, square: int, color: COLOR, removed: int = 0) -> Tuple[Optional[PieceType], int]:
+        """
+        Cheapest piece of color attacking square, looking through the pieces on the squares set in removed.
+        :param removed: bitboard of the squares to treat as empty.
+        :return: the piece and its square, None and -1 if square is not attacked.
+        """
+        raise NotImplementedError
+
+    def pawn_bitboards(self) -> Tuple[int, int]:
+        """
+        :return: bitboards of the white pawns and of the black pawns.
+        """
+        raise NotImplementedError
+
+    def static_evaluation(self):
+        """
+        Material, piece-square tables and pawn structure, tapered between middlegame and endgame by the number of
+        pieces left. Blends the scores kept up to date by the backend as pieces are placed and removed with the
+        cached pawn structure.
+        """
+        pawns_mg, pawns_eg = self.pawn_structure_eval()
+        return ((self.mg_score + pawns_mg) * self.n_pieces + (self.eg_score + pawns_eg) * (32 - self.n_pieces)) / 32
+
+    def static_evaluation_scan(self):
+        """
+        Same as static_evaluation, computed from scratch. Used to check the incremental scores in debug mode.
+        """
+        mg = eg = n_pieces = 0
+        for square in range(64):
+            piece, color = self.piece_at(square)
+            if piece is not None:
+                byte = piece_bytes[(piece, color)]
+                mg += mg_table[byte << 6 | square]
+                eg += eg_table[byte << 6 | square]
+                n_pieces += 1
+        pawns_mg, pawns_eg = pawn_structure_scores(*self.pawn_bitboards())
+        return ((mg + pawns_mg) * n_pieces + (eg + pawns_eg) * (32 - n_pieces)) / 32
+
+    def pawn_structure_eval(self) -> Tuple[int, int]:
+        """
+        Middlegame and endgame pawn structure scores from white's point of view, looked up in the pawn hash table
+        and only computed when the pawn structure is not there.
+        """
+        key = self.zobrist.pawn_hash
+        scores = self.pawn_table.probe(key)
+        if scores is None:
+            scores = pawn_structure_scores(*self.pawn_bitboards())
+            self.pawn_table.store(key, *scores)
+        return scores
+
+    def set_network(self, network: Network):
+        """
+        Evaluate with network from now on: build its accumulators for the current position, to be updated by
+        make_move and unmake_move.
+        """
+        self.accumulator = Accumulator(network, self)
+
+    def nnue_evaluation(self, adjusted: bool = True) -> int:
+        """
+        Network evaluation, from white's point of view like static_evaluation. set_network must have been called.
+        """
+        return self.accumulator.evaluate(self.color_to_move, self.n_pieces, adjusted) * self.color_to_move.value
+
+
+class Board(BaseBoard):
+    """
+    Mailbox board. Squares are ints, rank * 8 + file, and the move generators walk the per-square tables of
+    attack_map instead of building squares on the fly.
+    The mailbox is a flat bytearray holding the one byte piece encoding of constants.piece_bytes. Each piece list
+    comes with the position of every square in it, so that pieces are added and removed in constant time.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.mailbox = bytearray(64)
+        self.piece_lists: List[List[int]] = [[] for _ in range(32)]  # indexed by piece byte
+        self.list_index = [0] * 64  # position of each occupied square in its piece list
+        # same lists as above, by (piece, color)
+        self.piece_to_squares: Dict[Tuple[PieceType, COLOR], List[int]] = {
+            key: self.piece_lists[byte] for key, byte in piece_bytes.items()
+        }
+
+        self.attack_map = AttackMap()
+
     @classmethod
     def from_fen(cls, fen):
         """
@@ -63,9 +375,7 @@ class Board:
                     color = COLOR.BLACK
 
                 piece_type = PieceType.from_char(c.lower())
-                board.bitboard[current_rank][current_file] = (
-                    piece_type, color)
-                board.piece_to_squares[(piece_type, color)].append(Square(current_file, current_rank))
+                board.put_piece(piece_type, color, current_rank * 8 + current_file)
                 current_file += 1
 
         board.color_to_move = COLOR.WHITE if fen_parts[1] == "w" else COLOR.BLACK
@@ -74,874 +384,693 @@ class Board:
         if en_passant == "-":
             board.en_passant = None
         else:
-            board.en_passant = Square.from_string_algebraic(en_passant)
+            board.en_passant = Square.from_string_algebraic(en_passant).index
+        if board.en_passant is not None and not board.en_passant_capturable(board.en_passant, board.color_to_move):
+            board.en_passant = None
         board.move_50_rule = int(fen_parts[4])
+        board.start_ply = 2 * (int(fen_parts[5]) - 1) + (board.color_to_move == COLOR.BLACK)
 
         board.zobrist.initialize_hash(board)
 
         return board
 
-    @classmethod
-    def from_startpos(cls):
-        return cls.from_fen("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
+    def piece_at(self, square: int) -> Tuple[Optional[PieceType], Optional[COLOR]]:
+        return byte_pieces[self.mailbox[square]]
 
-    def make_move(self, move: Move):
+    def put_piece(self, piece: PieceType, color: COLOR, square: int):
         """
-        Executes a move on the board and flips the color to move.
-        :param move: move to make
-        :return:
+        Place a piece on an empty square, keeping the piece lists and the attack map in sync.
         """
-        self.move_history_stack.append(move)
-        self.en_passant_stack.append(self.en_passant)
-        self.castling_rights_stack.append(self.castling_rights.clone())
-        self.zobrist.update_hash(move, self.color_to_move)
-        self.zobrist_history.append(self.zobrist.hash)
-        self.move_50_rule_stack.append(self.move_50_rule)
-        self.move_50_rule += 1
-        self.en_passant = None
-        match move.piece_moved:
-            case PieceType.KING:
-                self.castling_rights.moved_king(self.color_to_move)
-                if abs(move.from_square.file - move.to_square.file) > 1:
-                    self.make_castle(move)
-                else:
-                    self.make_simple_move(move)
-
-            case PieceType.PAWN:
-                self.move_50_rule = 0
-                # case capture or en passant
-                if move.promotion is not None:
-                    self.make_promotion(move)
-                elif move.from_square.file != move.to_square.file:
-                    if self.bitboard[move.to_square.rank][move.to_square.file] == (None, None):
-                        self.make_en_passant(move)
-                    elif move.promotion is None:
-                        self.make_simple_move(move)
-
-
-                else:
-                    if abs(move.to_square.rank - move.from_square.rank) == 2:
-                        tg = 1 if self.color_to_move == COLOR.WHITE else -1
-                        self.en_passant = Square(move.to_square.file, move.to_square.rank - tg)
-                    self.make_simple_move(move)
-            case PieceType.ROOK:
-                self.castling_rights.moved_rook(self.color_to_move, move.from_square)
-                self.make_simple_move(move)
-            case _:
-                self.make_simple_move(move)
-
-        self.color_to_move = self.color_to_move.flip()
-
-    def is_3fold(self):
-        return self.zobrist_history.count(self.zobrist.hash) > 2
-
-    def make_simple_move(self, move: Move):
+        byte = piece_bytes[(piece, color)]
+        self.mailbox[square] = byte
+        squares = self.piece_lists[byte]
+        self.list_index[square] = len(squares)
+        squares.append(square)
+        self.attack_map.add_piece(self, piece, color, square)
+        mg, eg = phase_table[byte << 6 | square]
+        self.mg_score += mg
+        self.eg_score += eg
+        self.n_pieces += 1
+
+    def remove_piece(self, square: int) -> PieceType:
+        """
+        Remove the piece on square, keeping the piece lists and the attack map in sync. The last square of the piece
+        list takes the place of the removed one.
+        :return: the removed piece.
+        """
+        byte = self.mailbox[square]
+        self.mailbox[square] = 0
+        squares = self.piece_lists[byte]
+        last = squares.pop()
+        if last != square:
+            i = self.list_index[square]
+            squares[i] = last
+            self.list_index[last] = i
+        piece, color = byte_pieces[byte]
+        self.attack_map.remove_piece(self, piece, color, square)
+        mg, eg = phase_table[byte << 6 | square]
+        self.mg_score -= mg
+        self.eg_score -= eg
+        self.n_pieces -= 1
+        return piece
+
+    def is_check(self) -> bool:
+        return self.is_attacked(self.piece_to_squares[(PieceType.KING, self.color_to_move)][0])
+
+    def make_move(self, move: int):
         """
-        Makes a simple move that does not involve anything but moving a piece and possibly capturing what's on the landing square
-        :param move:
+        Executes a move on the board and flips the color to move.
+        :param move: move to make, in the packed format of move.py
         :return:
         """
-        p, c = self.bitboard[move.to_square.rank][move.to_square.file]
+        record = self.push_undo_record(move)
+
+        us = self.color_to_move
+        from_sq, to_sq = move & 63, (move >> 6) & 63
+        piece_moved = code_pieces[(move >> 12) & 7]
 
-        if p is not None:  # remove opponent piece
+        if move & CAPTURE_MASK:  # remove opponent piece
             self.move_50_rule = 0
-            self.piece_to_squares[(p, c)].remove(move.to_square)
+            self.remove_piece(to_sq)
+
+        match piece_moved:
+            case PieceType.KING:
+                if move & CASTLING:
+                    rook_from, rook_to = self.castle_rook_squares(to_sq)
+                    self.remove_piece(rook_from)
+                    self.put_piece(PieceType.ROOK, us, rook_to)
+            case PieceType.PAWN:
+                self.move_50_rule = 0
+                if move & EN_PASSANT:
+                    self.remove_piece(to_sq - 8 * us.value)
+                elif move & DOUBLE_PUSH and self.en_passant_capturable(from_sq + 8 * us.value, us.flip()):
+                    self.en_passant = from_sq + 8 * us.value
 
-        self.piece_to_squares[(move.piece_moved, self.color_to_move)].remove(move.from_square)
-        self.piece_to_squares[(move.piece_moved, self.color_to_move)].append(move.to_square)
+        self.remove_piece(from_sq)
+        self.put_piece(code_pieces[(move >> 18) & 7] or piece_moved, us, to_sq)
 
-        # set to_square to piece_moved and erase from_square
-        self.bitboard[move.from_square.rank][move.from_square.file] = (None, None)
-        self.bitboard[move.to_square.rank][move.to_square.file] = (move.piece_moved, self.color_to_move)
+        self.finish_move(record, us)
 
-    def make_castle(self, move):
+    def en_passant_capturable(self, square: int, color: COLOR) -> bool:
         """
-        Execute a castle move.
-        :param move:
-        :return:
+        Whether a pawn of color stands ready to capture en passant on square, legality aside.
         """
-        if move.to_square.file == 2:
-            self.piece_to_squares[(PieceType.ROOK, self.color_to_move)].remove(Square(0, move.from_square.rank))
-            self.piece_to_squares[(PieceType.ROOK, self.color_to_move)].append(Square(3, move.from_square.rank))
-            self.bitboard[move.from_square.rank][3] = self.bitboard[move.from_square.rank][0]
-            self.bitboard[move.from_square.rank][0] = (None, None)
-
-            self.piece_to_squares[(PieceType.KING, self.color_to_move)] = [move.to_square]
-            self.bitboard[move.to_square.rank][move.to_square.file] = (PieceType.KING, self.color_to_move)
-            self.bitboard[move.from_square.rank][move.from_square.file] = (None, None)
-
-        else:
-            self.piece_to_squares[(PieceType.ROOK, self.color_to_move)].remove(Square(7, move.from_square.rank))
-            self.piece_to_squares[(PieceType.ROOK, self.color_to_move)].append(Square(5, move.from_square.rank))
-            self.bitboard[move.from_square.rank][5] = self.bitboard[move.from_square.rank][7]
-            self.bitboard[move.from_square.rank][7] = (None, None)
-
-            self.piece_to_squares[(PieceType.KING, self.color_to_move)] = [move.to_square]
-            self.bitboard[move.to_square.rank][move.to_square.file] = (PieceType.KING, self.color_to_move)
-            self.bitboard[move.from_square.rank][move.from_square.file] = (None, None)
+        pawn = piece_bytes[(PieceType.PAWN, color)]
+        return any(self.mailbox[sq] == pawn for sq in pawn_targets[color.flip()][square])
 
     def unmake_move(self):
         """
         Unmake a move and revert the state of the board to the previous one
         :return:
         """
-        self.move_50_rule = self.move_50_rule_stack.pop()
-        self.en_passant = self.en_passant_stack.pop()
-        self.castling_rights = self.castling_rights_stack.pop()
-        self.color_to_move = self.color_to_move.flip()
-        self.zobrist_history.pop()
+        move = self.pop_undo_record()
 
-        move = self.move_history_stack.pop()
-        self.zobrist.update_hash(move, self.color_to_move)
+        us, them = self.color_to_move, self.color_to_move.flip()
+        from_sq, to_sq = move & 63, (move >> 6) & 63
 
-        match move.piece_moved:
-            case PieceType.KING:
-                if abs(move.from_square.file - move.to_square.file) > 1:
-                    self.unmake_castle(move)
-                else:
-                    self.unmake_classic_move(move)
-            case PieceType.PAWN:
-                # case capture or en passant
-                if move.from_square.file != move.to_square.file:
-                    if move.piece_captured is None:
-                        self.unmake_en_passant(move)
-                    else:
-                        self.unmake_classic_move(move)
-                elif move.promotion is not None:
-                    self.unmake_promotion(move)
-                else:
-                    self.unmake_classic_move(move)
-            case _:
-                self.unmake_classic_move(move)
+        # if the move was a promotion, this removes the promoted piece
+        self.remove_piece(to_sq)
+        self.put_piece(code_pieces[(move >> 12) & 7], us, from_sq)
+
+        if move & CAPTURE_MASK:
+            self.put_piece(code_pieces[(move >> 15) & 7], them, to_sq)
+        elif move & EN_PASSANT:
+            self.put_piece(PieceType.PAWN, them, to_sq - 8 * us.value)
+        elif move & CASTLING:
+            rook_from, rook_to = self.castle_rook_squares(to_sq)
+            self.remove_piece(rook_to)
+            self.put_piece(PieceType.ROOK, us, rook_from)
 
-        # special cases: en passant, castling, promotion
+        if self.debug:
+            self.check_consistency()
 
-    def generate_moves(self) -> List[Move]:
+    def generate_moves(self, tactical: bool = True, quiet: bool = True,
+                       from_square: Optional[int] = None) -> List[int]:
         """
-        Generate all legal moves in the position
+        Generate all legal moves in the position, packed as in move.py
+        :param tactical: include captures (en passant too) and promotions.
+        :param quiet: include all the other moves, castling included.
+        :param from_square: if given, only generate the moves of the piece on this square.
         :return:
         """
-        pinned_pieces: Set[Square] = self.generate_pinned()
-        king = self.piece_to_squares[(PieceType.KING, self.color_to_move)][0]
-        attacked_bitboard = self.generate_attacked_squares(self.color_to_move.flip())
-        attacking_king = attacked_bitboard[king.rank][king.file]
-        is_check = len(attacking_king) > 0
-
-        moves: List[Move] = []
-
-        # king
-        king = self.piece_to_squares[(PieceType.KING, self.color_to_move)][0]
-        pseudo_legal = self.generate_adjacent_moves_pseudo_legal(king, king_pattern)
-        for mov in pseudo_legal:
-            if not attacked_bitboard[mov.to_square.rank][mov.to_square.file]:
-                moves.append(mov)
-        if not is_check:
-            castles = self.generate_castling_legal(king, attacked_bitboard)
-            moves.extend(castles)
-
-        if len(attacking_king) > 1:
+        pin_rays: Dict[int, Set[int]] = self.generate_pinned()
+        king = self.piece_lists[piece_bytes[(PieceType.KING, self.color_to_move)]][0]
+        attacked = self.attack_map.counts[self.color_to_move.flip()]
+        checkers = self.generate_checkers(king) if attacked[king] else []
+        is_check = len(checkers) > 0
+
+        moves: List[int] = []
+
+        # king. The attack map sees sliders as blocked by our king, so stepping away from a slider along its ray
+        # must be excluded separately
+        x_rayed = set()
+        for checker in checkers:
+            if byte_pieces[self.mailbox[checker]][0] in sliding_pieces:
+                d_file, d_rank = (king & 7) - (checker & 7), (king >> 3) - (checker >> 3)
+                ray = rays[king][directions.index(((d_file > 0) - (d_file < 0), (d_rank > 0) - (d_rank < 0)))]
+                if ray:
+                    x_rayed.add(ray[0])
+        if from_square is None or from_square == king:
+            pseudo_legal = self.generate_adjacent_moves_pseudo_legal(king, king_targets[king], tactical, quiet)
+            for mov in pseudo_legal:
+                to = (mov >> 6) & 63
+                if not attacked[to] and to not in x_rayed:
+                    moves.append(mov)
+            if not is_check and quiet:
+                castles = self.generate_castling_legal(king, attacked)
+                moves.extend(castles)
+
+        if len(checkers) > 1:
             # if there are more than one attacking king, we can only move the king
             return moves
 
+        # squares where a non-king move must land to stop the check
+        evasion_mask = self.check_evasion_mask(king, checkers[0]) if is_check else None
+
         # bishop
-        bishops = copy.copy(self.piece_to_squares[(PieceType.BISHOP, self.color_to_move)])
-        for square in bishops:
-            pseudo_legal = self.generate_sliding_moves_pseudo_legal(square, diagonal_pattern)
-            if square not in pinned_pieces and not is_check:
-                moves.extend(pseudo_legal)
-            else:
-                moves.extend(self.check_pseudo_legal_moves(pseudo_legal))
+        for square in self.pieces_to_generate(PieceType.BISHOP, from_square):
+            pseudo_legal = self.generate_sliding_moves_pseudo_legal(square, diagonal_directions, tactical, quiet)
+            moves.extend(self.check_pseudo_legal_moves(pseudo_legal, pin_rays.get(square), evasion_mask))
 
         # rook
-        rooks = copy.copy(self.piece_to_squares[(PieceType.ROOK, self.color_to_move)])
-        for square in rooks:
-            pseudo_legal = self.generate_sliding_moves_pseudo_legal(square, straight_pattern)
-            if square not in pinned_pieces and not is_check:
-                moves.extend(pseudo_legal)
-            else:
-                moves.extend(self.check_pseudo_legal_moves(pseudo_legal))
+        for square in self.pieces_to_generate(PieceType.ROOK, from_square):
+            pseudo_legal = self.generate_sliding_moves_pseudo_legal(square, straight_directions, tactical, quiet)
+            moves.extend(self.check_pseudo_legal_moves(pseudo_legal, pin_rays.get(square), evasion_mask))
 
         # queen
-        queens = copy.copy(self.piece_to_squares[(PieceType.QUEEN, self.color_to_move)])
-        for square in queens:
-            pseudo_legal = self.generate_sliding_moves_pseudo_legal(square, straight_pattern + diagonal_pattern)
-            if square not in pinned_pieces and not is_check:
-                moves.extend(pseudo_legal)
-            else:
-                moves.extend(self.check_pseudo_legal_moves(pseudo_legal))
+        for square in self.pieces_to_generate(PieceType.QUEEN, from_square):
+            pseudo_legal = self.generate_sliding_moves_pseudo_legal(square, range(8), tactical, quiet)
+            moves.extend(self.check_pseudo_legal_moves(pseudo_legal, pin_rays.get(square), evasion_mask))
 
-        # knight
-        knights = copy.copy(self.piece_to_squares[(PieceType.KNIGHT, self.color_to_move)])
-        for square in knights:
-            if square in pinned_pieces:
+        # knight: a pinned knight can never move
+        for square in self.pieces_to_generate(PieceType.KNIGHT, from_square):
+            if square in pin_rays:
                 continue
-            elif not is_check:
-                moves.extend(self.generate_adjacent_moves_pseudo_legal(square, knight_pattern))
-            else:
-                mv = self.generate_adjacent_moves_pseudo_legal(square, knight_pattern)
-                moves.extend(self.check_pseudo_legal_moves(mv))
+            pseudo_legal = self.generate_adjacent_moves_pseudo_legal(square, knight_targets[square], tactical, quiet)
+            moves.extend(self.check_pseudo_legal_moves(pseudo_legal, None, evasion_mask))
 
         # pawn
-        pawns = copy.copy(self.piece_to_squares[(PieceType.PAWN, self.color_to_move)])
-        # ordering of this list, which breaks things
-
-        for square in pawns:
-            pseudo_legal = self.generate_pawns_pushes_captures_promotions_pseudo_legal(square)
-            if square not in pinned_pieces and not is_check:
-                moves.extend(pseudo_legal)
-            else:
-                moves.extend(self.check_pseudo_legal_moves(pseudo_legal))
-
-            en_pass = self.generate_en_passant_pseudo_legal(square)
-            if self.check_legality_en_passant(en_pass):
-                moves.extend(en_pass)
-            for m in moves:
-                if m.from_square.rank == m.to_square.rank and m.piece_moved == PieceType.PAWN:
-                    debug = 1
-                    print("pretty bad if you ask me")
+        for square in self.pieces_to_generate(PieceType.PAWN, from_square):
+            pseudo_legal = self.generate_pawns_pushes_captures_promotions_pseudo_legal(square, tactical, quiet)
+            moves.extend(self.check_pseudo_legal_moves(pseudo_legal, pin_rays.get(square), evasion_mask))
+
+            if tactical:
+                for en_pass in self.generate_en_passant_pseudo_legal(square):
+                    if self.check_legality_en_passant(en_pass, king, pin_rays.get(square), checkers, evasion_mask):
+                        moves.append(en_pass)
         return moves
 
-    def generate_pinned(self):
+    def pieces_to_generate(self, piece: PieceType, from_square: Optional[int]) -> List[int]:
+        byte = piece_bytes[(piece, self.color_to_move)]
+        if from_square is None:
+            return self.piece_lists[byte]
+        if self.mailbox[from_square] == byte:
+            return [from_square]
+        return []
+
+    def is_legal(self, move: int) -> bool:
         """
-        Assume that the king is not in check. Sliding pieces go through the king for move generation purposes.
-        :return:
+        Check whether a move, for instance coming from the transposition table or the killer moves, is legal in the
+        current position. Only the moves of the piece on its starting square are generated.
         """
-        pinned_squares = set()
+        from_sq = move & 63
+        if self.mailbox[from_sq] != (move >> 12) & 7 | color_bits[self.color_to_move]:
+            return False
+        return move in self.generate_moves(from_square=from_sq)
 
-        pinned_squares.update(
-            self.gen_pinned_sliding(sliding_diagonal, diagonal_pattern)
-        )
-        pinned_squares.update(
-            self.gen_pinned_sliding(sliding_straight, straight_pattern)
-        )
-        return pinned_squares
+    def generate_pinned(self) -> Dict[int, Set[int]]:
+        """
+        Find the pieces of the color to move that are pinned to their king.
+        :return: dictionary from pinned square to the squares it can move to without exposing the king, that is the
+        squares between the king and the pinner, pinner included.
+        """
+        pin_rays = self.gen_pinned_sliding(sliding_diagonal, diagonal_directions)
+        pin_rays.update(self.gen_pinned_sliding(sliding_straight, straight_directions))
+        return pin_rays
 
-    def generate_adjacent_moves_pseudo_legal(self, square: Square, pattern):
-        moves = []
-        piece_moved = self.bitboard[square.rank][square.file][0]
+    def generate_checkers(self, king_square: int) -> List[int]:
+        """
+        Squares of the opponent pieces giving check to the king on king_square.
+        """
+        opponent_color = self.color_to_move.flip()
+        them = color_bits[opponent_color]
+        mailbox = self.mailbox
+        checkers = []
 
-        for direction in pattern:
-            w = square + direction
-            if not w.is_valid():
-                continue
+        # pawns: they stand where a pawn of ours on king_square would capture
+        pawn = piece_bytes[(PieceType.PAWN, opponent_color)]
+        for square in pawn_targets[self.color_to_move][king_square]:
+            if mailbox[square] == pawn:
+                checkers.append(square)
+
+        # knights
+        knight = piece_bytes[(PieceType.KNIGHT, opponent_color)]
+        for square in knight_targets[king_square]:
+            if mailbox[square] == knight:
+                checkers.append(square)
+
+        # sliding
+        for d in range(8):
+            for square in rays[king_square][d]:
+                byte = mailbox[square]
+                if byte:
+                    if byte & them and d in slider_directions.get(byte_pieces[byte][0], ()):
+                        checkers.append(square)
+                    break
+
+        return checkers
+
+    @staticmethod
+    def check_evasion_mask(king_square: int, checker: int) -> Set[int]:
+        """
+        Squares where a piece other than the king can go to stop a single check: capturing the checker or, if it is a
+        slider, blocking the ray between it and the king.
+        """
+        mask = {checker}
+        for ray in rays[king_square]:
+            if checker in ray:
+                mask.update(ray[:ray.index(checker)])
+                break
+        return mask
+
+    def generate_adjacent_moves_pseudo_legal(self, square: int, targets: List[int], tactical: bool = True,
+                                             quiet: bool = True):
+        moves = []
+        mailbox = self.mailbox
+        us = color_bits[self.color_to_move]
+        base = square | (mailbox[square] & 7) << 12
 
-            piece_captured, color_captured = self.bitboard[w.rank][w.file]
-            if color_captured == self.color_to_move:
+        for to in targets:
+            byte = mailbox[to]
+            if byte & us or not (tactical if byte else quiet):
                 continue
-            move = Move(
-                from_square=square,
-                to_square=w,
-                piece_moved=piece_moved,
-                piece_captured=piece_captured,
-                promotion=None
-            )
-
-            moves.append(move)
+            moves.append(base | to << 6 | (byte & 7) << 15)
         return moves
 
-    def generate_sliding_moves_pseudo_legal(self, square: Square, list_directions):
-        piece = self.bitboard[square.rank][square.file][0]
+    def generate_sliding_moves_pseudo_legal(self, square: int, list_directions, tactical: bool = True,
+                                            quiet: bool = True):
+        mailbox = self.mailbox
+        us = color_bits[self.color_to_move]
+        base = square | (mailbox[square] & 7) << 12
         moves = []
-        for direction in list_directions:
-            new_square = square.clone() + direction
-            while new_square.is_valid():
-                piece_f, color_f = self.bitboard[new_square.rank][new_square.file]
-                if color_f != self.color_to_move:
-                    moves.append(Move(
-                        piece_moved=piece,
-                        piece_captured=piece_f,
-                        from_square=square,
-                        to_square=new_square,
-                        promotion=None
-                    ))
-                if piece_f is not None:
-                    break
-
-                new_square = new_square + direction
+        for d in list_directions:
+            for to in rays[square][d]:
+                byte = mailbox[to]
+                if not byte:
+                    if quiet:
+                        moves.append(base | to << 6)
+                    continue
+                if tactical and not byte & us:
+                    moves.append(base | to << 6 | (byte & 7) << 15)
+                break
 
         return moves
 
     def generate_castling_pseudo_legal(self):
         raise NotImplementedError
 
-    def generate_pawns_pushes_capassptures_promotions_pseudo_legal(self, square: Square):
+    def generate_pawns_pushes_captures_promotions_pseudo_legal(self, square: int, tactical: bool = True,
+                                                               quiet: bool = True):
 
-        pawn_direction = 1 if self.color_to_move == COLOR.WHITE else -1  # direction of the pawn
+        step = 8 if self.color_to_move == COLOR.WHITE else -8  # direction of the pawn
         back_rank = 1 if self.color_to_move == COLOR.WHITE else 6  # rank of the back rank
         promotion_rank = 6 if self.color_to_move == COLOR.WHITE else 1  # rank of the promotion rank
-        opponent_color = self.color_to_move.flip()
+        them = color_bits[self.color_to_move.flip()]
+        mailbox = self.mailbox
+        rank = square >> 3
+        base = square | piece_codes[PieceType.PAWN] << 12
+        forward = square + step
         moves = []
 
         # single push
-        if square.rank != promotion_rank:
-            if self.bitboard[square.rank + pawn_direction][square.file][0] is None:
-                moves.append(Move(
-                    piece_moved=PieceType.PAWN,
-                    piece_captured=None,
-                    from_square=square,
-                    to_square=Square(square.file, square.rank + pawn_direction),
-                    promotion=None
-                ))
+        if rank != promotion_rank and quiet:
+            if not mailbox[forward]:
+                moves.append(base | forward << 6)
                 # double push
-                if square.rank == back_rank and self.bitboard[square.rank + 2 * pawn_direction][square.file][0] is None:
-                    moves.append(Move(
-                        piece_moved=PieceType.PAWN,
-                        piece_captured=None,
-                        from_square=square,
-                        to_square=Square(square.file, square.rank + 2 * pawn_direction),
-                        promotion=None
-                    ))
-        else:  # promotion straight
-            if square.rank == promotion_rank:
-                if self.bitboard[square.rank + pawn_direction][square.file][0] is None:
-                    for piece in (PieceType.KNIGHT, PieceType.BISHOP, PieceType.ROOK, PieceType.QUEEN):
-                        moves.append(Move(
-                            piece_moved=PieceType.PAWN,
-                            piece_captured=None,
-                            from_square=square,
-                            to_square=Square(square.file, square.rank + pawn_direction),
-                            promotion=piece
-                        ))
+                if rank == back_rank and not mailbox[forward + step]:
+                    moves.append(base | (forward + step) << 6 | DOUBLE_PUSH)
+        elif tactical:  # promotion straight
+            if rank == promotion_rank:
+                if not mailbox[forward]:
+                    for piece in promotion_pieces:
+                        moves.append(base | forward << 6 | piece_codes[piece] << 18)
+
+        if not tactical:
+            return moves
 
         # captures
-        if square.file != 0:
-            piece_captured, color_captured = self.bitboard[square.rank + pawn_direction][square.file - 1]
-            if color_captured == opponent_color:
-                assert piece_captured is not None
-                assert self.bitboard[square.rank + pawn_direction][square.file - 1][0] is not None
-
-                if square.rank == promotion_rank:
-                    for piece in (PieceType.KNIGHT, PieceType.BISHOP, PieceType.ROOK, PieceType.QUEEN):
-                        moves.append(Move(
-                            piece_moved=PieceType.PAWN,
-                            piece_captured=piece_captured,
-                            from_square=square,
-                            to_square=Square(square.file - 1, square.rank + pawn_direction),
-                            promotion=piece
-                        ))
+        for to in pawn_targets[self.color_to_move][square]:
+            byte = mailbox[to]
+            if byte & them:
+                move = base | to << 6 | (byte & 7) << 15
+                if rank == promotion_rank:
+                    for piece in promotion_pieces:
+                        moves.append(move | piece_codes[piece] << 18)
                 else:
-                    moves.append(Move(
-                        piece_moved=PieceType.PAWN,
-                        piece_captured=piece_captured,
-                        from_square=square,
-                        to_square=Square(square.file - 1, square.rank + pawn_direction),
-                        promotion=None
-                    ))
-        if square.file != 7:
-            piece_captured, color_captured = self.bitboard[square.rank + pawn_direction][square.file + 1]
-            if color_captured == opponent_color:
-                if square.rank == promotion_rank:
-                    for piece in (PieceType.KNIGHT, PieceType.BISHOP, PieceType.ROOK, PieceType.QUEEN):
-                        moves.append(Move(
-                            piece_moved=PieceType.PAWN,
-                            piece_captured=piece_captured,
-                            from_square=square,
-                            to_square=Square(square.file + 1, square.rank + pawn_direction),
-                            promotion=piece
-                        ))
-                else:
-                    moves.append(Move(
-                        piece_moved=PieceType.PAWN,
-                        piece_captured=piece_captured,
-                        from_square=square,
-                        to_square=Square(square.file + 1, square.rank + pawn_direction),
-                        promotion=None
-                    ))
-
-        for m in moves:
-            if m.from_square.rank == m.to_square.rank:
-                debug = 1
-                print("pretty bad if you ask me")
+                    moves.append(move)
+
         return moves
 
-    def generate_en_passant_pseudo_legal(self, square: Square):  # decide if this returns a list or a single object
+    def generate_en_passant_pseudo_legal(self, square: int):  # decide if this returns a list or a single object
         # en passant
-        direction = 1 if self.color_to_move == COLOR.WHITE else -1
-        if self.en_passant is not None:
-            if self.en_passant.rank == square.rank + direction and abs(self.en_passant.file - square.file) == 1:
-                return [Move(
-                    piece_moved=PieceType.PAWN,
-                    piece_captured=None,
-                    from_square=square,
-                    to_square=self.en_passant,
-                    promotion=None
-                )]
+        if self.en_passant is not None and self.en_passant in pawn_targets[self.color_to_move][square]:
+            return [square | self.en_passant << 6 | piece_codes[PieceType.PAWN] << 12 | EN_PASSANT]
         return []
 
-    def generate_attacked_squares(self, attacker_color: COLOR):
-        """
-        Generate all the squares attacked by the attacker_color.
-        :return:
-        """
-        bitboard: List[List[List[PieceType]]] = [[[] for _ in range(8)] for _ in range(8)]
-
-        # pawns
-        if attacker_color == COLOR.WHITE:
-            tg = 1
-        else:
-            tg = -1
-        # rank goes up
-        for square in self.piece_to_squares[(PieceType.PAWN, attacker_color)]:
-            if square.file != 0:
-                bitboard[square.rank + tg][square.file - 1].append(PieceType.PAWN)
-            if square.file != 7:
-                bitboard[square.rank + tg][square.file + 1].append(PieceType.PAWN)
-
-        # knights
-        for square in self.piece_to_squares[(PieceType.KNIGHT, attacker_color)]:
-            for direction in knight_pattern:
-                attack_square = square + direction
-                if attack_square.is_valid():
-                    bitboard[attack_square.rank][attack_square.file].append(PieceType.KNIGHT)
-
-        # king
-        for square in self.piece_to_squares[(PieceType.KING, attacker_color)]:
-            for direction in king_pattern:
-                attack_square = square + direction
-                if attack_square.is_valid():
-                    bitboard[attack_square.rank][attack_square.file].append(PieceType.KING)
-
-        # sliding
-        for square in self.piece_to_squares[(PieceType.BISHOP, attacker_color)]:
-            for direction in diagonal_pattern:
-                self.fill_attack_bitboard(square, direction, bitboard, attacker_color)
-
-        for square in self.piece_to_squares[(PieceType.ROOK, attacker_color)]:
-            for direction in straight_pattern:
-                self.fill_attack_bitboard(square, direction, bitboard, attacker_color)
-
-        for square in self.piece_to_squares[(PieceType.QUEEN, attacker_color)]:
-            for direction in straight_pattern + diagonal_pattern:
-                self.fill_attack_bitboard(square, direction, bitboard, attacker_color)
-
-        return bitboard
-
-    def fill_attack_bitboard(self, square: Square, direction, bitboard, attacker_color: COLOR):
-        """ updates bitboard in place """
-        piece_att = self.bitboard[square.rank][square.file][0]
-        new_square = square.clone() + direction
-        while new_square.is_valid():
-
-            bitboard[new_square.rank][new_square.file].append(piece_att)
-
-            piece, color = self.bitboard[new_square.rank][new_square.file]
-            if piece is not None:
-                if piece == PieceType.KING and color != attacker_color:
-                    pass
-                else:
-                    break
-
-            new_square = new_square + direction
-
-    def gen_pinned_sliding(self, list_sliding_pieces, list_sliding_directions):
+    def gen_pinned_sliding(self, list_sliding_pieces, list_sliding_directions) -> Dict[int, Set[int]]:
         """
         Generate all the pieces pinned by attacks in direction list_directions (pieces with these patterns are in
         list_pieces_types)
         :param list_sliding_pieces:
-        :param list_sliding_directions:
-        :return:
+        :param list_sliding_directions: indices in attack_map.directions.
+        :return: dictionary from pinned square to the squares between the king and the pinner, pinner included.
         """
-        pinned_squares = set()
-        king_square: Square = self.piece_to_squares[(PieceType.KING, self.color_to_move)][0]
+        pin_rays = {}
+        king_square = self.piece_lists[piece_bytes[(PieceType.KING, self.color_to_move)]][0]
+        mailbox = self.mailbox
+        us = color_bits[self.color_to_move]
 
-        for direction in list_sliding_directions:
+        for d in list_sliding_directions:
             encountered = None
-            new_square = king_square.clone()
-
-            while True:
-                new_square = new_square + direction
-                if not new_square.is_valid():
-                    break
+            ray = set()
 
-                piece, color = self.bitboard[new_square.rank][new_square.file]
-                if piece is None: continue
+            for square in rays[king_square][d]:
+                ray.add(square)
+                byte = mailbox[square]
+                if not byte: continue
 
-                if color == self.color_to_move:
+                if byte & us:
                     if encountered is not None: break
-                    encountered = new_square
+                    encountered = square
                 else:
-                    if piece in list_sliding_pieces:
-                        pinned_squares.add(encountered)
-                    else:
-                        break
+                    if byte_pieces[byte][0] in list_sliding_pieces and encountered is not None:
+                        pin_rays[encountered] = ray
+                    break
 
-        return pinned_squares
+        return pin_rays
 
-    def is_attacked(self, square: Square):
+    def is_attacked(self, square: int):
         """
-        Check if a square is attacked by the opponent. This is slow and should only be used once if multiple attacks
-        need to be checked, it is better to generate the full bitboard
+        Check if a square is attacked by the opponent, reading the incrementally updated attack map.
         # todo: instead of using self.color_to_move use a custom color as argument
         :param square:
         :return:
         """
-        # check sliding, pawns, knights, kings
-        opponent_color = self.color_to_move.flip()
-
-        # pawns
-        if self.color_to_move == COLOR.WHITE and square.rank != 7:
-            # rank goes up
-            if square.file != 0:
-                if self.bitboard[square.rank + 1][square.file - 1] == (PieceType.PAWN, COLOR.BLACK):
-                    return True
-            if square.file != 7:
-                if self.bitboard[square.rank + 1][square.file + 1] == (PieceType.PAWN, COLOR.BLACK):
-                    return True
-        elif square.rank != 0:
-            if square.file != 0:
-                if self.bitboard[square.rank - 1][square.file - 1] == (PieceType.PAWN, COLOR.WHITE):
-                    return True
-            if square.file != 7:
-                if self.bitboard[square.rank - 1][square.file + 1] == (PieceType.PAWN, COLOR.WHITE):
-                    return True
-
-        # knights
-        for direction in knight_pattern:
-            attack_square = square + direction
-            if attack_square.is_valid():
-                if self.bitboard[attack_square.rank][attack_square.file] == (PieceType.KNIGHT, opponent_color):
-                    return True
-
-        # king
-        other_king_square: Square = self.piece_to_squares[(PieceType.KING, opponent_color)][0]
-        distance_rank = abs(square.rank - other_king_square.rank)  # maybe functions to do this?
-        distance_file = abs(square.file - other_king_square.file)
-        if max(distance_rank, distance_file) < 2:  # could be compressed but why?
-            return True
-
-        # sliding
-        if self.is_attacked_sliding(square, sliding_diagonal, diagonal_pattern):
-            return True
-
-        if self.is_attacked_sliding(square, sliding_straight, straight_pattern):
-            return True
+        return self.attack_map.is_attacked(square, self.color_to_move.flip())
 
-        return False
-
-    def is_attacked_sliding(self, square: Square, list_sliding_pieces, list_sliding_directions):
-        opponent_color = self.color_to_move.flip()
-
-        for direction in list_sliding_directions:
-            new_square = square.clone()
-            while True:
-                new_square = new_square + direction
-                if not new_square.is_valid():
-                    break
-
-                piece, color = self.bitboard[new_square.rank][new_square.file]
-                if piece is None:
-                    continue
-
-                if color == opponent_color and piece in list_sliding_pieces:
-                    return True
-                else:
+    def least_valuable_attacker(self, square: int, color: COLOR, removed: int = 0) -> Tuple[Optional[PieceType], int]:
+        """
+        Cheapest piece of color attacking square, looking through the pieces on the squares set in removed.
+        :param removed: bitboard of the squares to treat as empty.
+        :return: the piece and its square, None and -1 if square is not attacked.
+        """
+        mailbox = self.mailbox
+        for piece, targets in ((PieceType.PAWN, pawn_targets[color.flip()][square]),
+                               (PieceType.KNIGHT, knight_targets[square])):
+            byte = piece_bytes[(piece, color)]
+            for sq in targets:
+                if mailbox[sq] == byte and not removed >> sq & 1:
+                    return piece, sq
+
+        best, best_sq = None, -1
+        for d in range(8):
+            for sq in rays[square][d]:
+                if mailbox[sq] and not removed >> sq & 1:
+                    piece, c = byte_pieces[mailbox[sq]]
+                    if c == color and d in slider_directions.get(piece, ()) and \
+                            (best is None or constants.values[piece] < constants.values[best]):
+                        best, best_sq = piece, sq
                     break
-        return False
+        if best is not None:
+            return best, best_sq
 
-    def static_evaluation(self):
-        values = constants.values
-        score = 0
-        n_pieces = 0
-        for l in self.piece_to_squares.values():
-            n_pieces += len(l)
+        king = piece_bytes[(PieceType.KING, color)]
+        for sq in king_targets[square]:
+            if mailbox[sq] == king and not removed >> sq & 1:
+                return PieceType.KING, sq
+        return None, -1
 
-        end_game_mul = 1 - n_pieces / 32
-
-        for piece, color in self.piece_to_squares:
-            for square in self.piece_to_squares[(piece, color)]:
-                n_pieces += 1
-                score += values[piece] * color.value
-
-                file = square.file
-                rank = square.rank if color == COLOR.BLACK else 7 - square.rank
-
-                score += constants.complete_table[piece][rank][file] * color.value * (1 - end_game_mul)
-                score += constants.complete_table_endgame[piece][rank][file] * color.value * end_game_mul
-
-        return score
-
-    def pawn_structure_eval(self):
-        pawns_w = self.piece_to_squares[(PieceType.PAWN, COLOR.WHITE)]
-        pawns_b = self.piece_to_squares[(PieceType.PAWN, COLOR.BLACK)]
-
-        doubles = 0
-        passers = 0
-
-    def check_pseudo_legal_moves(self, moves: List[Move]) -> Iterable[Move]:
+    def pawn_bitboards(self) -> Tuple[int, int]:
         """
-        This function checks which moves in the list moves are legal. Assume all the moves here come from the same piece
-        so that some speedup can be implemented in the future. Basic implementation might be just bruteforcing all the
-        moves with is_attacked().
-        :param moves:
-        :return:
+        :return: bitboards of the white pawns and of the black pawns.
         """
+        res = []
+        for color in (COLOR.WHITE, COLOR.BLACK):
+            bb = 0
+            for square in self.piece_to_squares[(PieceType.PAWN, color)]:
+                bb |= 1 << square
+            res.append(bb)
+        return res[0], res[1]
 
-        # todo: this implementation is idiotic we need to keep track of pinned pieces and the direction they are pinned
-        # but for now we do this
-        valid = []
-        for move in moves:
-            self.make_move(move)
-            self.color_to_move = self.color_to_move.flip()
-            if not self.is_attacked(self.piece_to_squares[(PieceType.KING, self.color_to_move)][0]):
-                valid.append(move)
-            self.color_to_move = self.color_to_move.flip()
-
-            self.unmake_move()
-        return valid
-
-    def check_legality_en_passant(self, en_pass):
-        return self.check_pseudo_legal_moves(en_pass) != []
-
-    def generate_castling_legal(self, square: Square, attacked_bitboard):
+    @staticmethod
+    def check_pseudo_legal_moves(moves: List[int], pin_ray: Optional[Set[int]],
+                                 evasion_mask: Optional[Set[int]]) -> Iterable[int]:
+        """
+        Filter the pseudo legal moves of a single (non-king) piece, without touching the board.
+        :param moves: pseudo legal moves of the piece.
+        :param pin_ray: squares the piece can move to if it is pinned, None otherwise.
+        :param evasion_mask: squares that stop the check if the king is in check, None otherwise.
+        :return: legal moves.
+        """
+        if pin_ray is None and evasion_mask is None:
+            return moves
+        if pin_ray is None:
+            return [move for move in moves if (move >> 6) & 63 in evasion_mask]
+        if evasion_mask is None:
+            return [move for move in moves if (move >> 6) & 63 in pin_ray]
+        return [move for move in moves if (move >> 6) & 63 in pin_ray and (move >> 6) & 63 in evasion_mask]
+
+    def check_legality_en_passant(self, move: int, king_square: int, pin_ray: Optional[Set[int]],
+                                  checkers: List[int], evasion_mask: Optional[Set[int]]) -> bool:
+        """
+        En passant needs special care: the captured pawn is not on the landing square, and the capture removes two
+        pawns from the same rank at once, which may expose the king to a rook or queen along that rank.
+        """
+        from_sq, to_sq = move & 63, (move >> 6) & 63
+        captured_square = (from_sq & ~7) | (to_sq & 7)
+        if pin_ray is not None and to_sq not in pin_ray:
+            return False
+        if checkers and checkers[0] != captured_square and to_sq not in evasion_mask:
+            return False
+
+        if king_square >> 3 != from_sq >> 3:
+            return True
+        # directions 0 and 1 of attack_map.directions look east and west
+        for square in rays[king_square][0 if from_sq > king_square else 1]:
+            piece, color = byte_pieces[self.mailbox[square]]
+            if piece is not None and square != from_sq and square != captured_square:
+                return color == self.color_to_move or piece not in sliding_straight
+        return True
+
+    def generate_castling_legal(self, square: int, attacked: List[int]):
         """
         Generate castling moves that are legal.
-        todo: completely generated by the copilot, needs to be checked but looks good.
-        :param square:
-        :param attacked_bitboard:
+        :param square: square of the king.
+        :param attacked: number of opponent pieces attacking each square.
         :return:
         """
         moves = []
-        rank = square.rank
         if self.color_to_move == COLOR.WHITE:
-            if self.castling_rights.white_king_side and self.bitboard[0][7] == (PieceType.ROOK, COLOR.WHITE):
-                if not attacked_bitboard[0][5] and not attacked_bitboard[0][6] and self.bitboard[0][5][0] is None and \
-                        self.bitboard[0][6][0] is None:
-                    moves.append(Move(
-                        piece_moved=PieceType.KING,
-                        piece_captured=None,
-                        from_square=square,
-                        to_square=Square(6, 0),
-                        promotion=None
-                    ))
-            if self.castling_rights.white_queen_side and self.bitboard[0][0] == (PieceType.ROOK, COLOR.WHITE):
-                if not attacked_bitboard[0][2] and not attacked_bitboard[0][3] and self.bitboard[0][1][0] is None and \
-                        self.bitboard[0][2][0] is None and self.bitboard[0][3][0] is None:
-                    moves.append(Move(
-                        piece_moved=PieceType.KING,
-                        piece_captured=None,
-                        from_square=square,
-                        to_square=Square(2, 0),
-                        promotion=None
-                    ))
+            king_side = self.castling_rights & CastlingRights.WHITE_KING_SIDE
+            queen_side = self.castling_rights & CastlingRights.WHITE_QUEEN_SIDE
         else:
-            if self.castling_rights.black_king_side and self.bitboard[7][7] == (PieceType.ROOK, COLOR.BLACK):
-                if not attacked_bitboard[7][5] and not attacked_bitboard[7][6] and self.bitboard[7][5][0] is None and \
-                        self.bitboard[7][6][0] is None:
-                    moves.append(Move(
-                        piece_moved=PieceType.KING,
-                        piece_captured=None,
-                        from_square=square,
-                        to_square=Square(6, 7),
-                        promotion=None
-                    ))
-            if self.castling_rights.black_queen_side and self.bitboard[7][0] == (PieceType.ROOK, COLOR.BLACK):
-                if not attacked_bitboard[7][2] and not attacked_bitboard[7][3] and self.bitboard[7][1][0] is None and \
-                        self.bitboard[7][2][0] is None and self.bitboard[7][3][0] is None:
-                    moves.append(Move(
-                        piece_moved=PieceType.KING,
-                        piece_captured=None,
-                        from_square=square,
-                        to_square=Square(2, 7),
-                        promotion=None
-                    ))
+            king_side = self.castling_rights & CastlingRights.BLACK_KING_SIDE
+            queen_side = self.castling_rights & CastlingRights.BLACK_QUEEN_SIDE
+        mailbox = self.mailbox
+        rook = piece_bytes[(PieceType.ROOK, self.color_to_move)]
+        base = square & ~7
+        king = square | piece_codes[PieceType.KING] << 12 | CASTLING
+
+        if king_side and mailbox[base + 7] == rook:
+            if not attacked[base + 5] and not attacked[base + 6] and not mailbox[base + 5] and not mailbox[base + 6]:
+                moves.append(king | (base + 6) << 6)
+        if queen_side and mailbox[base] == rook:
+            if not attacked[base + 2] and not attacked[base + 3] and not mailbox[base + 1] and \
+                    not mailbox[base + 2] and not mailbox[base + 3]:
+                moves.append(king | (base + 2) << 6)
         return moves
 
-    def make_en_passant(self, move):
-        direction = 1 if self.color_to_move == COLOR.WHITE else -1
-
-        self.bitboard[move.to_square.rank][move.to_square.file] = (PieceType.PAWN, self.color_to_move)
-        self.bitboard[move.from_square.rank][move.from_square.file] = (None, None)
-        self.piece_to_squares[(PieceType.PAWN, self.color_to_move)].remove(move.from_square)
-        self.piece_to_squares[(PieceType.PAWN, self.color_to_move)].append(move.to_square)
-
-        # remove old pawn
-        self.bitboard[move.to_square.rank - direction][move.to_square.file] = (None, None)
-        self.piece_to_squares[(PieceType.PAWN, self.color_to_move.flip())].remove(
-            Square(move.to_square.file, move.to_square.rank - direction))
-
-    def make_promotion(self, move):
-        self.bitboard[move.to_square.rank][move.to_square.file] = (move.promotion, self.color_to_move)
-        self.piece_to_squares[(move.promotion, self.color_to_move)].append(move.to_square)
-
-        self.bitboard[move.from_square.rank][move.from_square.file] = (None, None)
-        self.piece_to_squares[(PieceType.PAWN, self.color_to_move)].remove(move.from_square)
-
-        if move.piece_captured is not None:
-            self.piece_to_squares[(move.piece_captured, self.color_to_move.flip())].remove(move.to_square)
-
-    def unmake_classic_move(self, move):
-        """assumes the color that needs to play is the one that played the move"""
-        # reset to_square to original state
-        opponent_color = self.color_to_move.flip()
-        if move.piece_captured is not None:
-            self.bitboard[move.to_square.rank][move.to_square.file] = (move.piece_captured, self.color_to_move.flip())
-            self.piece_to_squares[(move.piece_captured, opponent_color)].append(move.to_square)
-        else:
-            self.bitboard[move.to_square.rank][move.to_square.file] = (None, None)
-
-        # reset from_square to original state
-        self.bitboard[move.from_square.rank][move.from_square.file] = (move.piece_moved, self.color_to_move)
-
-        if move.promotion is not None:
-            self.piece_to_squares[(move.promotion, self.color_to_move)].remove(move.to_square)
-        else:
-            self.piece_to_squares[(move.piece_moved, self.color_to_move)].remove(move.to_square)
-        self.piece_to_squares[(move.piece_moved, self.color_to_move)].append(move.from_square)
-
-    def unmake_en_passant(self, move):
-        self.bitboard[move.to_square.rank][move.to_square.file] = (None, None)
-        self.bitboard[move.from_square.rank][move.from_square.file] = (move.piece_moved, self.color_to_move)
-        self.piece_to_squares[(move.piece_moved, self.color_to_move)].remove(move.to_square)
-        self.piece_to_squares[(move.piece_moved, self.color_to_move)].append(move.from_square)
-
-        # re add missing pawn
-        direction = 1 if self.color_to_move == COLOR.WHITE else -1
-        self.bitboard[move.to_square.rank - direction][move.to_square.file] = (
-            PieceType.PAWN, self.color_to_move.flip())
-        self.piece_to_squares[(PieceType.PAWN, self.color_to_move.flip())].append(
-            Square(move.to_square.file, move.to_square.rank - direction))
-
-    def unmake_promotion(self, move):
-        # remove the new promoted piece from the board
-        self.bitboard[move.to_square.rank][move.to_square.file] = (None, None)
-        self.piece_to_squares[(move.promotion, self.color_to_move)].remove(move.to_square)
-
-        # add the pawn back
-        self.bitboard[move.from_square.rank][move.from_square.file] = (PieceType.PAWN, self.color_to_move)
-        self.piece_to_squares[(PieceType.PAWN, self.color_to_move)].append(move.from_square)
-
-    def unmake_castle(self, move):
-        if move.to_square.file == 2:
-
-            # handle rook
-            self.piece_to_squares[(PieceType.ROOK, self.color_to_move)].remove(Square(3, move.from_square.rank))
-            self.piece_to_squares[(PieceType.ROOK, self.color_to_move)].append(Square(0, move.from_square.rank))
-
-            self.bitboard[move.from_square.rank][0] = (PieceType.ROOK, self.color_to_move)
-            self.bitboard[move.from_square.rank][3] = (None, None)
-
-            # handle king
-            self.piece_to_squares[(PieceType.KING, self.color_to_move)] = [move.from_square]
-            self.bitboard[move.from_square.rank][move.from_square.file] = (PieceType.KING, self.color_to_move)
-            self.bitboard[move.to_square.rank][move.to_square.file] = (None, None)
-
-        else:
-            self.piece_to_squares[(PieceType.ROOK, self.color_to_move)].remove(Square(5, move.from_square.rank))
-            self.piece_to_squares[(PieceType.ROOK, self.color_to_move)].append(Square(7, move.from_square.rank))
-
-            self.bitboard[move.from_square.rank][7] = (PieceType.ROOK, self.color_to_move)
-            self.bitboard[move.from_square.rank][5] = (None, None)
-
-            self.piece_to_squares[(PieceType.KING, self.color_to_move)] = [move.from_square]
-            self.bitboard[move.from_square.rank][move.from_square.file] = (PieceType.KING, self.color_to_move)
-            self.bitboard[move.to_square.rank][move.to_square.file] = (None, None)
-
 
 class CastlingRights:
-    def __init__(self, wks=False, wqs=False, bks=False, bqs=False):
-        self.white_king_side = wks
-        self.white_queen_side = wqs
-        self.black_king_side = bks
-        self.black_queen_side = bqs
+    """
+    Castling rights are a 4-bit int, one bit per side and color, so that saving and restoring them allocates nothing.
+    """
+    WHITE_KING_SIDE = 1
+    WHITE_QUEEN_SIDE = 2
+    BLACK_KING_SIDE = 4
+    BLACK_QUEEN_SIDE = 8
+    ALL = 15
+
+    chars = {"K": WHITE_KING_SIDE, "Q": WHITE_QUEEN_SIDE, "k": BLACK_KING_SIDE, "q": BLACK_QUEEN_SIDE}
+
+    # rights that survive a move from or to each square: moving the king or a rook, or capturing a rook on its
+    # starting square, loses the corresponding rights
+    masks = [ALL] * 64
+    masks[0] = ALL ^ WHITE_QUEEN_SIDE
+    masks[7] = ALL ^ WHITE_KING_SIDE
+    masks[4] = ALL ^ WHITE_KING_SIDE ^ WHITE_QUEEN_SIDE
+    masks[56] = ALL ^ BLACK_QUEEN_SIDE
+    masks[63] = ALL ^ BLACK_KING_SIDE
+    masks[60] = ALL ^ BLACK_KING_SIDE ^ BLACK_QUEEN_SIDE
 
     @classmethod
-    def from_string(cls, s):
-        castling_rights = cls()
+    def from_string(cls, s) -> int:
+        castling_rights = 0
         for c in s:
-            if c == "K":
-                castling_rights.white_king_side = True
-            elif c == "Q":
-                castling_rights.white_queen_side = True
-            elif c == "k":
-                castling_rights.black_king_side = True
-            elif c == "q":
-                castling_rights.black_queen_side = True
-            elif c == "-":
-                pass
-            else:
+            if c in cls.chars:
+                castling_rights |= cls.chars[c]
+            elif c != "-":
                 raise ValueError
         return castling_rights
 
-    def update_rights(self, move: Move):
-        raise NotImplementedError
+    @classmethod
+    def to_string(cls, castling_rights: int) -> str:
+        return "".join(c for c, bit in cls.chars.items() if castling_rights & bit) or "-"
+
+    @classmethod
+    def update_rights(cls, castling_rights: int, move: int) -> int:
+        """
+        :param castling_rights: rights before the move.
+        :param move: packed move.
+        :return: rights after the move.
+        """
+        return castling_rights & cls.masks[move & 63] & cls.masks[(move >> 6) & 63]
 
-    def moved_king(self, color):
-        if color == COLOR.WHITE:
-            self.white_king_side = False
-            self.white_queen_side = False
-        else:
-            self.black_king_side = False
-            self.black_queen_side = False
-
-    def clone(self):
-        return CastlingRights(
-            wks=self.white_king_side,
-            wqs=self.white_queen_side,
-            bks=self.black_king_side,
-            bqs=self.black_queen_side
-        )
-
-    def moved_rook(self, color, square):
-        if color == COLOR.WHITE:
-            if square == Square(0, 0):
-                self.white_queen_side = False
-            elif square == Square(7, 0):
-                self.white_king_side = False
-        else:
-            if square == Square(0, 7):
-                self.black_queen_side = False
-            elif square == Square(7, 7):
-                self.black_king_side = False
+
+class UndoRecord:
+    """
+    What make_move saves to be able to unmake a move. The captured piece is part of the packed move.
+    """
+    __slots__ = ("move", "castling_rights", "en_passant", "move_50_rule", "hash", "pawn_hash")
+
+    def __init__(self):
+        self.move = 0
+        self.castling_rights = 0
+        self.en_passant = None
+        self.move_50_rule = 0
+        self.hash = 0
+        self.pawn_hash = 0
+
+
+MAX_GAME_PLY = 1024  # records preallocated in the undo stack. It grows if a game gets longer
+REPETITION_FILTER_MASK = 4095
 
 
 class ZobristHashHandler:
+    """
+    Zobrist hash of the position: piece placement, side to move, castling rights and en passant file.
+    Boards only set the en passant square when a pawn can capture there, so the file is hashed whenever it is set.
+    pawn_hash only hashes the pawns, with the same keys, and indexes the pawn structure cache.
+    """
+
     def __init__(self, n_bits: int = 64, seed: int = 0) -> None:
-        self.table, self.black_to_move = self.generate_zobrist_table(n_bits=n_bits, seed=seed)
+        self.table, self.black_to_move, self.castling, self.en_passant_files = \
+            self.generate_zobrist_table(n_bits=n_bits, seed=seed)
+        self.hash = 0
+        self.pawn_hash = 0
 
     @staticmethod
+    @functools.lru_cache
     def generate_zobrist_table(n_bits, seed):
-        random.seed(seed)
-        table = [[random.getrandbits(n_bits) for _ in range(12)] for _ in range(64)]
-        black_to_move = random.getrandbits(n_bits)
-        return table, black_to_move
+        """
+        Keys for every (square, piece) pair, for black to move, for each of the 16 combinations of castling rights
+        and for each en passant file. Cached, since every board asks for the same tables.
+        """
+        rng = random.Random(seed)
+        table = [[rng.getrandbits(n_bits) for _ in range(12)] for _ in range(64)]
+        black_to_move = rng.getrandbits(n_bits)
+        castling = [rng.getrandbits(n_bits) for _ in range(16)]
+        en_passant_files = [rng.getrandbits(n_bits) for _ in range(8)]
+        return table, black_to_move, castling, en_passant_files
 
     @staticmethod
-    def get_table_idxs(piece: PieceType, color: COLOR, square: Square):
-        return square.rank * 8 + square.file, piece.value + 3 * (color.value + 1)
+    def get_table_idxs(piece: PieceType, color: COLOR, square: int):
+        return square, piece.value + 3 * (color.value + 1)
 
-    def initialize_hash(self, board: Board) -> None:
-        h = 0
+    def compute_hash(self, board) -> int:
+        """
+        Hash of the position on board, from scratch.
+        """
+        h = self.castling[board.castling_rights]
         if board.color_to_move == COLOR.BLACK:
             h ^= self.black_to_move
-        for rank in range(8):
-            for file in range(8):
-                if board.bitboard[rank][file][0] is None:
-                    continue
-                piece, color = board.bitboard[rank][file]
-                square = Square(file, rank)
+        if board.en_passant is not None:
+            h ^= self.en_passant_files[board.en_passant & 7]
+        for square in range(64):
+            piece, color = board.piece_at(square)
+            if piece is None:
+                continue
+            i, j = self.get_table_idxs(piece, color, square)
+            h ^= self.table[i][j]
+        return h
+
+    def compute_pawn_hash(self, board) -> int:
+        h = 0
+        for square in range(64):
+            piece, color = board.piece_at(square)
+            if piece == PieceType.PAWN:
                 i, j = self.get_table_idxs(piece, color, square)
                 h ^= self.table[i][j]
-        self.hash = h
+        return h
+
+    def initialize_hash(self, board) -> None:
+        self.hash = self.compute_hash(board)
+        self.pawn_hash = self.compute_pawn_hash(board)
+
+    def verify_hash(self, board) -> None:
+        """
+        Debug check: the incrementally updated hash must match the one computed from scratch.
+        """
+        assert self.hash == self.compute_hash(board), "incremental zobrist hash out of sync"
+        assert self.pawn_hash == self.compute_pawn_hash(board), "incremental pawn hash out of sync"
 
     def get_hash(self):
         return self.hash
 
-    def update_hash(self, move: Move, color_to_move: COLOR):
-        self.hash ^= self.black_to_move
-        if move.piece_captured is not None:
-            i, j = self.get_table_idxs(move.piece_captured, color_to_move.flip(), move.to_square)
-            self.hash ^= self.table[i][j]
-        i, j = self.get_table_idxs(move.piece_moved, color_to_move, move.from_square)
-        self.hash ^= self.table[i][j]
-        i, j = self.get_table_idxs(move.piece_moved, color_to_move, move.to_square)
-        self.hash ^= self.table[i][j]
+    def update_hash(self, move: int, color_to_move: COLOR, castling_rights: int, new_castling_rights: int,
+                    en_passant: Optional[int], new_en_passant: Optional[int]):
+        """
+        Update the hash for a move. Call it once the move is made, with the state before and after it.
+        :param move: packed move, see move.py. Squares are indexed as rank * 8 + file, like the table.
+        :param color_to_move: color that made the move.
+        """
+        from_sq, to_sq = move & 63, (move >> 6) & 63
+        us = 3 * (color_to_move.value + 1)
+        them = 6 - us
+        table = self.table
+
+        h = self.hash ^ self.black_to_move
+        piece = ((move >> 12) & 7) - 1 + us
+        promotion = (move >> 18) & 7
+        h ^= table[from_sq][piece] ^ table[to_sq][promotion - 1 + us if promotion else piece]
+        if piece == PieceType.PAWN.value + us:
+            self.pawn_hash ^= table[from_sq][piece] if promotion else table[from_sq][piece] ^ table[to_sq][piece]
+        if move & CAPTURE_MASK:
+            captured = ((move >> 15) & 7) - 1 + them
+            h ^= table[to_sq][captured]
+            if captured == PieceType.PAWN.value + them:
+                self.pawn_hash ^= table[to_sq][captured]
+        elif move & EN_PASSANT:
+            h ^= table[to_sq - 8 * color_to_move.value][PieceType.PAWN.value + them]
+            self.pawn_hash ^= table[to_sq - 8 * color_to_move.value][PieceType.PAWN.value + them]
+        elif move & CASTLING:
+            rook_from, rook_to = Board.castle_rook_squares(to_sq)
+            h ^= table[rook_from][PieceType.ROOK.value + us] ^ table[rook_to][PieceType.ROOK.value + us]
+
+        if castling_rights != new_castling_rights:
+            h ^= self.castling[castling_rights] ^ self.castling[new_castling_rights]
+        if en_passant is not None:
+            h ^= self.en_passant_files[en_passant & 7]
+        if new_en_passant is not None:
+            h ^= self.en_passant_files[new_en_passant & 7]
+        self.hash = h
 
 
 if __name__ == "__main__":
     zobrist = ZobristHashHandler()
     fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQ - 0 1"
     board = Board.from_fen(fen)
-    move = Move.from_string("e2e4", board)
+    move = Move.from_string("e2e4", board).to_packed()
 
     print(board.zobrist.get_hash())
     board.make_move(move)
@@ -1,9 +1,24 @@
-from typing import List
+from typing import List, Optional, Tuple
 
 from bitboard import BitBoard
-from attack_bitboard import MovePatterns
-from constants import COLOR, PieceType
-from move import Move
+from attack_bitboard import MovePatterns, compute_rays, between
+from board import BaseBoard, CastlingRights, phase_table
+from magic import magic_bishop, magic_rook
+from constants import COLOR, PieceType, Square, piece_bytes
+from move import CAPTURE_MASK, CASTLING, DOUBLE_PUSH, EN_PASSANT, code_pieces, piece_codes
+
+# squares are ints, file + 8 * rank, like in attack_bitboard and in packed moves.
+promotion_pieces = (PieceType.KNIGHT, PieceType.BISHOP, PieceType.ROOK, PieceType.QUEEN)
+rank_1 = 0xFF
+rank_8 = 0xFF << 56
+full_board = (1 << 64) - 1
+
+
+def iterate_bits(bb: int):
+    while bb:
+        lsb = bb & -bb
+        yield lsb.bit_length() - 1
+        bb ^= lsb
 
 
 class BitBoardManager:
@@ -11,77 +26,424 @@ class BitBoardManager:
         self.color = color
         self.pawn_moves = MovePatterns.pawn_moves[color]
         self.pawn_attacks = MovePatterns.pawn_attacks[color]
-        
+
         self.bishop_bitboard = BitBoard()
         self.rook_bitboard = BitBoard()
         self.queen_bitboard = BitBoard()
         self.knight_bitboard = BitBoard()
         self.pawn_bitboard = BitBoard()
         self.king_bitboard = BitBoard()
+        self.occupied = BitBoard()
+
+        # same objects as above, indexed by PieceType.value
+        self.bitboards = [
+            self.pawn_bitboard,
+            self.knight_bitboard,
+            self.bishop_bitboard,
+            self.rook_bitboard,
+            self.queen_bitboard,
+            self.king_bitboard,
+        ]
 
-    
     def get_occupied_squares(self):
         return self.bishop_bitboard | self.rook_bitboard | self.queen_bitboard | self.knight_bitboard | self.pawn_bitboard | self.king_bitboard
 
+    def add_piece(self, piece: PieceType, square: int):
+        self.bitboards[piece.value].set_squares(square)
+        self.occupied.set_squares(square)
+
+    def remove_piece(self, piece: PieceType, square: int):
+        self.bitboards[piece.value].remove_square(square)
+        self.occupied.remove_square(square)
+
 
 class UtilityBitboard:
     def __init__(self):
         self.pinned_squares = BitBoard()
         self.checkers = BitBoard()
         self.check_rays = BitBoard()
+        self.pin_rays = {}  # pinned square -> squares it can move to without exposing the king
 
 
-class Board:
+class Board(BaseBoard):
+    """
+    Bitboard implementation of board.Board, with the same public API.
+    A 64-entry mailbox is kept alongside the bitboards to look up the piece on a given square.
+    """
 
     def __init__(self):
+        super().__init__()
         self.white_bitboards = BitBoardManager(COLOR.WHITE)
         self.black_bitboards = BitBoardManager(COLOR.BLACK)
-        self.white_piece_to_square = [[] for _ in PieceType]
-        self.black_piece_to_square = [[] for _ in PieceType]
-        self.my_bitboards = None
-        self.opponent_bitboards = None
-
-        self.castling_rights = CastlingRights()
-        self.en_passant = None
-        self.color_to_move = None
-        self.zobrist = None
+        self.mailbox: List[Tuple[Optional[PieceType], Optional[COLOR]]] = [(None, None) for _ in range(64)]
+        self.my_bitboards = self.white_bitboards
+        self.opponent_bitboards = self.black_bitboards
 
         self.utility_bitboard = UtilityBitboard()
 
-        self.move_history = []
-        self.castling_rights_history = []
-        self.en_passant_history = []
-        self.zobrist_hash_history = []
-
     @classmethod
     def from_fen(cls, fen: str):
-        raise NotImplementedError
+        """
+        Parse input string in fen format and use its info to initialize a Board object.
+        """
+        board = cls()
+        current_rank = 7
+        current_file = 0
+        fen_parts = fen.split()  # [pieces, color, castling rights, en passant, 50 move rule, total half moves]
 
-    @classmethod
-    def from_startpos(cls):
-        return cls.from_fen("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
-    
-    def generate_moves(self) -> List[Move]:
-        raise NotImplementedError
+        for c in fen_parts[0]:
+            if c == "/":
+                current_rank -= 1
+                current_file = 0
+            elif c.isdigit():
+                current_file += int(c)
+            else:
+                color = COLOR.WHITE if c.isupper() else COLOR.BLACK
+                piece_type = PieceType.from_char(c.lower())
+                board.put_piece(piece_type, color, current_file + 8 * current_rank)
+                current_file += 1
+
+        board.color_to_move = COLOR.WHITE if fen_parts[1] == "w" else COLOR.BLACK
+        board.my_bitboards, board.opponent_bitboards = board.managers(board.color_to_move)
+        board.castling_rights = CastlingRights.from_string(fen_parts[2])
+        board.en_passant = None if fen_parts[3] == "-" else Square.from_string_algebraic(fen_parts[3]).index
+        if board.en_passant is not None and not board.en_passant_capturable(board.en_passant, board.color_to_move):
+            board.en_passant = None
+        board.move_50_rule = int(fen_parts[4])
+        board.start_ply = 2 * (int(fen_parts[5]) - 1) + (board.color_to_move == COLOR.BLACK)
+
+        board.zobrist.initialize_hash(board)
+
+        return board
+
+    def managers(self, color: COLOR):
+        """
+        :return: bitboards of color, bitboards of the opponent of color.
+        """
+        if color == COLOR.WHITE:
+            return self.white_bitboards, self.black_bitboards
+        return self.black_bitboards, self.white_bitboards
+
+    def put_piece(self, piece: PieceType, color: COLOR, square: int):
+        self.managers(color)[0].add_piece(piece, square)
+        self.mailbox[square] = (piece, color)
+        mg, eg = phase_table[piece_bytes[(piece, color)] << 6 | square]
+        self.mg_score += mg
+        self.eg_score += eg
+        self.n_pieces += 1
+
+    def take_piece(self, piece: PieceType, color: COLOR, square: int):
+        self.managers(color)[0].remove_piece(piece, square)
+        self.mailbox[square] = (None, None)
+        mg, eg = phase_table[piece_bytes[(piece, color)] << 6 | square]
+        self.mg_score -= mg
+        self.eg_score -= eg
+        self.n_pieces -= 1
+
+    def piece_at(self, square: int) -> Tuple[Optional[PieceType], Optional[COLOR]]:
+        return self.mailbox[square]
+
+    def occupancy(self) -> int:
+        return self.white_bitboards.occupied.val | self.black_bitboards.occupied.val
+
+    def make_move(self, move: int):
+        """
+        Executes a move on the board and flips the color to move.
+        :param move: move to make, in the packed format of move.py
+        :return:
+        """
+        record = self.push_undo_record(move)
+
+        us, them = self.color_to_move, self.color_to_move.flip()
+        from_sq, to_sq = move & 63, (move >> 6) & 63
+        piece_moved = code_pieces[(move >> 12) & 7]
+
+        if move & CAPTURE_MASK:
+            self.move_50_rule = 0
+            self.take_piece(code_pieces[(move >> 15) & 7], them, to_sq)
+
+        match piece_moved:
+            case PieceType.KING:
+                if move & CASTLING:
+                    rook_from, rook_to = self.castle_rook_squares(to_sq)
+                    self.take_piece(PieceType.ROOK, us, rook_from)
+                    self.put_piece(PieceType.ROOK, us, rook_to)
+            case PieceType.PAWN:
+                self.move_50_rule = 0
+                if move & EN_PASSANT:
+                    self.take_piece(PieceType.PAWN, them, to_sq - 8 * us.value)
+                elif move & DOUBLE_PUSH and self.en_passant_capturable(from_sq + 8 * us.value, them):
+                    self.en_passant = from_sq + 8 * us.value
+
+        self.take_piece(piece_moved, us, from_sq)
+        self.put_piece(code_pieces[(move >> 18) & 7] or piece_moved, us, to_sq)
+
+        self.my_bitboards, self.opponent_bitboards = self.opponent_bitboards, self.my_bitboards
+        self.finish_move(record, us)
+
+    def unmake_move(self):
+        """
+        Unmake a move and revert the state of the board to the previous one
+        :return:
+        """
+        move = self.pop_undo_record()
+        self.my_bitboards, self.opponent_bitboards = self.opponent_bitboards, self.my_bitboards
+
+        us, them = self.color_to_move, self.color_to_move.flip()
+        from_sq, to_sq = move & 63, (move >> 6) & 63
+        piece_moved = code_pieces[(move >> 12) & 7]
+
+        self.take_piece(code_pieces[(move >> 18) & 7] or piece_moved, us, to_sq)
+        self.put_piece(piece_moved, us, from_sq)
+
+        if move & CAPTURE_MASK:
+            self.put_piece(code_pieces[(move >> 15) & 7], them, to_sq)
+        elif move & EN_PASSANT:
+            self.put_piece(PieceType.PAWN, them, to_sq - 8 * us.value)
+        elif move & CASTLING:
+            rook_from, rook_to = self.castle_rook_squares(to_sq)
+            self.take_piece(PieceType.ROOK, us, rook_to)
+            self.put_piece(PieceType.ROOK, us, rook_from)
+
+        if self.debug:
+            self.check_consistency()
+
+    def en_passant_capturable(self, square: int, color: COLOR) -> bool:
+        """
+        Whether a pawn of color stands ready to capture en passant on square, legality aside.
+        """
+        return MovePatterns.pawn_attacks[color.flip()][square].val & self.managers(color)[0].pawn_bitboard.val != 0
+
+    def attackers(self, square: int, occupancy: int, color: COLOR) -> int:
+        """
+        Pieces of the given color that attack square, with sliders blocked by occupancy.
+        """
+        bbs = self.managers(color)[0].bitboards
+        queens = bbs[PieceType.QUEEN.value].val
+        return (
+            (MovePatterns.pawn_attacks[color.flip()][square].val & bbs[PieceType.PAWN.value].val)
+            | (MovePatterns.knight_moves[square].val & bbs[PieceType.KNIGHT.value].val)
+            | (MovePatterns.king_moves[square].val & bbs[PieceType.KING.value].val)
+            | (magic_bishop(square, occupancy) & (bbs[PieceType.BISHOP.value].val | queens))
+            | (magic_rook(square, occupancy) & (bbs[PieceType.ROOK.value].val | queens))
+        )
+
+    def least_valuable_attacker(self, square: int, color: COLOR, removed: int = 0) -> Tuple[Optional[PieceType], int]:
+        """
+        Cheapest piece of color attacking square, looking through the pieces on the squares set in removed.
+        :param removed: bitboard of the squares to treat as empty.
+        :return: the piece and its square, None and -1 if square is not attacked.
+        """
+        occupancy = self.occupancy() & ~removed
+        attackers = self.attackers(square, occupancy, color) & occupancy
+        if attackers:
+            bbs = self.managers(color)[0].bitboards
+            for piece in PieceType:
+                bb = attackers & bbs[piece.value].val
+                if bb:
+                    return piece, (bb & -bb).bit_length() - 1
+        return None, -1
+
+    def is_attacked(self, square: int):
+        """
+        Check if a square is attacked by the opponent of the color to move.
+        :param square:
+        :return:
+        """
+        return self.attackers(square, self.occupancy(), self.color_to_move.flip()) != 0
+
+    def is_check(self) -> bool:
+        king_square = self.my_bitboards.king_bitboard.lsb()
+        return self.attackers(king_square, self.occupancy(), self.color_to_move.flip()) != 0
 
     def update_utility_bitboard(self):
-        checkers = BitBoard()
-        check_rays = BitBoard()
+        """
+        Compute the pieces giving check, the squares that block or capture a single checker, and the pinned pieces
+        of the color to move together with the squares along their pin ray.
+        """
         king_square = self.my_bitboards.king_bitboard.lsb()
-        occupied_squares = self.my_bitboards.get_occupied_squares() | self.opponent_bitboards.get_occupied_squares()
-
-        knight_attacks = MovePatterns.knight_moves[king_square] & self.opponent_bitboards.knight_bitboard
-        checkers |= knight_attacks
-        check_rays |= knight_attacks
-        pawn_attacks = self.my_bitboards.pawn_attacks[king_square] & self.opponent_bitboards.pawn_bitboard
-        checkers |= pawn_attacks
-        check_rays |= pawn_attacks
-        bishop_attacks = magic_bishop(king_square, occupied_squares) & (self.opponent_bitboards.bishop_bitboard | self.opponent_bitboards.queen_bitboard)
-        checkers |= bishop_attacks
-        check_rays |= compute_bishop_rays(king_square, bishop_attacks)
-        rook_attacks = magic_rook(king_square, occupied_squares) & (self.opponent_bitboards.rook_bitboard | self.opponent_bitboards.queen_bitboard)
-        checkers |= rook_attacks
-        check_rays |= compute_rook_rays(king_square, rook_attacks)
-
-        self.utility_bitboard.checkers = checkers
-        self.utility_bitboard.check_rays = check_rays
+        my_occupied = self.my_bitboards.occupied.val
+        opponent_occupied = self.opponent_bitboards.occupied.val
+        occupied_squares = my_occupied | opponent_occupied
+        opponent = self.opponent_bitboards.bitboards
+        queens = opponent[PieceType.QUEEN.value].val
+        diagonal_sliders = opponent[PieceType.BISHOP.value].val | queens
+        straight_sliders = opponent[PieceType.ROOK.value].val | queens
+
+        checkers = self.attackers(king_square, occupied_squares, self.color_to_move.flip())
+        check_rays = checkers | compute_rays(king_square, checkers)
+
+        # a piece is pinned if it is the only piece between the king and an enemy slider looking at it through our
+        # own pieces
+        pinned_squares = 0
+        pin_rays = {}
+        pinners = (magic_bishop(king_square, opponent_occupied) & diagonal_sliders) | \
+                  (magic_rook(king_square, opponent_occupied) & straight_sliders)
+        for pinner in iterate_bits(pinners):
+            blockers = between[king_square][pinner] & occupied_squares
+            if blockers & (blockers - 1) == 0 and blockers & my_occupied:
+                pinned_squares |= blockers
+                pin_rays[blockers.bit_length() - 1] = between[king_square][pinner] | (1 << pinner)
+
+        self.utility_bitboard.checkers = BitBoard(checkers)
+        self.utility_bitboard.check_rays = BitBoard(check_rays)
+        self.utility_bitboard.pinned_squares = BitBoard(pinned_squares)
+        self.utility_bitboard.pin_rays = pin_rays
+
+    def generate_moves(self, tactical: bool = True, quiet: bool = True,
+                       from_square: Optional[int] = None) -> List[int]:
+        """
+        Generate all legal moves in the position, packed as in move.py
+        :param tactical: include captures (en passant too) and promotions.
+        :param quiet: include all the other moves, castling included.
+        :param from_square: if given, only generate the moves of the piece on this square.
+        :return:
+        """
+        self.update_utility_bitboard()
+        us, them = self.color_to_move, self.color_to_move.flip()
+        mine = self.my_bitboards.bitboards
+        my_occupied = self.my_bitboards.occupied.val
+        opponent_occupied = self.opponent_bitboards.occupied.val
+        occupied = my_occupied | opponent_occupied
+        checkers = self.utility_bitboard.checkers.val
+        pin_rays = self.utility_bitboard.pin_rays
+        mailbox = self.mailbox
+        from_mask = full_board if from_square is None else 1 << from_square
+        land_mask = (opponent_occupied if tactical else 0) | (~occupied & full_board if quiet else 0)
+
+        moves: List[int] = []
+
+        # king: the king itself must not block the attackers when we check its destination squares
+        king_square = self.my_bitboards.king_bitboard.lsb()
+        if from_mask & (1 << king_square):
+            occupied_no_king = occupied ^ (1 << king_square)
+            base = king_square | piece_codes[PieceType.KING] << 12
+            for to in iterate_bits(MovePatterns.king_moves[king_square].val & land_mask):
+                if not self.attackers(to, occupied_no_king, them):
+                    moves.append(base | to << 6 | piece_codes[mailbox[to][0]] << 15)
+            if not checkers and quiet:
+                moves.extend(self.generate_castling_legal(king_square, occupied))
+
+        if checkers & (checkers - 1):
+            # double check: only the king can move
+            return moves
+
+        target_mask = self.utility_bitboard.check_rays.val if checkers else full_board
+
+        # knights, bishops, rooks, queens
+        for piece in (PieceType.KNIGHT, PieceType.BISHOP, PieceType.ROOK, PieceType.QUEEN):
+            for from_sq in iterate_bits(mine[piece.value].val & from_mask):
+                if piece == PieceType.KNIGHT:
+                    if from_sq in pin_rays:
+                        continue
+                    targets = MovePatterns.knight_moves[from_sq].val
+                elif piece == PieceType.BISHOP:
+                    targets = magic_bishop(from_sq, occupied)
+                elif piece == PieceType.ROOK:
+                    targets = magic_rook(from_sq, occupied)
+                else:
+                    targets = magic_bishop(from_sq, occupied) | magic_rook(from_sq, occupied)
+                targets &= land_mask & target_mask
+                if from_sq in pin_rays:
+                    targets &= pin_rays[from_sq]
+                base = from_sq | piece_codes[piece] << 12
+                for to in iterate_bits(targets):
+                    moves.append(base | to << 6 | piece_codes[mailbox[to][0]] << 15)
+
+        self.generate_pawn_moves(moves, occupied, opponent_occupied, target_mask, pin_rays, from_mask, tactical, quiet)
+        return moves
+
+    def is_legal(self, move: int) -> bool:
+        """
+        Check whether a move, for instance coming from the transposition table or the killer moves, is legal in the
+        current position. Only the moves of the piece on its starting square are generated.
+        """
+        from_sq = move & 63
+        if self.mailbox[from_sq] != (code_pieces[(move >> 12) & 7], self.color_to_move):
+            return False
+        return move in self.generate_moves(from_square=from_sq)
+
+    def generate_pawn_moves(self, moves: List[int], occupied: int, opponent_occupied: int, target_mask: int,
+                            pin_rays, from_mask: int = full_board, tactical: bool = True, quiet: bool = True):
+        """
+        Append the legal pawn moves to moves, given the masks computed by update_utility_bitboard.
+        """
+        us = self.color_to_move
+        direction = 8 * us.value
+        start_rank = 1 if us == COLOR.WHITE else 6
+        promotion_ranks = rank_1 | rank_8
+        # pushes to the last rank are promotions, hence tactical
+        push_mask = (promotion_ranks if tactical else 0) | (~promotion_ranks & full_board if quiet else 0)
+
+        pawn = piece_codes[PieceType.PAWN] << 12
+
+        for from_sq in iterate_bits(self.my_bitboards.pawn_bitboard.val & from_mask):
+            mask = target_mask & pin_rays.get(from_sq, full_board)
+            base = from_sq | pawn
+            targets = 0
+
+            one = from_sq + direction
+            if not (occupied >> one) & 1:
+                targets |= 1 << one
+                two = one + direction
+                if from_sq // 8 == start_rank and not (occupied >> two) & 1:
+                    targets |= 1 << two
+                targets &= push_mask
+            if tactical:
+                targets |= self.my_bitboards.pawn_attacks[from_sq].val & opponent_occupied
+            targets &= mask
+
+            for to in iterate_bits(targets):
+                move = base | to << 6 | piece_codes[self.mailbox[to][0]] << 15
+                if (1 << to) & promotion_ranks:
+                    for piece in promotion_pieces:
+                        moves.append(move | piece_codes[piece] << 18)
+                elif to - from_sq == 2 * direction:
+                    moves.append(move | DOUBLE_PUSH)
+                else:
+                    moves.append(move)
+
+            if tactical and self.en_passant is not None:
+                to = self.en_passant
+                if self.my_bitboards.pawn_attacks[from_sq].val & (1 << to) and \
+                        self.check_legality_en_passant(from_sq, to, occupied):
+                    moves.append(base | to << 6 | EN_PASSANT)
+
+    def check_legality_en_passant(self, from_sq: int, to_sq: int, occupied: int) -> bool:
+        """
+        En passant removes two pieces from the same rank, so pin and check masks are not enough: recompute the
+        attacks on the king with the occupancy after the capture.
+        """
+        captured_sq = to_sq - 8 * self.color_to_move.value
+        occupied_after = occupied ^ (1 << from_sq) ^ (1 << captured_sq) | (1 << to_sq)
+        king_square = self.my_bitboards.king_bitboard.lsb()
+        attackers = self.attackers(king_square, occupied_after, self.color_to_move.flip())
+        return attackers & ~(1 << captured_sq) == 0
+
+    def generate_castling_legal(self, king_square: int, occupied: int) -> List[int]:
+        """
+        Generate castling moves that are legal. Assumes the king is not in check.
+        """
+        moves = []
+        them = self.color_to_move.flip()
+        if self.color_to_move == COLOR.WHITE:
+            rights = ((CastlingRights.WHITE_KING_SIDE, 7, 6), (CastlingRights.WHITE_QUEEN_SIDE, 0, 2))
+        else:
+            rights = ((CastlingRights.BLACK_KING_SIDE, 63, 62), (CastlingRights.BLACK_QUEEN_SIDE, 56, 58))
+
+        for right, rook_square, king_to in rights:
+            if not self.castling_rights & right or self.mailbox[rook_square] != (PieceType.ROOK, self.color_to_move):
+                continue
+            if between[king_square][rook_square] & occupied:
+                continue
+            step = 1 if king_to > king_square else -1
+            if any(self.attackers(s, occupied, them) for s in (king_square + step, king_to)):
+                continue
+            moves.append(king_square | king_to << 6 | piece_codes[PieceType.KING] << 12 | CASTLING)
+        return moves
+
+    def pawn_bitboards(self) -> Tuple[int, int]:
+        """
+        :return: bitboards of the white pawns and of the black pawns.
+        """
+        return self.white_bitboards.pawn_bitboard.val, self.black_bitboards.pawn_bitboard.val
@@ -57,6 +57,15 @@ class PieceType(Enum):
                 return "k"
 
 
+# one byte encoding of (piece, color) used by the mailbox board: PieceType.value + 1 in the low three bits, the same
+# piece codes as packed moves, plus one bit for the color. 0 is an empty square.
+color_bits = {COLOR.WHITE: 8, COLOR.BLACK: 16}
+piece_bytes = {(piece, color): piece.value + 1 | color_bits[color] for piece in PieceType for color in COLOR}
+byte_pieces = [(None, None)] * 32
+for (_piece, _color), _byte in piece_bytes.items():
+    byte_pieces[_byte] = (_piece, _color)
+
+
 @dataclasses.dataclass(frozen=True)
 class Square:  # todo: be very careful of potential bugs due to copies by reference instead of by value
     file: int
@@ -69,6 +78,13 @@ class Square:  # todo: be very careful of potential bugs due to copies by refere
     def to_string_algebraic(self):
         return chr(self.file + ord("a")) + str(self.rank + 1)
 
+    @property
+    def index(self) -> int:
+        """
+        Integer form of the square, rank * 8 + file, used by the boards and by packed moves.
+        """
+        return self.rank * 8 + self.file
+
     def __add__(self, other: Tuple[int, int]):
         return Square(
             self.file + other[0],
@@ -2,78 +2,144 @@ import copy
 import time
 
 from board import Board
-from move import Move
+from eval_cache import EvalCache, EVAL_CACHE_BITS
+import board_bitboard
+from move import uci_string, EN_PASSANT
+from move_picker import staged_moves, is_tactical, is_losing_capture, mvv_lva, code_values
 from constants import COLOR, PieceType, values
+from tablebase import Tablebase, WIN, LOSS
+from transposition_table import TranspositionTable, BOUND_EXACT, BOUND_LOWER, BOUND_UPPER
+from timer import Timer
 from typing import List, Optional
 
 MATING_SCORE = 250000
-
-
-def score_move(move: Move):
-    if move.piece_captured is not None:
-        return values[move.piece_captured]
-    elif move.promotion == PieceType.QUEEN:
-        return values[PieceType.QUEEN] + 100
+MAX_PLY = 128
+# quiescence search: a capture is skipped when even winning the captured piece and this much more would not raise
+# alpha
+DELTA_MARGIN = 200
+CHECK_NODES = 1024  # the time and node limits are checked once every CHECK_NODES nodes
+# Lazy SMP: the helper i > 0 skips the iterations where (depth + skip_phase[(i - 1) % 20]) // skip_size[...] is odd,
+# so that the workers spread over the depths rather than all search the same one
+skip_size = [1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4]
+skip_phase = [0, 1, 0, 1, 2, 3, 0, 1, 2, 3, 4, 5, 0, 1, 2, 3, 4, 5, 6, 7]
+
+# board implementations the engine can search on. They expose the same public API.
+backends = {
+    "mailbox": Board,
+    "bitboard": board_bitboard.Board,
+}
+
+
+def score_move(board, move: int):
+    """
+    Captures and promotions by static exchange evaluation, so that losing captures come after the quiet moves.
+    """
+    if is_tactical(move):
+        return board.see(move)
     else:
         return 0
 
 
-# TODO: handle threads.
+def tablebase_score(result: int, distance: int) -> int:
+    """
+    Score of a tablebase result, on the scale of the mate scores of the search, which lose a point per move of the
+    winner: a win in 1 ply is worth MATING_SCORE - 1, a loss in 2 plies -(MATING_SCORE - 1), and so on.
+    :param result: WIN, DRAW or LOSS, for the side to move.
+    :param distance: distance to mate in plies.
+    """
+    if result == WIN:
+        return MATING_SCORE - (distance + 1) // 2
+    if result == LOSS:
+        return -(MATING_SCORE - distance // 2)
+    return 0
+
+
+def uci_score(score: float) -> str:
+    """
+    Score as in the UCI info command: "mate N" for a mate in N moves, negative if the engine is the one mated, "cp N"
+    otherwise, in whole centipawns.
+    """
+    if score > MATING_SCORE - 100:
+        return f"mate {MATING_SCORE - int(score)}"
+    if score < -(MATING_SCORE - 100):
+        return f"mate {-(MATING_SCORE + int(score))}"
+    return f"cp {round(score)}"
+
+
 # Note: with alpha-beta pruning enabled, the search is not exhaustive. We must be carefult when we
 # integrate a lookup table, since computed scores may only be upper or lower bounds to the actual score.
 class Engine:
-    def __init__(self, board: Board):
+    def __init__(self, board: Board, eval_cache_bits: int = EVAL_CACHE_BITS, tablebase: Optional[Tablebase] = None,
+                 transposition_table: Optional[TranspositionTable] = None):
         self.board = board
+        self.eval_cache = EvalCache(eval_cache_bits)
+        self.tablebase = tablebase  # probed below the root once few enough pieces are left
         self.current_best_move = None
-        self.trasposition_table = {}  # hash: str -> (depth: int, score: float, move: Optional[Move])
+        # may be shared with later searches, e.g. over a whole game
+        self.trasposition_table = transposition_table if transposition_table is not None else TranspositionTable()
         self.node_count = 0
+        self.root_ply = board.ply
+        self.killers = [[None, None] for _ in range(MAX_PLY)]  # two quiet moves per ply that caused a beta cutoff
+        self.timer: Optional[Timer] = None
+        # set when a limit is reached or by stop_search, possibly from another thread: the search unwinds
+        self.stopped = False
+        self.root_best = None  # (score, move) of the best root move searched to the full depth of the iteration
+        self.completed_depth = 0  # of the last completed iteration
+        self.stop_event = None  # of a Lazy SMP helper, set by the main worker once it is done
 
         self.query_hits = 0
 
-    def reorder_moves(self, moves: List[Move]) -> List[Move]:
+    def evaluate(self) -> float:
+        """
+        Static evaluation of the current position, from white's point of view, looked up in the evaluation cache
+        first.
+        """
+        key = self.board.zobrist.hash
+        score = self.eval_cache.probe(key)
+        if score is None:
+            score = self.board.static_evaluation()
+            self.eval_cache.store(key, score)
+        return score
+
+    def reorder_moves(self, moves: List[int]) -> List[int]:
         """
         Use static heuristics and/or results of previous computations to order moves
         based on how promising they are. Important for pruning.
         :param moves: list of legal moves to reorder
         :return: reordered list of moves
         """
-        moves.sort(key=score_move, reverse=True)
+        moves.sort(key=lambda move: score_move(self.board, move), reverse=True)
         return moves
 
-    def update_transposition_table(self, depth: int, score: float, move: Move, is_exact: bool = True):
+    def update_transposition_table(self, depth: int, score: float, move: int, bound: int = BOUND_EXACT):
         """
         Update transposition table with the result of a computation.
         :param depth: depth of the computation
         :param score: score of the position
-        :param move: best move
+        :param move: best move, packed
+        :param bound: BOUND_EXACT, or BOUND_LOWER and BOUND_UPPER if the search failed high or low
         """
-        hash = self.board.zobrist.get_hash()
-        if hash in self.trasposition_table:
-            old_depth, old_score, old_move, old_is_exact = self.trasposition_table[hash]
-            if old_depth >= depth:
-                return
-        self.trasposition_table[hash] = (depth, score, move, is_exact)
+        self.trasposition_table.store(self.board.zobrist.get_hash(), depth, score, move, bound)
 
     def query_trasposition_table(self):
         """
         Check if the current position is already in the transposition table.
-        :return: depth, score, move if the position is in the table, 3 times None otherwise
+        :return: depth, score, move, bound if the position is in the table, 4 times None otherwise
         """
-        hash = self.board.zobrist.get_hash()
-        if hash in self.trasposition_table:
+        entry = self.trasposition_table.probe(self.board.zobrist.get_hash())
+        if entry is not None:
             self.query_hits += 1
-            return self.trasposition_table[hash]
+            return entry
 
         return None, None, None, None
 
     def vanilla_minimax(self, depth: int, color: COLOR):
         self.node_count += 1
         if depth == 0:
-            return self.board.static_evaluation(), None
+            return self.evaluate(), None
         legal_moves = self.board.generate_moves()
         if len(legal_moves) == 0:
-            king_square = self.board.piece_to_squares[(PieceType.KING, self.board.color_to_move)][0]
-            if self.board.is_attacked(king_square):
+            if self.board.is_check():
                 return - color.value * MATING_SCORE, None
             else:
                 return 0.0, None
@@ -94,15 +160,15 @@ class Engine:
 
     def vanilla_negamax(self, depth, color):
         self.node_count += 1
-        old_depth, old_score, old_move, is_exact = self.query_trasposition_table()
-        if is_exact == True and old_depth >= depth:
+        old_depth, old_score, old_move, bound = self.query_trasposition_table()
+        if bound == BOUND_EXACT and old_depth >= depth:
             return old_score, old_move
 
         if depth == 0:
-            return self.board.static_evaluation() * color.value, None
+            return self.evaluate() * color.value, None
         legal_moves = self.board.generate_moves()
         if len(legal_moves) == 0:
-            if self.board.is_attacked(self.board.piece_to_squares[(PieceType.KING, self.board.color_to_move)][0]):
+            if self.board.is_check():
                 return -MATING_SCORE, None
             else:
                 return 0, None
@@ -120,11 +186,10 @@ class Engine:
 
     def minimax(self, depth: int, alpha: float, beta: float, color: COLOR):
         if depth == 0:
-            return self.board.static_evaluation(), None
+            return self.evaluate(), None
         legal_moves = self.board.generate_moves()
         if len(legal_moves) == 0:
-            king_square = self.board.piece_to_squares[(PieceType.KING, self.board.color_to_move)][0]
-            if self.board.is_attacked(king_square):
+            if self.board.is_check():
                 return - color.value * MATING_SCORE, None
             else:
                 return 0.0, None
@@ -154,78 +219,228 @@ class Engine:
                 beta = min(beta, score)
         return best_score, best_move  # best_score is an upper bound to the actual best score if color.is_max(), and a lower bound otherwise
 
-    def negamax(self, depth, alpha, beta, color) -> (int, Optional[Move]):
+    def check_limits(self):
+        """
+        Stop the search if it is past the hard time limit or the node limit. The first iteration always completes,
+        so that there is a move to play.
+        """
+        if self.stop_event is not None and self.stop_event.is_set():
+            self.stopped = True
+        timer = self.timer
+        if timer is not None and self.current_best_move is not None:
+            if timer.out_of_time() or timer.nodes is not None and self.node_count >= timer.nodes:
+                self.stopped = True
+
+    def negamax(self, depth, alpha, beta, color) -> (int, Optional[int]):
         self.node_count += 1
+        if self.node_count % CHECK_NODES == 0:
+            self.check_limits()
+        if self.stopped:
+            return 0, None
 
-        if self.board.is_3fold():
-            return 0
+        if self.board.ply > self.root_ply and self.board.is_repetition(self.root_ply):
+            return 0, None
+
+        # endgames in the tablebase are solved: their score is exact at any depth
+        if self.tablebase is not None and self.board.ply > self.root_ply and \
+                self.board.n_pieces <= self.tablebase.max_pieces:
+            result = self.tablebase.probe(self.board)
+            if result is not None:
+                return tablebase_score(*result), None
 
         # access transposition table and check if we can return early
-        old_depth, old_score, old_move, old_is_exact = self.query_trasposition_table()
+        old_depth, old_score, old_move, old_bound = self.query_trasposition_table()
         if old_depth is not None and old_depth >= depth:
-            if old_is_exact == True or old_score >= beta:
+            if old_bound == BOUND_EXACT or old_bound == BOUND_LOWER and old_score >= beta or \
+                    old_bound == BOUND_UPPER and old_score <= alpha:
                 return old_score, old_move
 
-        # check if exploration is over and return static evaluation
+        # check if exploration is over and resolve the captures left on the board
         if depth == 0:
-            return self.board.static_evaluation() * color.value, None
-
-        # generate legal moves and check if mate/stalemate has been reached
-        legal_moves = self.board.generate_moves()
-        if len(legal_moves) == 0:
-            if self.board.is_attacked(self.board.piece_to_squares[(PieceType.KING, self.board.color_to_move)][0]):
-                return -MATING_SCORE, None
-            else:
-                return 0, None
-
-        # explore the tree one level deeper
-        legal_moves = self.reorder_moves(legal_moves)
-        best_score, best_move, is_exact = -MATING_SCORE, legal_moves[0], True
-        for move in legal_moves:
+            return self.quiescence(alpha, beta, color), None
+
+        # explore the tree one level deeper. Moves are generated lazily, best candidates first
+        ply = self.board.ply - self.root_ply
+        killers = self.killers[ply] if ply < MAX_PLY else []
+        best_score, best_move, bound = -MATING_SCORE, None, BOUND_EXACT
+        original_alpha = alpha
+        for move in staged_moves(self.board, old_move, killers):
+            if best_move is None:
+                best_move = move
             self.board.make_move(move)
             score = -self.negamax(depth - 1, -beta, -alpha, color.flip())[0]
             self.board.unmake_move()
+            if self.stopped:
+                return 0, None
             if score > best_score:
                 if score > MATING_SCORE - 100:
                     best_score, best_move = score - 1, move
                 else:
                     best_score, best_move = score, move
+                if ply == 0:
+                    self.root_best = (best_score, best_move)
 
             alpha = max(alpha, score)
             if alpha >= beta:
-                is_exact = False
+                bound = BOUND_LOWER
+                if not is_tactical(move) and ply < MAX_PLY:
+                    self.store_killer(ply, move)
                 break
 
-        # update transposition table and return. in general, best_score is a lower bound to the actual best score
-        self.update_transposition_table(depth, best_score, best_move, is_exact)
+        # no legal moves: mate or stalemate
+        if best_move is None:
+            if self.board.is_check():
+                return -MATING_SCORE, None
+            else:
+                return 0, None
+
+        # update transposition table and return. after a cutoff best_score is a lower bound to the actual best score,
+        # and if no move raised alpha, an upper bound
+        if bound == BOUND_EXACT and best_score <= original_alpha:
+            bound = BOUND_UPPER
+        self.update_transposition_table(depth, best_score, best_move, bound)
         return best_score, best_move
 
+    def quiescence(self, alpha: float, beta: float, color: COLOR) -> float:
+        """
+        Search of the captures and promotions only, run at the horizon so that the static evaluation is never taken in
+        the middle of an exchange. The side to move can stand pat, i.e. keep the static evaluation, instead of
+        capturing, except when in check, where every evasion is searched.
+        Captures that lose material by static exchange evaluation are skipped, and so are the ones that cannot raise
+        alpha even winning the captured piece plus DELTA_MARGIN (delta pruning).
+        :return: score from the point of view of the side to move, fail-soft.
+        """
+        self.node_count += 1
+        if self.node_count % CHECK_NODES == 0:
+            self.check_limits()
+        if self.stopped:
+            return 0
+        in_check = self.board.is_check()
+        if self.board.ply - self.root_ply >= MAX_PLY:
+            return self.evaluate() * color.value
+
+        if in_check:
+            moves = self.reorder_moves(self.board.generate_moves())
+            if not moves:
+                return -MATING_SCORE
+            best_score = -MATING_SCORE
+        else:
+            best_score = stand_pat = self.evaluate() * color.value
+            if stand_pat >= beta:
+                return stand_pat
+            # not even winning a queen would raise alpha
+            if stand_pat + values[PieceType.QUEEN] + DELTA_MARGIN < alpha:
+                return stand_pat
+            alpha = max(alpha, stand_pat)
+            moves = self.board.generate_moves(quiet=False)
+            moves.sort(key=mvv_lva, reverse=True)
+
+        for move in moves:
+            if not in_check:
+                gain = code_values[(move >> 15) & 7] or (values[PieceType.PAWN] if move & EN_PASSANT else 0)
+                promotion = (move >> 18) & 7
+                if promotion:
+                    gain += code_values[promotion] - values[PieceType.PAWN]
+                if stand_pat + gain + DELTA_MARGIN <= alpha or is_losing_capture(self.board, move):
+                    continue
+            self.board.make_move(move)
+            score = -self.quiescence(-beta, -alpha, color.flip())
+            self.board.unmake_move()
+            if self.stopped:
+                return 0
+            if score > MATING_SCORE - 100:
+                score -= 1
+            if score > best_score:
+                best_score = score
+                if score >= beta:
+                    break
+                alpha = max(alpha, score)
+        return best_score
+
+    def store_killer(self, ply: int, move: int):
+        killers = self.killers[ply]
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+
     def stop_search(self):
         """
-        Stop the search and return the best move found so far.
+        Stop the search, which may be running on another thread, and return the best move found so far. The search
+        polls the flag at every node and returns shortly after.
         :return: best move
         """
-        # Note: this way we discard information from the current unfinished search.
-        # TODO: use it somehow.
-        return self.current_best_move
+        self.stopped = True
+        return self.root_best[1] if self.root_best is not None else self.current_best_move
+
+    def ponderhit(self):
+        """
+        The opponent played the move the engine was pondering on: the search goes on, from now on within the time
+        allocated to the move.
+        """
+        if self.timer is not None and self.timer.ponder:
+            self.timer.ponder = False
+            self.timer.start(self.root_color)
 
-    def search(self, max_depth: int):
+    def search(self, max_depth: int, timer: Optional[Timer] = None, worker: int = 0):
         """
-        Search the best move for the current position.
+        Search the best move for the current position, by iterative deepening. With a timer, no iteration is
+        started if it is predicted to end past the soft time limit, from the time taken by the previous ones, and an
+        iteration running past the hard limit, or past the node limit, is abandoned.
         :param max_depth: maximum depth to search
-        :return: best move
+        :param timer: limits of the search, started here
+        :param worker: index of the worker in a Lazy SMP search. The helpers, > 0, join the search of the main
+        worker in the transposition table, skip some of the iterations and print nothing
+        :return: score and best move, packed, of the last completed iteration
         """
         self.node_count = 0
+        self.root_ply = self.board.ply
+        self.killers = [[None, None] for _ in range(MAX_PLY)]
+        if worker == 0:
+            self.trasposition_table.new_search()
+        self.current_best_move = None
+        self.completed_depth = 0
+        self.root_color = self.board.color_to_move
+        self.timer, self.stopped = timer, False
+        if timer is not None:
+            timer.start(self.root_color)
+        score, durations = None, []
+        start = time.perf_counter()
         for depth in range(1, max_depth + 1):
-            score, best_move = self.negamax(depth, -MATING_SCORE, MATING_SCORE, self.board.color_to_move)
-            self.current_best_move = best_move
-            print(f"info depth {depth} score cp {score} pv {best_move.to_string()} nodes {self.node_count}")
+            if worker > 0 and (depth + skip_phase[(worker - 1) % 20]) // skip_size[(worker - 1) % 20] % 2:
+                continue
+            iteration_start = time.perf_counter()
+            self.root_best = None
+            result = self.negamax(depth, -MATING_SCORE, MATING_SCORE, self.root_color)
+            if self.stopped:
+                # the root moves are searched best first: a root move searched to the full depth is at least as
+                # good as the choice of the previous iteration
+                if self.root_best is not None:
+                    score, self.current_best_move = self.root_best
+                break
+            score, self.current_best_move = result
+            self.completed_depth = depth
+            durations.append(time.perf_counter() - iteration_start)
+            if worker > 0:
+                continue
+            elapsed = time.perf_counter() - start
+            # no pv without legal moves, in a mated or stalemated root
+            pv = f" pv {uci_string(self.current_best_move)}" if self.current_best_move is not None else ""
+            print(f"info depth {depth} score {uci_score(score)}{pv} nodes {self.node_count} "
+                  f"time {int(elapsed * 1000)} hashfull {self.trasposition_table.hashfull()}",
+                  flush=True)
+            if timer is not None and depth < max_depth:
+                # each iteration takes a few times longer than the previous one
+                growth = min(max(durations[-1] / durations[-2], 1.5), 8) if len(durations) > 1 and durations[-2] else 4
+                if not timer.has_time_for(durations[-1] * growth):
+                    break
 
+        if self.current_best_move is None:
+            # stopped before any root move was searched: any legal move is better than none. Still None if there are
+            # no legal moves
+            self.current_best_move = next(staged_moves(self.board), None)
         return score, self.current_best_move
 
 
-from test_mov_gen import data
-
 if __name__ == '__main__':
     # board = Board.from_fen("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
     # eng = Engine(board)
@@ -239,12 +454,13 @@ if __name__ == '__main__':
     # eng.vanilla_minimax(depth, COLOR.WHITE)
     # print(eng.node_count)
 
-    board = Board.from_fen(data.various_fen[1])
+    board = backends["bitboard"].from_fen("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1")
     eng = Engine(board)
     # res = eng.vanilla_negamax(depth, COLOR.WHITE)
 
     res = eng.search(6)
     print(eng.node_count)
     print(eng.query_hits)
+    print(f"eval cache: {eng.eval_cache.hits}/{eng.eval_cache.probes} hits")
 
     print(res)
@@ -0,0 +1,43 @@
+from typing import Optional
+
+EVAL_CACHE_BITS = 16
+
+
+class EvalCache:
+    """
+    Fixed-size cache of static evaluations, indexed by the low bits of the zobrist hash. The two arrays are
+    preallocated; each slot keeps the full hash, to tell a hit from a collision, and a new entry always replaces the
+    old one. Iterative deepening evaluates the same leaves at every iteration, and they are found here.
+    """
+
+    def __init__(self, size_bits: int = EVAL_CACHE_BITS):
+        self.mask = (1 << size_bits) - 1
+        self.keys = [-1] * (self.mask + 1)  # hashes are never negative, so -1 marks an empty slot
+        self.scores = [0.0] * (self.mask + 1)
+        self.probes = 0
+        self.hits = 0
+
+    def probe(self, key: int) -> Optional[float]:
+        """
+        :return: cached evaluation of the position with this hash, None on a miss.
+        """
+        self.probes += 1
+        i = key & self.mask
+        if self.keys[i] == key:
+            self.hits += 1
+            return self.scores[i]
+        return None
+
+    def store(self, key: int, score: float):
+        i = key & self.mask
+        self.keys[i] = key
+        self.scores[i] = score
+
+    def hit_rate(self) -> float:
+        return self.hits / self.probes if self.probes else 0.0
+
+    def clear(self):
+        self.keys = [-1] * (self.mask + 1)
+        self.scores = [0.0] * (self.mask + 1)
+        self.probes = 0
+        self.hits = 0
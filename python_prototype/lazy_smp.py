@@ -0,0 +1,136 @@
+"""
+Lazy SMP: several processes search the same root at once, and share what they find through one transposition table in
+shared memory.
+
+The main worker searches in the calling process, with the limits of the search, and reports; the helpers run in a
+pool of processes started once, skip some of the iterations (see engine.skip_size) so that they search ahead of the
+main worker, and fill the shared table with results it then finds ready. Once the main worker is done, the helpers
+are stopped, and the best move is the one of the deepest iteration completed by any worker.
+"""
+import argparse
+import multiprocessing
+import pickle
+import time
+from typing import Dict, Optional
+
+from engine import Engine, backends, uci_score
+from move import uci_string
+from tablebase import Tablebase
+from timer import Timer
+from transposition_table import TranspositionTable, AGE_MASK, DEFAULT_HASH_MB
+
+
+def helper_loop(worker: int, table_name: str, size_mb: int, jobs, results, stop):
+    """
+    Body of a helper process: search the positions of the jobs queue until told to stop, and send back the result.
+    :param worker: index of the helper, from 1
+    :param table_name: name of the shared memory of the transposition table
+    :param size_mb: size of the transposition table
+    :param jobs: queue of (pickled board, max depth, age of the search, tablebase directory or None), None to exit
+    :param results: queue of (worker, completed depth, score, move, nodes)
+    :param stop: event set by the main worker once it is done
+    """
+    transposition_table = TranspositionTable(size_mb, name=table_name)
+    tablebases: Dict[str, Tablebase] = {}
+    while (job := jobs.get()) is not None:
+        board, max_depth, age, tablebase_directory = job
+        board = pickle.loads(board)
+        if tablebase_directory is not None and tablebase_directory not in tablebases:
+            tablebases[tablebase_directory] = Tablebase(tablebase_directory)
+        transposition_table.age = age
+        engine = Engine(board, tablebase=tablebases.get(tablebase_directory), transposition_table=transposition_table)
+        engine.stop_event = stop
+        score, move = engine.search(max_depth, worker=worker)
+        results.put((worker, engine.completed_depth, score, move, engine.node_count))
+    transposition_table.close()
+
+
+class LazySMP:
+    """
+    Pool of helper processes, sharing a transposition table with the main worker.
+    """
+
+    def __init__(self, workers: int, transposition_table: TranspositionTable):
+        """
+        :param workers: number of workers, the main one included
+        :param transposition_table: table of the main worker, allocated in shared memory
+        """
+        if transposition_table.shared_memory is None:
+            raise ValueError("Lazy SMP needs a transposition table in shared memory")
+        self.transposition_table = transposition_table
+        # spawn rather than fork: the main worker runs on a thread of the director
+        context = multiprocessing.get_context("spawn")
+        self.stop = context.Event()
+        self.results = context.Queue()
+        self.jobs = [context.Queue() for _ in range(workers - 1)]
+        self.helpers = [
+            context.Process(target=helper_loop, args=(i + 1, transposition_table.shared_memory.name,
+                                                      transposition_table.size_mb, jobs, self.results, self.stop),
+                            daemon=True)
+            for i, jobs in enumerate(self.jobs)
+        ]
+        for helper in self.helpers:
+            helper.start()
+
+    def search(self, engine: Engine, max_depth: int, timer: Optional[Timer] = None):
+        """
+        Search with all the workers, the main one being engine, which has to use the shared transposition table.
+        :param engine: main worker
+        :param max_depth: maximum depth to search
+        :param timer: limits of the search, applied by the main worker
+        :return: score and best move, packed, of the deepest completed iteration
+        """
+        self.stop.clear()
+        age = (self.transposition_table.age + 1) & AGE_MASK  # the one the main worker is about to start
+        tablebase_directory = engine.tablebase.directory if engine.tablebase is not None else None
+        # the queues pickle on a thread of their own, by when the main worker is already moving on the board: send a
+        # snapshot of the root instead
+        root = pickle.dumps(engine.board)
+        for jobs in self.jobs:
+            jobs.put((root, max_depth, age, tablebase_directory))
+        try:
+            score, move = engine.search(max_depth, timer)
+        finally:
+            self.stop.set()
+            depth, nodes = engine.completed_depth, engine.node_count
+            for _ in self.helpers:
+                _, helper_depth, helper_score, helper_move, helper_nodes = self.results.get()
+                nodes += helper_nodes
+                if helper_depth > depth and helper_move is not None and engine.board.is_legal(helper_move):
+                    depth, score, move = helper_depth, helper_score, helper_move
+        engine.current_best_move = move
+        pv = f" pv {uci_string(move)}" if move is not None else ""
+        print(f"info depth {depth} score {uci_score(score)}{pv} nodes {nodes}", flush=True)
+        return score, move
+
+    def close(self):
+        """
+        Stop the helper processes. The transposition table is left to its owner.
+        """
+        for jobs in self.jobs:
+            jobs.put(None)
+        for helper in self.helpers:
+            helper.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="time to reach each depth with several numbers of workers")
+    parser.add_argument("--fen", type=str,
+                        default="r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1")
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--hash", type=int, default=DEFAULT_HASH_MB, help="transposition table size in MB")
+    parser.add_argument("--backend", type=str, default="mailbox", choices=list(backends))
+    args = parser.parse_args()
+
+    for workers in args.workers:
+        transposition_table = TranspositionTable(args.hash, shared=True)
+        pool = LazySMP(workers, transposition_table)
+        engine = Engine(backends[args.backend].from_fen(args.fen), transposition_table=transposition_table)
+        pool.search(engine, 1)  # once the helpers are up
+        transposition_table.clear()
+        start = time.perf_counter()
+        pool.search(engine, args.depth)
+        print(f"workers {workers} depth {args.depth} time {time.perf_counter() - start:.2f}s")
+        pool.close()
+        transposition_table.close()
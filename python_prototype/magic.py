@@ -0,0 +1,145 @@
+"""
+Magic bitboards for sliding pieces, as in src/magic.rs.
+
+For every square we keep the mask of the relevant occupancy bits (the rays without the board edges), a magic number
+and a table of attacks. Multiplying the masked occupancy by the magic and keeping the top bits gives a perfect hash of
+the blockers configuration, so rook and bishop attacks are a single table lookup.
+
+Finding the magics is a random search that takes a while in python, so the result is cached in CACHE_PATH and
+loaded at import time. Delete the file to force the search to run again.
+"""
+import os
+import pickle
+import random
+from typing import List, Tuple
+
+from attack_bitboard import sliding_attacks, straight_pattern, diagonal_pattern
+
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "magic_tables.pkl")
+CACHE_VERSION = 1
+FULL = (1 << 64) - 1
+
+
+def relevant_mask(square: int, patterns) -> int:
+    """
+    Squares whose occupancy matters for a slider on square: its rays, excluding the last square of each ray.
+    """
+    res = 0
+    for pattern in patterns:
+        file_a = square % 8 + pattern[0]
+        rank_a = square // 8 + pattern[1]
+        while 0 <= file_a + pattern[0] <= 7 and 0 <= rank_a + pattern[1] <= 7:
+            res |= 1 << (file_a + rank_a * 8)
+            file_a += pattern[0]
+            rank_a += pattern[1]
+    return res
+
+
+def subsets(mask: int):
+    """
+    Enumerate all the subsets of the bits of mask (Carry-Rippler trick).
+    """
+    subset = 0
+    while True:
+        yield subset
+        subset = (subset - mask) & mask
+        if subset == 0:
+            return
+
+
+def find_magic(square: int, patterns, rng: random.Random) -> Tuple[int, int, int, List[int]]:
+    """
+    Search a magic number for a slider on square.
+    :return: mask, magic, shift and attack table.
+    """
+    mask = relevant_mask(square, patterns)
+    bits = mask.bit_count()
+    shift = 64 - bits
+    occupancies = list(subsets(mask))
+    attacks = [sliding_attacks(square, occupancy, patterns) for occupancy in occupancies]
+
+    while True:
+        # sparse candidates work best
+        magic = rng.getrandbits(64) & rng.getrandbits(64) & rng.getrandbits(64)
+        if (((mask * magic) & FULL) >> 56).bit_count() < 6:
+            continue
+
+        table = [-1] * (1 << bits)
+        for occupancy, attack in zip(occupancies, attacks):
+            idx = ((occupancy * magic) & FULL) >> shift
+            if table[idx] == -1:
+                table[idx] = attack
+            elif table[idx] != attack:
+                break
+        else:
+            return mask, magic, shift, [0 if attack == -1 else attack for attack in table]
+
+
+def generate_tables(seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    tables = {"version": CACHE_VERSION}
+    for name, patterns in (("rook", straight_pattern), ("bishop", diagonal_pattern)):
+        masks, magics, shifts, attacks = [], [], [], []
+        for square in range(64):
+            mask, magic, shift, table = find_magic(square, patterns, rng)
+            masks.append(mask)
+            magics.append(magic)
+            shifts.append(shift)
+            attacks.append(table)
+        tables[name] = (masks, magics, shifts, attacks)
+    return tables
+
+
+def load_tables(path: str = CACHE_PATH) -> dict:
+    """
+    Load the magic tables from path, generating and saving them if the cache is missing or stale.
+    """
+    try:
+        with open(path, "rb") as f:
+            tables = pickle.load(f)
+        if tables.get("version") == CACHE_VERSION:
+            return tables
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+
+    tables = generate_tables()
+    try:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass  # read-only location: we will just search again next time
+    return tables
+
+
+_tables = load_tables()
+rook_masks, rook_magics, rook_shifts, rook_table = _tables["rook"]
+bishop_masks, bishop_magics, bishop_shifts, bishop_table = _tables["bishop"]
+
+
+def magic_rook(square: int, occupancy: int) -> int:
+    """
+    Squares attacked by a rook on square, given the occupied squares. Blockers are included.
+    """
+    return rook_table[square][(((occupancy & rook_masks[square]) * rook_magics[square]) & FULL) >> rook_shifts[square]]
+
+
+def magic_bishop(square: int, occupancy: int) -> int:
+    """
+    Squares attacked by a bishop on square, given the occupied squares. Blockers are included.
+    """
+    return bishop_table[square][
+        (((occupancy & bishop_masks[square]) * bishop_magics[square]) & FULL) >> bishop_shifts[square]]
+
+
+def magic_queen(square: int, occupancy: int) -> int:
+    return magic_rook(square, occupancy) | magic_bishop(square, occupancy)
+
+
+if __name__ == '__main__':
+    # regenerate the cache
+    if os.path.exists(CACHE_PATH):
+        os.remove(CACHE_PATH)
+    load_tables()
+    print("magic tables written to " + CACHE_PATH)
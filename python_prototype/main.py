@@ -2,12 +2,14 @@ import helpers
 from orchestradirector import OrchestraDirector
 
 
-while True:
-    message = input()
+if __name__ == '__main__':
+    # the guard keeps the helper processes of a Lazy SMP search, which import this module, out of the loop
+    while True:
+        message = input()
 
-    command = message.split()[0]
-    options = message[message.find(" ") + 1:]
+        command = message.split()[0]
+        options = message[message.find(" ") + 1:]
 
-    helpers.log_to_file(message)
+        helpers.log_to_file(message)
 
-    OrchestraDirector.handle_command(command, options)
+        OrchestraDirector.handle_command(command, options)
@@ -3,6 +3,63 @@ from typing import Optional
 
 from constants import Square, PieceType
 
+# In the search, moves are plain ints with the following bit layout:
+#   0-5    starting square, as file + 8 * rank
+#   6-11   landing square
+#   12-14  piece moved, as PieceType.value + 1
+#   15-17  piece captured, 0 if none or en passant
+#   18-20  promotion, 0 if none
+#   21     en passant flag
+#   22     castling flag
+#   23     double pawn push flag
+# Move below is only a readable view of this format, used at the boundary with the UCI protocol.
+EN_PASSANT = 1 << 21
+CASTLING = 1 << 22
+DOUBLE_PUSH = 1 << 23
+CAPTURE_MASK = 7 << 15
+PROMOTION_MASK = 7 << 18
+TACTICAL_MASK = CAPTURE_MASK | PROMOTION_MASK | EN_PASSANT
+
+piece_codes = {None: 0, **{piece: piece.value + 1 for piece in PieceType}}
+code_pieces = [None] + list(PieceType)
+
+square_names = [chr(ord("a") + i % 8) + str(i // 8 + 1) for i in range(64)]
+from_to_names = [square_names[i & 63] + square_names[i >> 6] for i in range(4096)]
+promotion_suffixes = [""] + [piece.to_char() for piece in PieceType] + [""]
+
+
+def pack(from_square: int, to_square: int, piece_moved: PieceType, piece_captured: Optional[PieceType] = None,
+         promotion: Optional[PieceType] = None, flags: int = 0) -> int:
+    return from_square | to_square << 6 | piece_codes[piece_moved] << 12 | piece_codes[piece_captured] << 15 | \
+        piece_codes[promotion] << 18 | flags
+
+
+def move_from(move: int) -> int:
+    return move & 63
+
+
+def move_to(move: int) -> int:
+    return (move >> 6) & 63
+
+
+def move_piece(move: int) -> PieceType:
+    return code_pieces[(move >> 12) & 7]
+
+
+def move_captured(move: int) -> Optional[PieceType]:
+    return code_pieces[(move >> 15) & 7]
+
+
+def move_promotion(move: int) -> Optional[PieceType]:
+    return code_pieces[(move >> 18) & 7]
+
+
+def uci_string(move: int) -> str:
+    """
+    Algebraic notation of a packed move (e.g. "e2e4" or "e7e8q"), from precomputed tables.
+    """
+    return from_to_names[move & 4095] + promotion_suffixes[(move >> 18) & 7]
+
 
 @dataclass
 class Move:  # en passant is codified as a capture of a pawn on the square behind the pawn that moved
@@ -26,8 +83,8 @@ class Move:  # en passant is codified as a capture of a pawn on the square behin
         promotion = None if len(s) == 4 else PieceType.from_char(s[4])
 
         return cls(
-            piece_moved=board.bitboard[start.rank][start.file][0],
-            piece_captured=board.bitboard[end.rank][end.file][0],
+            piece_moved=board.piece_at(start.index)[0],
+            piece_captured=board.piece_at(end.index)[0],
             from_square=start,
             to_square=end,
             promotion=promotion,
@@ -44,5 +101,36 @@ class Move:  # en passant is codified as a capture of a pawn on the square behin
 
         return start + end + promotion
 
+    @classmethod
+    def from_packed(cls, move: int):
+        return cls(
+            piece_moved=move_piece(move),
+            piece_captured=move_captured(move),
+            from_square=Square(move & 7, (move >> 3) & 7),
+            to_square=Square((move >> 6) & 7, (move >> 9) & 7),
+            promotion=move_promotion(move),
+        )
+
+    def to_packed(self) -> int:
+        """
+        Packed form of the move. The flags are inferred from the pieces and squares involved.
+        """
+        flags = 0
+        if self.piece_moved == PieceType.PAWN:
+            if self.from_square.file != self.to_square.file and self.piece_captured is None:
+                flags = EN_PASSANT
+            elif abs(self.from_square.rank - self.to_square.rank) == 2:
+                flags = DOUBLE_PUSH
+        elif self.piece_moved == PieceType.KING and abs(self.from_square.file - self.to_square.file) > 1:
+            flags = CASTLING
+        return pack(
+            self.from_square.index,
+            self.to_square.index,
+            self.piece_moved,
+            self.piece_captured,
+            self.promotion,
+            flags,
+        )
+
     def __repr__(self):
         return str(self.piece_moved) + "  " + self.to_string()
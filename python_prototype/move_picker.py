@@ -0,0 +1,87 @@
+from typing import Iterator, List, Optional
+
+from constants import PieceType, values
+from move import TACTICAL_MASK, EN_PASSANT
+
+# values indexed by the piece codes of packed moves, 0 meaning no piece
+code_values = [0] + [values[piece] for piece in PieceType]
+king_code = PieceType.KING.value + 1
+
+
+def is_tactical(move: int) -> bool:
+    """
+    Captures, en passant included, and promotions.
+    """
+    return move & TACTICAL_MASK != 0
+
+
+def mvv_lva(move: int) -> int:
+    """
+    Most valuable victim, least valuable attacker: order captures by the value of the captured piece first, and by
+    the value of the capturing piece second.
+    """
+    score = 0
+    captured = (move >> 15) & 7
+    if captured:
+        score += 10 * code_values[captured] - code_values[(move >> 12) & 7] // 100
+    elif move & EN_PASSANT:
+        score += 10 * values[PieceType.PAWN] - 1
+    return score + code_values[(move >> 18) & 7]
+
+
+def is_losing_capture(board, move: int) -> bool:
+    """
+    Whether the capture loses material once the exchange on the target square is played out, by static exchange
+    evaluation. Capturing a piece at least as valuable as the capturing one never loses, and the king can only
+    capture undefended pieces, so SEE only runs for the other captures.
+    """
+    captured, moved = (move >> 15) & 7, (move >> 12) & 7
+    if (move >> 18) & 7 or not captured or moved == king_code or code_values[captured] >= code_values[moved]:
+        return False
+    return board.see(move) < 0
+
+
+def staged_moves(board, hash_move: Optional[int] = None, killers: List[Optional[int]] = ()) -> Iterator[int]:
+    """
+    Yield the legal moves of the position in order of how promising they are, generating each stage only when the
+    previous ones are exhausted. A beta cutoff on the hash move or on a capture thus never pays for the generation of
+    the quiet moves. Stages:
+        1. hash move, if legal
+        2. winning or equal captures and promotions, by MVV-LVA
+        3. killer moves, if legal
+        4. the other quiet moves
+        5. losing captures, least losing first
+    The board must be in the same position every time the generator is resumed.
+    :param board: board to generate moves for.
+    :param hash_move: best move stored in the transposition table for this position, if any.
+    :param killers: quiet moves that caused a beta cutoff at the same ply in sibling nodes.
+    """
+    if hash_move is not None and board.is_legal(hash_move):
+        yield hash_move
+    else:
+        hash_move = None
+
+    tactical = board.generate_moves(quiet=False)
+    tactical.sort(key=mvv_lva, reverse=True)
+    losing = []
+    for move in tactical:
+        if move == hash_move:
+            continue
+        if is_losing_capture(board, move):
+            losing.append(move)
+            continue
+        yield move
+
+    tried_killers = []
+    for killer in killers:
+        if killer is not None and killer != hash_move and killer not in tried_killers and \
+                not is_tactical(killer) and board.is_legal(killer):
+            tried_killers.append(killer)
+            yield killer
+
+    for move in board.generate_moves(tactical=False):
+        if move != hash_move and move not in tried_killers:
+            yield move
+
+    losing.sort(key=board.see, reverse=True)
+    yield from losing
@@ -0,0 +1,504 @@
+"""
+NumPy port of the network evaluation of the Rust engine (src/nnue), reading the same .nnue file.
+
+The feature transformer maps the pieces of a position, seen from each side with its own king, to two accumulators of
+HALF_DIMENSIONS int16 values and PSQT_BUCKETS int32 piece-square scores. It is stored LEB128-compressed in the file;
+it is decompressed once to .npy files next to it and memory-mapped from there afterwards. The layer stacks that
+follow are stored raw and are memory-mapped straight from the .nnue file.
+
+Accumulator keeps the two accumulators of a board up to date move by move, and Network.forward evaluates any number
+of accumulators at once. All the arithmetic is integer and follows the Rust code, so the scores are the same.
+"""
+import os
+from typing import Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+from constants import COLOR, PieceType
+from move import CASTLING, EN_PASSANT, code_pieces
+
+default_network_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "nnue_weights",
+                                    "nn-0000000000a0.nnue")
+
+# file format
+VERSION = 2062757664
+NETWORK_HASH = 470823026
+FEATURE_TRANSFORMER_HASH = 2133022904
+LAYER_STACK_HASH = 1664313546
+LEB128_MAGIC = b"COMPRESSED_LEB128"
+LEB128_CHUNK_SIZE = 1 << 22  # compressed bytes decoded at a time
+
+# architecture
+HALF_DIMENSIONS = 2560
+INPUT_DIMENSIONS = 64 * 11 * 32  # HalfKAv2_hm: 11 piece planes (the two kings share one) for each of 32 king squares
+PSQT_BUCKETS = 8
+LAYER_STACKS = 8
+FC_0_OUT_DIMS = 15
+FC_1_OUT_DIMS = 32
+OUTPUT_SCALE = 16
+WEIGHT_SCALE_BITS = 6
+ADJUSTMENT_DELTA = 24
+
+MAX_GAME_PLY = 1024
+
+
+def padded(dims: int) -> int:
+    return (dims + 7) // 8 * 8
+
+
+def _feature_index(perspective: COLOR, king_square: int, piece: PieceType, color: COLOR, square: int) -> int:
+    """
+    Input feature of a piece for one side, same as FeatureTransformer::make_index in the Rust engine. Black sees the
+    board flipped vertically, and the board is mirrored horizontally so that its king is on files e-h.
+    """
+    if perspective == COLOR.BLACK:
+        square ^= 56
+        king_square ^= 56
+    plane = 10 if piece == PieceType.KING else 2 * piece.value + (color != perspective)
+    king_file, king_rank = king_square % 8, king_square // 8
+    if king_file < 4:
+        king_file ^= 7
+        square ^= 7
+    king_bucket = 31 - (king_rank * 4 + king_file - 4)
+    return square + plane * 64 + king_bucket * 11 * 64
+
+
+# feature_table[perspective index][king square][(2 * piece + color index) * 64 + square]
+perspectives = (COLOR.WHITE, COLOR.BLACK)
+feature_table = [
+    [
+        [
+            _feature_index(perspective, king_square, piece, color, square)
+            for piece in PieceType for color in perspectives for square in range(64)
+        ]
+        for king_square in range(64)
+    ]
+    for perspective in perspectives
+]
+
+
+def side_index(color: COLOR) -> int:
+    return 0 if color == COLOR.WHITE else 1
+
+
+def active_features(pieces: Iterable[Tuple[PieceType, COLOR, int]], perspective: COLOR, king_square: int) -> List[int]:
+    """
+    :param pieces: (piece, color, square) of every piece on the board.
+    :param perspective: side the features are seen from.
+    :param king_square: square of the king of perspective.
+    :return: indices of the active input features.
+    """
+    table = feature_table[side_index(perspective)][king_square]
+    return [table[(2 * piece.value + side_index(color)) * 64 + square] for piece, color, square in pieces]
+
+
+def board_pieces(board) -> List[Tuple[PieceType, COLOR, int]]:
+    res = []
+    for square in range(64):
+        piece, color = board.piece_at(square)
+        if piece is not None:
+            res.append((piece, color, square))
+    return res
+
+
+def fen_pieces(fen: str) -> List[Tuple[PieceType, COLOR, int]]:
+    res = []
+    rank, file = 7, 0
+    for c in fen.split(maxsplit=1)[0]:
+        if c == "/":
+            rank -= 1
+            file = 0
+        elif c.isdigit():
+            file += int(c)
+        else:
+            res.append((PieceType.from_char(c.lower()), COLOR.WHITE if c.isupper() else COLOR.BLACK, rank * 8 + file))
+            file += 1
+    return res
+
+
+def king_squares(pieces: Sequence[Tuple[PieceType, COLOR, int]]) -> List[int]:
+    """
+    :return: square of the white king and square of the black king.
+    """
+    res = [0, 0]
+    for piece, color, square in pieces:
+        if piece == PieceType.KING:
+            res[side_index(color)] = square
+    return res
+
+
+def decode_leb128(buf: np.ndarray, dtype) -> np.ndarray:
+    """
+    Decode signed LEB128 integers, all at once. buf must end with the last byte of a number.
+    Values are accumulated in int64 and then cast to dtype, which wraps the same way as the shifts in the Rust reader.
+    """
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    lengths = ends - starts + 1
+    positions = np.arange(len(buf)) - np.repeat(starts, lengths)
+    values = np.add.reduceat((buf & 0x7f).astype(np.int64) << (7 * positions), starts)
+    shifts = 7 * lengths
+    negative = (buf[ends] & 0x40 != 0) & (shifts < np.dtype(dtype).itemsize * 8)
+    values[negative] -= np.left_shift(1, shifts[negative])
+    return values.astype(dtype)
+
+
+def encode_leb128(values: np.ndarray) -> bytes:
+    """
+    Signed LEB128 encoding of an integer array, the inverse of decode_leb128.
+    """
+    values = np.asarray(values, dtype=np.int64).ravel()
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    while True:
+        limit = np.left_shift(1, 7 * n_bytes - 1)
+        too_big = (values < -limit) | (values >= limit)
+        if not too_big.any():
+            break
+        n_bytes[too_big] += 1
+    starts = np.cumsum(n_bytes) - n_bytes
+    positions = np.arange(n_bytes.sum()) - np.repeat(starts, n_bytes)
+    buf = (np.repeat(values, n_bytes) >> (7 * positions)) & 0x7f
+    buf[positions < np.repeat(n_bytes, n_bytes) - 1] |= 0x80
+    return buf.astype(np.uint8).tobytes()
+
+
+def read_leb128(data: np.ndarray, offset: int, count: int, dtype) -> Tuple[np.ndarray, int]:
+    """
+    Read a block of count LEB128-compressed integers: magic string, little endian u32 size in bytes, data.
+    :return: decoded array and offset of the end of the block.
+    """
+    if data[offset:offset + len(LEB128_MAGIC)].tobytes() != LEB128_MAGIC:
+        raise ValueError(f"expected LEB128 block at offset {offset}")
+    offset += len(LEB128_MAGIC)
+    size = int(np.frombuffer(data, dtype="<u4", count=1, offset=offset)[0])
+    offset += 4
+    buf = data[offset:offset + size]
+
+    res = np.empty(count, dtype=dtype)
+    n = start = 0
+    while start < size:
+        # cut chunks right after the last byte of a number
+        stop = min(start + LEB128_CHUNK_SIZE, size)
+        if stop < size:
+            stop = start + int(np.flatnonzero(buf[start:stop] < 0x80)[-1]) + 1
+        values = decode_leb128(buf[start:stop], dtype)
+        if n + len(values) > count:
+            raise ValueError(f"LEB128 block at offset {offset} holds more than {count} values")
+        res[n:n + len(values)] = values
+        n += len(values)
+        start = stop
+    if n != count:
+        raise ValueError(f"LEB128 block at offset {offset} holds {n} values, expected {count}")
+    return res, offset + size
+
+
+def skip_leb128(data: np.ndarray, offset: int) -> int:
+    offset += len(LEB128_MAGIC)
+    return offset + 4 + int(np.frombuffer(data, dtype="<u4", count=1, offset=offset)[0])
+
+
+def _truncating_division(a, b: int):
+    """
+    Integer division rounding towards zero, like in Rust.
+    """
+    return np.sign(a) * (np.abs(a) // b)
+
+
+class LayerStack:
+    """
+    Dense layers of one bucket, stored raw in the file: fc_0 sparse input, fc_1 and fc_2 affine, each as int32 biases
+    followed by int8 weights with rows padded to a multiple of 8.
+    """
+
+    def __init__(self, fc_0_bias, fc_0_weights, fc_1_bias, fc_1_weights, fc_2_bias, fc_2_weights):
+        self.fc_0_bias = fc_0_bias  # (FC_0_OUT_DIMS + 1,)
+        self.fc_0_weights = fc_0_weights  # (FC_0_OUT_DIMS + 1, padded(HALF_DIMENSIONS))
+        self.fc_1_bias = fc_1_bias  # (FC_1_OUT_DIMS,)
+        self.fc_1_weights = fc_1_weights  # (FC_1_OUT_DIMS, padded(2 * FC_0_OUT_DIMS))
+        self.fc_2_bias = fc_2_bias  # (1,)
+        self.fc_2_weights = fc_2_weights  # (1, padded(FC_1_OUT_DIMS))
+        # transposed int32 copies for the products, a few hundred kB
+        self.fc_0_matrix = fc_0_weights.T.astype(np.int32)
+        self.fc_1_matrix = fc_1_weights[:, :2 * FC_0_OUT_DIMS].T.astype(np.int32)
+        self.fc_2_matrix = fc_2_weights[:, :FC_1_OUT_DIMS].T.astype(np.int32)
+
+    @classmethod
+    def read(cls, data: np.ndarray, offset: int, half_dimensions: int) -> Tuple["LayerStack", int]:
+        arrays = []
+        for out_dims, in_dims in ((FC_0_OUT_DIMS + 1, half_dimensions), (FC_1_OUT_DIMS, 2 * FC_0_OUT_DIMS),
+                                  (1, FC_1_OUT_DIMS)):
+            arrays.append(np.frombuffer(data, dtype="<i4", count=out_dims, offset=offset))
+            offset += 4 * out_dims
+            weights = np.frombuffer(data, dtype=np.int8, count=out_dims * padded(in_dims), offset=offset)
+            arrays.append(weights.reshape(out_dims, padded(in_dims)))
+            offset += out_dims * padded(in_dims)
+        return cls(*arrays), offset
+
+    def to_bytes(self) -> bytes:
+        return b"".join(
+            np.ascontiguousarray(a, dtype=dtype).tobytes() for a, dtype in (
+                (self.fc_0_bias, "<i4"), (self.fc_0_weights, np.int8),
+                (self.fc_1_bias, "<i4"), (self.fc_1_weights, np.int8),
+                (self.fc_2_bias, "<i4"), (self.fc_2_weights, np.int8),
+            )
+        )
+
+    def propagate(self, transformed: np.ndarray) -> np.ndarray:
+        """
+        :param transformed: (N, half_dimensions) output of the feature transformer.
+        :return: (N,) positional scores.
+        """
+        fc_0 = self.fc_0_bias + transformed @ self.fc_0_matrix[:transformed.shape[1]]
+        fc_0, remainder = fc_0[:, :FC_0_OUT_DIMS], fc_0[:, FC_0_OUT_DIMS]
+
+        ac_sqr_0 = np.minimum(127, fc_0.astype(np.int64) ** 2 >> (2 * WEIGHT_SCALE_BITS + 7))
+        ac_0 = np.clip(fc_0 >> WEIGHT_SCALE_BITS, 0, 127)
+        combined = np.concatenate([ac_sqr_0, ac_0], axis=1).astype(np.int32)
+
+        fc_1 = self.fc_1_bias + combined @ self.fc_1_matrix
+        ac_1 = np.clip(fc_1 >> WEIGHT_SCALE_BITS, 0, 127)
+        fc_2 = self.fc_2_bias + ac_1 @ self.fc_2_matrix
+
+        forward = _truncating_division(remainder.astype(np.int64) * (600 * OUTPUT_SCALE),
+                                       127 * (1 << WEIGHT_SCALE_BITS))
+        return fc_2[:, 0] + forward
+
+
+class Network:
+    """
+    Weights of a .nnue file. Arrays may be read-only memory maps.
+    """
+
+    def __init__(self, ft_bias: np.ndarray, ft_weights: np.ndarray, ft_psqt: np.ndarray, layers: List[LayerStack],
+                 description: bytes = b""):
+        self.ft_bias = ft_bias  # (half_dimensions,) int16
+        self.ft_weights = ft_weights  # (INPUT_DIMENSIONS, half_dimensions) int16
+        self.ft_psqt = ft_psqt  # (INPUT_DIMENSIONS, PSQT_BUCKETS) int32
+        self.layers = layers  # one per bucket
+        self.description = description
+        self.half_dimensions = len(ft_bias)
+
+    @classmethod
+    def from_file(cls, path: str = default_network_path, half_dimensions: int = HALF_DIMENSIONS,
+                  cache: bool = True) -> "Network":
+        """
+        Load a network, memory-mapping its weights.
+        :param path: .nnue file.
+        :param half_dimensions: size of each accumulator. Only test networks differ from the default.
+        :param cache: decompress the feature transformer to .npy files next to path and map them on the next loads.
+        Without it, the feature transformer is decompressed in memory each time.
+        """
+        data = np.memmap(path, dtype=np.uint8, mode="r").view(np.ndarray)  # plain arrays index faster than memmaps
+        version, network_hash, size = np.frombuffer(data, dtype="<u4", count=3, offset=0)
+        if version != VERSION or network_hash != NETWORK_HASH:
+            raise ValueError(f"{path}: unsupported network version or architecture")
+        description = data[12:12 + size].tobytes()
+        offset = 12 + int(size)
+
+        if np.frombuffer(data, dtype="<u4", count=1, offset=offset)[0] != FEATURE_TRANSFORMER_HASH:
+            raise ValueError(f"{path}: unexpected feature transformer")
+        offset += 4
+        cache_paths = [f"{path}.{name}.npy" for name in ("ft_bias", "ft_weights", "ft_psqt")]
+        if cache and all(os.path.exists(p) and os.path.getmtime(p) >= os.path.getmtime(path) for p in cache_paths):
+            ft_bias, ft_weights, ft_psqt = (np.load(p, mmap_mode="r").view(np.ndarray) for p in cache_paths)
+            for _ in range(3):
+                offset = skip_leb128(data, offset)
+        else:
+            ft_bias, offset = read_leb128(data, offset, half_dimensions, np.int16)
+            ft_weights, offset = read_leb128(data, offset, INPUT_DIMENSIONS * half_dimensions, np.int16)
+            ft_psqt, offset = read_leb128(data, offset, INPUT_DIMENSIONS * PSQT_BUCKETS, np.int32)
+            ft_weights = ft_weights.reshape(INPUT_DIMENSIONS, half_dimensions)
+            ft_psqt = ft_psqt.reshape(INPUT_DIMENSIONS, PSQT_BUCKETS)
+            if cache:
+                for p, a in zip(cache_paths, (ft_bias, ft_weights, ft_psqt)):
+                    np.save(p, a)
+                ft_bias, ft_weights, ft_psqt = (np.load(p, mmap_mode="r").view(np.ndarray) for p in cache_paths)
+        if ft_bias.shape != (half_dimensions,):
+            raise ValueError(f"{path}: feature transformer has {ft_bias.shape[0]} dimensions, expected {half_dimensions}")
+
+        layers = []
+        for _ in range(LAYER_STACKS):
+            if np.frombuffer(data, dtype="<u4", count=1, offset=offset)[0] != LAYER_STACK_HASH:
+                raise ValueError(f"{path}: unexpected layer stack at offset {offset}")
+            layer, offset = LayerStack.read(data, offset + 4, half_dimensions)
+            layers.append(layer)
+        return cls(ft_bias, ft_weights, ft_psqt, layers, description)
+
+    def save(self, path: str):
+        """
+        Write the network in the .nnue format read by from_file and by the Rust engine.
+        """
+        with open(path, "wb") as f:
+            f.write(np.array([VERSION, NETWORK_HASH, len(self.description)], dtype="<u4").tobytes())
+            f.write(self.description)
+            f.write(np.array([FEATURE_TRANSFORMER_HASH], dtype="<u4").tobytes())
+            for a in (self.ft_bias, self.ft_weights, self.ft_psqt):
+                encoded = encode_leb128(a)
+                f.write(LEB128_MAGIC + np.array([len(encoded)], dtype="<u4").tobytes() + encoded)
+            for layer in self.layers:
+                f.write(np.array([LAYER_STACK_HASH], dtype="<u4").tobytes())
+                f.write(layer.to_bytes())
+
+    def accumulate(self, features: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Accumulator and PSQT scores of a set of active features, from scratch. Sums wrap around in int16 like the
+        incremental updates do.
+        """
+        values = self.ft_bias + self.ft_weights[features].sum(axis=0, dtype=np.int16)
+        psqt = self.ft_psqt[features].sum(axis=0, dtype=np.int32)
+        return values, psqt
+
+    def transform(self, values: np.ndarray) -> np.ndarray:
+        """
+        Feature transformer output: each half of each accumulator clipped to [0, 127] and multiplied with the other
+        half, divided by 128.
+        :param values: (N, 2, half_dimensions) accumulators, side to move first.
+        :return: (N, half_dimensions) int32 array.
+        """
+        half = self.half_dimensions // 2
+        clipped = np.clip(values, 0, 127).astype(np.int32)
+        return (clipped[:, :, :half] * clipped[:, :, half:] // 128).reshape(len(values), self.half_dimensions)
+
+    def forward(self, values: np.ndarray, psqt: np.ndarray, n_pieces: np.ndarray, adjusted: bool = True) -> np.ndarray:
+        """
+        Evaluate a batch of positions from their accumulators.
+        :param values: (N, 2, half_dimensions) int16 accumulators, side to move first.
+        :param psqt: (N, 2, PSQT_BUCKETS) int32 PSQT scores, side to move first.
+        :param n_pieces: (N,) number of pieces on the board, which selects the layer stack and the PSQT bucket.
+        :param adjusted: weigh the positional part a bit more than the PSQT part, like the Rust search does.
+        :return: (N,) int64 scores, from the point of view of the side to move.
+        """
+        buckets = (np.asarray(n_pieces) - 1) // 4
+        transformed = self.transform(values)
+        positional = np.zeros(len(values), dtype=np.int64)
+        for bucket in np.unique(buckets):
+            batch = buckets == bucket
+            positional[batch] = self.layers[bucket].propagate(transformed[batch])
+
+        rows = np.arange(len(values))
+        material = _truncating_division(psqt[rows, 0, buckets].astype(np.int64) - psqt[rows, 1, buckets], 2)
+        if adjusted:
+            return _truncating_division((1024 - ADJUSTMENT_DELTA) * material + (1024 + ADJUSTMENT_DELTA) * positional,
+                                        1024 * OUTPUT_SCALE)
+        return _truncating_division(material + positional, OUTPUT_SCALE)
+
+    def evaluate_fens(self, fens: List[str], adjusted: bool = True) -> np.ndarray:
+        """
+        Evaluate many positions at once, from the point of view of their side to move.
+        :param fens: positions in FEN or EPD format.
+        """
+        values = np.empty((len(fens), 2, self.half_dimensions), dtype=np.int16)
+        psqt = np.empty((len(fens), 2, PSQT_BUCKETS), dtype=np.int32)
+        n_pieces = np.empty(len(fens), dtype=np.int64)
+        for n, fen in enumerate(fens):
+            pieces = fen_pieces(fen)
+            us = COLOR.BLACK if fen.split()[1] == "b" else COLOR.WHITE
+            kings = king_squares(pieces)
+            for i, perspective in enumerate((us, us.flip())):
+                features = active_features(pieces, perspective, kings[side_index(perspective)])
+                values[n, i], psqt[n, i] = self.accumulate(features)
+            n_pieces[n] = len(pieces)
+        return self.forward(values, psqt, n_pieces, adjusted)
+
+
+class Accumulator:
+    """
+    Accumulators of the two sides for every position on the move stack of a board. make_move pushes a new level with
+    update, which adds and removes the features of the pieces the move changed, and unmake_move drops it with pop.
+    Only a king move forces a full refresh, and only for the side of that king.
+    Levels are indexed by side, white first, unlike the arguments of Network.forward.
+    """
+
+    def __init__(self, network: Network, board, max_ply: int = MAX_GAME_PLY):
+        self.network = network
+        self.values = np.empty((max_ply + 1, 2, network.half_dimensions), dtype=np.int16)
+        self.psqt = np.empty((max_ply + 1, 2, PSQT_BUCKETS), dtype=np.int32)
+        self.kings = [[0, 0] for _ in range(max_ply + 1)]
+        self.top = 0
+        self.refresh(board)
+
+    def refresh(self, board, sides: Iterable[COLOR] = perspectives):
+        """
+        Recompute the top level from the pieces on the board.
+        """
+        pieces = board_pieces(board)
+        kings = self.kings[self.top]
+        kings[:] = king_squares(pieces)
+        for perspective in sides:
+            i = side_index(perspective)
+            features = active_features(pieces, perspective, kings[i])
+            self.values[self.top, i], self.psqt[self.top, i] = self.network.accumulate(features)
+
+    def update(self, board, move: int, color_that_moved: COLOR):
+        """
+        Push the accumulators of the position after move. The board must already be in that position.
+        """
+        top = self.top + 1
+        if top == len(self.values):
+            self.values = np.concatenate([self.values, np.empty_like(self.values)])
+            self.psqt = np.concatenate([self.psqt, np.empty_like(self.psqt)])
+            self.kings.extend([0, 0] for _ in range(len(self.kings)))
+        self.values[top] = self.values[top - 1]
+        self.psqt[top] = self.psqt[top - 1]
+        self.kings[top][:] = self.kings[top - 1]
+        self.top = top
+
+        us, them = color_that_moved, color_that_moved.flip()
+        from_sq, to_sq = move & 63, (move >> 6) & 63
+        moved = code_pieces[(move >> 12) & 7]
+        added = [(code_pieces[(move >> 18) & 7] or moved, us, to_sq)]
+        removed = [(moved, us, from_sq)]
+        captured = code_pieces[(move >> 15) & 7]
+        if captured is not None:
+            removed.append((captured, them, to_sq))
+        elif move & EN_PASSANT:
+            removed.append((PieceType.PAWN, them, to_sq - 8 * us.value))
+        elif move & CASTLING:
+            rook_from, rook_to = board.castle_rook_squares(to_sq)
+            removed.append((PieceType.ROOK, us, rook_from))
+            added.append((PieceType.ROOK, us, rook_to))
+
+        weights, psqt_weights = self.network.ft_weights, self.network.ft_psqt
+        for perspective in perspectives:
+            if moved == PieceType.KING and perspective == us:
+                # the features of the side of the king all depend on its square
+                self.refresh(board, (us,))
+                continue
+            i = side_index(perspective)
+            values, psqt = self.values[top, i], self.psqt[top, i]
+            table = feature_table[i][self.kings[top][i]]
+            for piece, color, square in removed:
+                feature = table[(2 * piece.value + side_index(color)) * 64 + square]
+                values -= weights[feature]
+                psqt -= psqt_weights[feature]
+            for piece, color, square in added:
+                feature = table[(2 * piece.value + side_index(color)) * 64 + square]
+                values += weights[feature]
+                psqt += psqt_weights[feature]
+
+    def pop(self):
+        self.top -= 1
+
+    def evaluate(self, color_to_move: COLOR, n_pieces: int, adjusted: bool = True) -> int:
+        """
+        Network output for the top level, from the point of view of the side to move.
+        """
+        order = [side_index(color_to_move), side_index(color_to_move.flip())]
+        values = self.values[self.top, order][np.newaxis]
+        psqt = self.psqt[self.top, order][np.newaxis]
+        return int(self.network.forward(values, psqt, np.array([n_pieces]), adjusted)[0])
+
+    def verify(self, board):
+        """
+        Debug check of the incremental updates against a refresh.
+        """
+        pieces = board_pieces(board)
+        kings = king_squares(pieces)
+        assert kings == self.kings[self.top], "accumulator king squares out of sync"
+        for perspective in perspectives:
+            i = side_index(perspective)
+            values, psqt = self.network.accumulate(active_features(pieces, perspective, kings[i]))
+            assert np.array_equal(values, self.values[self.top, i]) and np.array_equal(psqt, self.psqt[self.top, i]), \
+                "incremental accumulator out of sync"
@@ -1,25 +1,42 @@
 import random
+import threading
 
-from engine import Engine
-from move import Move
+from engine import Engine, backends, MAX_PLY
+from lazy_smp import LazySMP
+from move import Move, uci_string
 from board import Board
+from tablebase import Tablebase
 from timer import Timer
+from transposition_table import TranspositionTable, DEFAULT_HASH_MB
 from typing import Optional, List
 import helpers
 
 DEBUG = False
+MAX_THREADS = 64
 
 
 # static class
 class OrchestraDirector:
     board: Optional[Board] = None
     timer: Optional[Timer] = None
+    backend: str = "mailbox"  # key of engine.backends
+    tablebase: Optional[Tablebase] = None
+    # allocated by the first search, not on import: the helper processes of Lazy SMP import this module too. Kept from
+    # one move to the next
+    transposition_table: Optional[TranspositionTable] = None
+    hash_mb: int = DEFAULT_HASH_MB
+    threads: int = 1
+    lazy_smp: Optional[LazySMP] = None  # helper processes, with more than one thread
+    # the search runs on a worker thread, so that the command loop keeps answering during it
+    engine: Optional[Engine] = None
+    search_thread: Optional[threading.Thread] = None
+    release = threading.Event()  # set by stop and ponderhit, that an infinite or pondering search waits for
 
     @classmethod
     def init_startpos(cls):
         if DEBUG:
             print("startpos")
-        cls.board = Board.from_startpos()
+        cls.board = backends[cls.backend].from_startpos()
 
     @classmethod
     def handle_command(cls, command, options):
@@ -29,17 +46,22 @@ class OrchestraDirector:
             case "isready":
                 cls.uci_handle_isready()
             case "ucinewgame":
-                pass
+                cls.uci_handle_stop()
+                if cls.transposition_table is not None:
+                    cls.transposition_table.clear()
             case "position":
+                cls.uci_handle_stop()
                 cls.uci_handle_position(options)
             case "go":
                 cls.uci_handle_go(options)
             case "stop":
                 cls.uci_handle_stop()
+            case "ponderhit":
+                cls.uci_handle_ponderhit()
             case "quit":
                 cls.uci_handle_quit()
             case "setoption":
-                pass
+                cls.uci_handle_setoption(options)
             case _:
                 if DEBUG:
                     raise NotImplementedError(command, options)
@@ -48,7 +70,66 @@ class OrchestraDirector:
     def uci_handle_uci(cls):
         print("id name Orchestra")
         print("id author Dario & Mattia")
-        print("uciok")
+        print("option name Backend type combo default " + cls.backend + "".join(" var " + b for b in backends))
+        print("option name TablebasePath type string default <empty>")
+        print(f"option name Hash type spin default {DEFAULT_HASH_MB} min 1 max 4096")
+        print("option name Ponder type check default false")
+        print(f"option name Threads type spin default 1 min 1 max {MAX_THREADS}")
+        print("uciok", flush=True)
+
+    @classmethod
+    def uci_handle_setoption(cls, options):
+        # setoption name <id> [value <x>]
+        words = options.split()
+        if "name" not in words:
+            return
+        value_idx = words.index("value") if "value" in words else len(words)
+        name = " ".join(words[words.index("name") + 1:value_idx])
+        value = " ".join(words[value_idx + 1:])
+        match name.lower():
+            case "backend":
+                if value in backends:
+                    cls.backend = value
+            case "hash":
+                if value.isdigit():
+                    cls.tear_down_search()  # the next search allocates the table with the new size
+                    cls.hash_mb = min(max(int(value), 1), 4096)
+            case "threads":
+                if value.isdigit():
+                    cls.tear_down_search()
+                    cls.threads = min(max(int(value), 1), MAX_THREADS)
+            case "tablebasepath":
+                cls.tablebase = Tablebase(value) if value and value != "<empty>" else None
+            case "ponder":
+                pass  # the GUI decides when to ponder, with go ponder
+            case _:
+                if DEBUG:
+                    raise NotImplementedError(name, value)
+
+    @classmethod
+    def set_up_search(cls):
+        """
+        Allocate the transposition table of hash_mb and, for more than one thread, start the helper processes, which
+        share the table in shared memory.
+        """
+        cls.tear_down_search()
+        cls.transposition_table = TranspositionTable(cls.hash_mb, shared=cls.threads > 1)
+        if cls.threads > 1:
+            cls.lazy_smp = LazySMP(cls.threads, cls.transposition_table)
+
+    @classmethod
+    def tear_down_search(cls):
+        """
+        Stop the running search, if any, and the helper processes, and free the transposition table. The next search
+        allocates it again.
+        """
+        cls.uci_handle_stop()
+        if cls.lazy_smp is not None:
+            cls.lazy_smp.close()
+            cls.lazy_smp = None
+        if cls.transposition_table is not None:
+            cls.transposition_table.close()
+            cls.transposition_table = None
 
     @classmethod
     def uci_handle_position(cls, options):
@@ -66,56 +147,74 @@ class OrchestraDirector:
     def execute_moves(cls, param):
         moves: List[str] = param.split()
         for mov_str in moves:
-            mov: Move = Move.from_string(mov_str, cls.board)
+            mov = Move.from_string(mov_str, cls.board).to_packed()
             cls.board.make_move(mov)
 
     @classmethod
     def init_from_fen(cls, fen):
         # todo: review this because the string editing is done in two different places
         # fen = options[options.find("[") + 1:options.find("]")]
-        cls.board = Board.from_fen(fen)
+        cls.board = backends[cls.backend].from_fen(fen)
 
     @classmethod
     def uci_handle_isready(cls):
-        print("readyok")
+        print("readyok", flush=True)
 
     @classmethod
     def uci_handle_go(cls, options):
-        op_list = options.split()
-        i = 0
-        while i < len(op_list):
-            match op_list[i]:
-                case "wtime":
-                    i += 2
-                case "btime":
-                    i += 2
-                case "winc":
-                    i += 2
-                case "binc":
-                    i += 2
-                case "depth":
-                    i += 2
-                case "nodes":
-                    i += 2
-                case "infinite":
-                    i += 1
-                case _:
-                    i += 1
-
-        legal_moves = cls.board.generate_moves()
-
-        eng = Engine(cls.board)
-        mov = eng.search(6)[1]
-
-        print("bestmove " + mov.to_string())
-        return mov
+        cls.uci_handle_stop()
+        timer = Timer.from_go(options)
+        max_depth = timer.depth or MAX_PLY
+
+        if cls.transposition_table is None:
+            cls.set_up_search()
+        cls.engine = Engine(cls.board, tablebase=cls.tablebase, transposition_table=cls.transposition_table)
+        cls.release.clear()
+        cls.search_thread = threading.Thread(target=cls.run_search, args=(cls.engine, max_depth, timer), daemon=True)
+        cls.search_thread.start()
+
+    @classmethod
+    def run_search(cls, engine: Engine, max_depth: int, timer: Timer):
+        """
+        Body of the search thread: search, then send the best move.
+        :param engine: engine of the search, on the board of the director
+        :param max_depth: maximum depth to search
+        :param timer: limits of the search
+        """
+        if cls.lazy_smp is not None:
+            mov = cls.lazy_smp.search(engine, max_depth, timer)[1]
+        else:
+            mov = engine.search(max_depth, timer)[1]
+        # the best move of an infinite or pondering search is sent only once the GUI asks for it
+        while (timer.infinite or timer.ponder) and not engine.stopped:
+            cls.release.wait()
+            cls.release.clear()
+        # the null move of UCI when the root has no legal moves
+        print("bestmove " + (uci_string(mov) if mov is not None else "0000"), flush=True)
 
     @classmethod
     def uci_handle_stop(cls):
-        raise NotImplementedError
+        """
+        Stop the running search, if any, and wait for it to send its best move.
+        """
+        if cls.search_thread is None:
+            return
+        # a search that has not started yet would clear the stop request: repeat it until the thread ends
+        while cls.search_thread.is_alive():
+            cls.engine.stop_search()
+            cls.release.set()
+            cls.search_thread.join(0.01)
+        cls.search_thread = None
+
+    @classmethod
+    def uci_handle_ponderhit(cls):
+        if cls.search_thread is not None:
+            cls.engine.ponderhit()
+            cls.release.set()
 
     @classmethod
     def uci_handle_quit(cls):
+        cls.tear_down_search()
         exit(0)
 
 
@@ -123,3 +222,4 @@ if __name__ == '__main__':
     OrchestraDirector.handle_command("position",  "fen 8/8/8/K7/8/8/7Q/1k6 b - - 0 1 moves b1c1")
     # OrchestraDirector.handle_command("position", "startpos moves e2e4")
     OrchestraDirector.handle_command("go", "movetime 1000")
+    OrchestraDirector.search_thread.join()
@@ -0,0 +1,134 @@
+"""
+Pawn structure evaluation: doubled, isolated, backward and passed pawns, from the pawn bitboards of both sides.
+
+Pawn structure changes with few moves, so the scores are cached in a PawnHashTable keyed by the pawn-only Zobrist
+key that ZobristHashHandler keeps up to date, and the evaluation is almost never computed during a search.
+"""
+from typing import List, Optional, Tuple
+
+from attack_map import pawn_targets
+from constants import COLOR
+
+# (middlegame, endgame) weights, per pawn
+doubled_penalty = (-10, -20)  # per pawn beyond the first on a file
+isolated_penalty = (-10, -15)  # no friendly pawn on the adjacent files
+backward_penalty = (-8, -10)  # cannot be supported by a friendly pawn and its stop square is attacked by an enemy pawn
+passed_bonus_mg = [0, 5, 10, 20, 35, 60, 100, 0]  # by rank, seen from the pawn's side
+passed_bonus_eg = [0, 10, 20, 40, 70, 120, 200, 0]
+
+
+def _bits(squares) -> int:
+    bb = 0
+    for sq in squares:
+        bb |= 1 << sq
+    return bb
+
+
+def _relative_rank(color: COLOR, square: int) -> int:
+    return square >> 3 if color == COLOR.WHITE else 7 - (square >> 3)
+
+
+file_masks = [0x0101010101010101 << f for f in range(8)]
+adjacent_file_masks = [(file_masks[f - 1] if f > 0 else 0) | (file_masks[f + 1] if f < 7 else 0) for f in range(8)]
+# enemy pawns that stop a pawn from being passed: ahead of it, on its file or on the adjacent files
+passed_masks = {
+    color: [
+        _bits(sq for sq in range(64) if _relative_rank(color, sq) > _relative_rank(color, square)) &
+        (file_masks[square & 7] | adjacent_file_masks[square & 7])
+        for square in range(64)
+    ]
+    for color in COLOR
+}
+# friendly pawns ahead of a pawn on its file: of doubled passed pawns, only the front one gets the bonus
+front_masks = {color: [passed_masks[color][square] & file_masks[square & 7] for square in range(64)] for color in COLOR}
+# friendly pawns that can still support a pawn: on the adjacent files, level with it or behind
+support_masks = {
+    color: [
+        _bits(sq for sq in range(64) if _relative_rank(color, sq) <= _relative_rank(color, square)) &
+        adjacent_file_masks[square & 7]
+        for square in range(64)
+    ]
+    for color in COLOR
+}
+# enemy pawns attacking the square in front of a pawn
+stop_attack_masks = {
+    color: [
+        _bits(pawn_targets[color][square + 8 * color.value]) if 0 <= square + 8 * color.value < 64 else 0
+        for square in range(64)
+    ]
+    for color in COLOR
+}
+
+
+def pawn_structure_scores(white_pawns: int, black_pawns: int) -> Tuple[int, int]:
+    """
+    Pawn structure terms, computed from scratch.
+    :param white_pawns: bitboard of the white pawns, squares indexed as rank * 8 + file.
+    :param black_pawns: bitboard of the black pawns.
+    :return: middlegame and endgame scores, from white's point of view.
+    """
+    mg = eg = 0
+    for color, own, enemy in ((COLOR.WHITE, white_pawns, black_pawns), (COLOR.BLACK, black_pawns, white_pawns)):
+        sign = color.value
+        for f in range(8):
+            n = (own & file_masks[f]).bit_count()
+            if n > 1:
+                mg += sign * doubled_penalty[0] * (n - 1)
+                eg += sign * doubled_penalty[1] * (n - 1)
+
+        passed, front = passed_masks[color], front_masks[color]
+        support, stop_attack = support_masks[color], stop_attack_masks[color]
+        bb = own
+        while bb:
+            lsb = bb & -bb
+            sq = lsb.bit_length() - 1
+            bb ^= lsb
+            if not own & adjacent_file_masks[sq & 7]:
+                mg += sign * isolated_penalty[0]
+                eg += sign * isolated_penalty[1]
+            elif not own & support[sq] and enemy & stop_attack[sq]:
+                mg += sign * backward_penalty[0]
+                eg += sign * backward_penalty[1]
+            if not enemy & passed[sq] and not own & front[sq]:
+                rank = _relative_rank(color, sq)
+                mg += sign * passed_bonus_mg[rank]
+                eg += sign * passed_bonus_eg[rank]
+    return mg, eg
+
+
+PAWN_TABLE_BITS = 14
+
+
+class PawnHashTable:
+    """
+    Fixed-size cache of pawn structure scores, indexed by the low bits of the pawn key. Each slot keeps the full key,
+    to tell a hit from a collision, and a new entry always replaces the old one.
+    """
+
+    def __init__(self, size_bits: int = PAWN_TABLE_BITS):
+        self.mask = (1 << size_bits) - 1
+        self.entries: List[Optional[Tuple[int, int, int]]] = [None] * (self.mask + 1)  # (key, mg, eg)
+        self.probes = 0
+        self.hits = 0
+
+    def probe(self, key: int) -> Optional[Tuple[int, int]]:
+        """
+        :return: cached middlegame and endgame scores of the pawn structure with this key, None on a miss.
+        """
+        self.probes += 1
+        entry = self.entries[key & self.mask]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry[1], entry[2]
+        return None
+
+    def store(self, key: int, mg: int, eg: int):
+        self.entries[key & self.mask] = (key, mg, eg)
+
+    def hit_rate(self) -> float:
+        return self.hits / self.probes if self.probes else 0.0
+
+    def clear(self):
+        self.entries = [None] * (self.mask + 1)
+        self.probes = 0
+        self.hits = 0
@@ -0,0 +1,148 @@
+import argparse
+import json
+import time
+from typing import Dict, List, Optional
+
+from board import Board
+from engine import backends
+from move import uci_string
+
+# (name, fen, node counts indexed by depth), same positions as src/tests/move_gen_test.rs
+positions = [
+    (
+        "startpos",
+        "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+        [1, 20, 400, 8902, 197281, 4865609, 119060324],
+    ),
+    (
+        "kiwipete",
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        [1, 48, 2039, 97862, 4085603, 193690690],
+    ),
+    (
+        "endgame",
+        "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+        [1, 14, 191, 2812, 43238, 674624, 11030083],
+    ),
+    (
+        "promotions",
+        "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        [1, 6, 264, 9467, 422333, 15833292],
+    ),
+    (
+        "talkchess",
+        "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+        [1, 44, 1486, 62379, 2103487, 89941194],
+    ),
+    (
+        "middlegame",
+        "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+        [1, 46, 2079, 89890, 3894594, 164075551],
+    ),
+]
+
+
+def perft(board: Board, depth: int, bulk_count: bool = True) -> int:
+    """
+    Count the leaves of the legal move tree rooted at the current position.
+    :param board: board to explore. It is left in its original state.
+    :param depth: depth of the tree, in plies.
+    :param bulk_count: if True, count the legal moves at depth 1 instead of making them.
+    :return: number of leaves.
+    """
+    if depth == 0:
+        return 1
+    moves = board.generate_moves()
+    if bulk_count and depth == 1:
+        return len(moves)
+
+    counter = 0
+    for move in moves:
+        board.make_move(move)
+        counter += perft(board, depth - 1, bulk_count)
+        board.unmake_move()
+    return counter
+
+
+def perft_divide(board: Board, depth: int, bulk_count: bool = True) -> Dict[str, int]:
+    """
+    Split the perft count by root move. Useful to locate move generation bugs by comparing against another engine.
+    :param board: board to explore. It is left in its original state.
+    :param depth: depth of the tree, in plies. Must be at least 1.
+    :param bulk_count: see perft.
+    :return: dictionary from root move in algebraic notation to number of leaves below it.
+    """
+    divide = {}
+    for move in board.generate_moves():
+        board.make_move(move)
+        divide[uci_string(move)] = perft(board, depth - 1, bulk_count)
+        board.unmake_move()
+    return divide
+
+
+def run_position(fen: str, depth: int, expected: Optional[int] = None, bulk_count: bool = True,
+                 backend: str = "mailbox") -> dict:
+    """
+    Time a perft run on a single position.
+    :param backend: key of engine.backends.
+    :return: dictionary with node count, wall time and nodes per second.
+    """
+    board = backends[backend].from_fen(fen)
+    start = time.perf_counter()
+    nodes = perft(board, depth, bulk_count)
+    elapsed = time.perf_counter() - start
+    return {
+        "fen": fen,
+        "depth": depth,
+        "nodes": nodes,
+        "expected": expected,
+        "ok": expected is None or nodes == expected,
+        "time_s": round(elapsed, 4),
+        "nps": int(nodes / elapsed) if elapsed > 0 else None,
+    }
+
+
+def run_suite(depth: int, bulk_count: bool = True, backend: str = "mailbox") -> dict:
+    """
+    Run perft on every position of the standard suite, capping the depth at the deepest known count.
+    :return: dictionary with per-position results and totals.
+    """
+    results = {}
+    total_nodes, total_time = 0, 0.0
+    for name, fen, counts in positions:
+        d = min(depth, len(counts) - 1)
+        res = run_position(fen, d, counts[d], bulk_count, backend)
+        results[name] = res
+        total_nodes += res["nodes"]
+        total_time += res["time_s"]
+
+    return {
+        "backend": backend,
+        "positions": results,
+        "total_nodes": total_nodes,
+        "total_time_s": round(total_time, 4),
+        "nps": int(total_nodes / total_time) if total_time > 0 else None,
+        "ok": all(r["ok"] for r in results.values()),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depth", type=int, default=3, help="perft depth (default 3)")
+    parser.add_argument("--fen", type=str, default=None, help="run a single position instead of the standard suite")
+    parser.add_argument("--divide", action="store_true", help="print node counts split by root move (requires --fen)")
+    parser.add_argument("--backend", type=str, choices=list(backends), default="mailbox", help="board implementation (default mailbox)")
+    parser.add_argument("--no-bulk", action="store_true", help="make and unmake the leaf moves instead of counting them")
+    args = parser.parse_args()
+
+    bulk = not args.no_bulk
+    if args.divide:
+        if args.fen is None:
+            parser.error("--divide requires --fen")
+        output = perft_divide(backends[args.backend].from_fen(args.fen), args.depth, bulk)
+    elif args.fen is not None:
+        output = run_position(args.fen, args.depth, bulk_count=bulk, backend=args.backend)
+    else:
+        output = run_suite(args.depth, bulk, args.backend)
+
+    print(json.dumps(output, indent=2))
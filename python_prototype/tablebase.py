@@ -0,0 +1,499 @@
+"""
+Endgame tablebases for the positions with up to four pieces, kings included, built by retrograde analysis.
+
+A table covers one material signature, like KQvKR, and stores two values for every position and side to move: the
+result for the side to move (win, draw or loss, two bits per position) and the distance to mate in plies. The
+position of the pieces p_0 ... p_(n-1) of a signature, kings first, is indexed by their squares:
+    index = sq_0 * 64^(n-1) + sq_1 * 64^(n-2) + ... + sq_(n-1)
+which wastes the entries where two pieces share a square, but turns every move into a constant offset of the index,
+so that the whole table is solved with array operations. Tables are only built for the signatures where white is the
+stronger side; the others are probed with the colors swapped and the board mirrored.
+
+Castling, en passant and the fifty-move rule are ignored, and positions with castling rights or an en passant square
+are never probed.
+"""
+import argparse
+import itertools
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from attack_map import king_targets, knight_targets, pawn_targets, rays, slider_directions
+from constants import COLOR, PieceType
+
+MAX_PIECES = 4
+TABLEBASE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tablebases")
+
+# results in the WDL files, for the side to move
+ILLEGAL, LOSS, DRAW, WIN = 0, 1, 2, 3
+
+signature_order = (PieceType.QUEEN, PieceType.ROOK, PieceType.BISHOP, PieceType.KNIGHT, PieceType.PAWN)
+sides = (COLOR.WHITE, COLOR.BLACK)  # side to move, first axis of the tables
+UNKNOWN = np.iinfo(np.int16).max  # distance of the results not found yet
+
+
+def _side_key(pieces: Sequence[PieceType]):
+    return len(pieces), [len(signature_order) - signature_order.index(p) for p in pieces]
+
+
+class Material:
+    """
+    Material signature: the pieces of each side besides the king. pieces lists all of them, kings included, in the
+    order of the table index.
+    """
+
+    def __init__(self, white: Sequence[PieceType], black: Sequence[PieceType]):
+        self.white = sorted(white, key=signature_order.index)
+        self.black = sorted(black, key=signature_order.index)
+        self.pieces = [(PieceType.KING, COLOR.WHITE)] + [(p, COLOR.WHITE) for p in self.white] + \
+                      [(PieceType.KING, COLOR.BLACK)] + [(p, COLOR.BLACK) for p in self.black]
+        self.name = "K" + "".join(p.to_char().upper() for p in self.white) + \
+                    "vK" + "".join(p.to_char().upper() for p in self.black)
+        self.n = len(self.pieces)
+        self.size = 64 ** self.n
+        self.weights = [64 ** (self.n - 1 - i) for i in range(self.n)]
+
+    @classmethod
+    def from_name(cls, name: str):
+        white, black = name.upper().split("V")
+        return cls([PieceType.from_char(c) for c in white[1:].lower()],
+                   [PieceType.from_char(c) for c in black[1:].lower()])
+
+    @classmethod
+    def from_pieces(cls, pieces: Sequence[Tuple[PieceType, COLOR]]):
+        return cls([p for p, c in pieces if c == COLOR.WHITE and p != PieceType.KING],
+                   [p for p, c in pieces if c == COLOR.BLACK and p != PieceType.KING])
+
+    def is_canonical(self) -> bool:
+        return _side_key(self.white) >= _side_key(self.black)
+
+    def flipped(self):
+        return Material(self.black, self.white)
+
+    def permutation(self, pieces: Sequence[Tuple[PieceType, COLOR]], flip: bool) -> List[int]:
+        """
+        :param pieces: pieces of a position with this material, in any order.
+        :param flip: whether the colors of the position are swapped with respect to the signature.
+        :return: for each piece of the signature, its index in pieces.
+        """
+        unused = list(range(len(pieces)))
+        res = []
+        for piece, color in self.pieces:
+            key = (piece, color.flip() if flip else color)
+            i = next(i for i in unused if pieces[i] == key)
+            unused.remove(i)
+            res.append(i)
+        return res
+
+
+def canonical(pieces: Sequence[Tuple[PieceType, COLOR]]) -> Tuple[Material, bool]:
+    """
+    :return: signature of the table holding a position with these pieces, and whether the position must be
+    mirrored, with the colors swapped, to be looked up there.
+    """
+    material = Material.from_pieces(pieces)
+    if material.is_canonical():
+        return material, False
+    return material.flipped(), True
+
+
+def dependencies(material: Material) -> List[Material]:
+    """
+    :return: signatures of the tables reached from this one by a capture or a promotion.
+    """
+    res = {}
+    for i, (piece, color) in enumerate(material.pieces):
+        if piece == PieceType.KING:
+            continue
+        rest = material.pieces[:i] + material.pieces[i + 1:]
+        if len(rest) > 2:
+            child = canonical(rest)[0]
+            res[child.name] = child
+        if piece == PieceType.PAWN:
+            for promotion in signature_order[:-1]:
+                child = canonical(rest + [(promotion, color)])[0]
+                res[child.name] = child
+    return list(res.values())
+
+
+def all_materials(max_pieces: int = MAX_PIECES) -> List[Material]:
+    """
+    :return: canonical signatures of up to max_pieces pieces, each one after the tables it depends on.
+    """
+    found = {}
+    for n in range(1, max_pieces - 1):
+        for pieces in itertools.product(signature_order, sides, repeat=n):
+            material = canonical(list(zip(pieces[::2], pieces[1::2])))[0]
+            found[material.name] = material
+    return sorted(found.values(), key=lambda m: (m.n, m.white.count(PieceType.PAWN) + m.black.count(PieceType.PAWN),
+                                                 m.name))
+
+
+def _slots(targets: Sequence[Sequence[int]]) -> np.ndarray:
+    """
+    Target squares of each square as a (64, k) array, padded with -1.
+    """
+    res = np.full((64, max(len(t) for t in targets)), -1, dtype=np.int32)
+    for square, t in enumerate(targets):
+        res[square, :len(t)] = t
+    return res
+
+
+def _slider_targets(square: int, piece: PieceType) -> List[int]:
+    return [sq for d in slider_directions[piece] for sq in rays[square][d]]
+
+
+def _pawn_pushes(color: COLOR, square: int) -> List[int]:
+    rank, step = square >> 3, 8 * color.value
+    if rank in (0, 7):
+        return []
+    start = 1 if color == COLOR.WHITE else 6
+    return [square + step] + ([square + 2 * step] if rank == start else [])
+
+
+def _pawn_unpushes(color: COLOR, square: int) -> List[int]:
+    """
+    Squares a pawn standing on square can have been pushed from.
+    """
+    return [sq for sq in range(8, 56) if square in _pawn_pushes(color, sq)]
+
+
+piece_slots = {
+    PieceType.KING: _slots(king_targets),
+    PieceType.KNIGHT: _slots(knight_targets),
+    **{piece: _slots([_slider_targets(sq, piece) for sq in range(64)]) for piece in slider_directions},
+}
+pawn_push_slots = {color: _slots([_pawn_pushes(color, sq) for sq in range(64)]) for color in COLOR}
+pawn_capture_slots = {
+    color: _slots([pawn_targets[color][sq] if 0 < sq >> 3 < 7 else [] for sq in range(64)]) for color in COLOR
+}
+pawn_unpush_slots = {color: _slots([_pawn_unpushes(color, sq) for sq in range(64)]) for color in COLOR}
+
+# attacks[piece][a, b]: a piece on a attacks b on an empty board. Pawns are keyed by color instead
+attacks = {piece: np.zeros((64, 64), dtype=bool) for piece in list(piece_slots) + list(COLOR)}
+for _square in range(64):
+    for _piece, _slot in piece_slots.items():
+        attacks[_piece][_square, _slot[_square][_slot[_square] >= 0]] = True
+    for _color in COLOR:
+        attacks[_color][_square, pawn_targets[_color][_square]] = True
+# on_segment[a << 12 | b << 6 | c]: c is strictly between a and b, on a line
+on_segment = np.zeros(64 * 64 * 64, dtype=bool)
+for _square in range(64):
+    for _ray in rays[_square]:
+        for _k, _target in enumerate(_ray):
+            on_segment[(_square << 12 | _target << 6) + np.array(_ray[:_k], dtype=int)] = True
+
+
+def _squares(index: np.ndarray, n: int) -> List[np.ndarray]:
+    return [(index >> 6 * (n - 1 - i)) & 63 for i in range(n)]
+
+
+def _in_check(pieces: Sequence[Tuple[PieceType, COLOR]], squares: List[np.ndarray], color: COLOR) -> np.ndarray:
+    """
+    Whether the king of color is attacked, for each position given by the arrays of squares of pieces.
+    """
+    k = pieces.index((PieceType.KING, color))
+    res = np.zeros(len(squares[k]), dtype=bool)
+    for j, (piece, c) in enumerate(pieces):
+        if c == color:
+            continue
+        hit = attacks[c if piece == PieceType.PAWN else piece][squares[j], squares[k]]
+        if piece in slider_directions:
+            segment = squares[j] << 12 | squares[k] << 6
+            for m in range(len(pieces)):
+                if m != j and m != k:
+                    hit &= ~on_segment[segment | squares[m]]
+        res |= hit
+    return res
+
+
+def _piece_moves(pieces: Sequence[Tuple[PieceType, COLOR]], squares: List[np.ndarray], i: int, slots: np.ndarray,
+                 captures: bool) -> Iterator[Tuple[np.ndarray, np.ndarray, Optional[int]]]:
+    """
+    Moves of piece i along slots, in each position given by the arrays of squares of pieces. Kings are never
+    captured: the positions where that is possible are illegal.
+    :param captures: generate the captures instead of the moves to empty squares.
+    :return: rows of the positions, target squares and index of the captured piece, or None, for each group of moves.
+    """
+    others = [j for j in range(len(pieces)) if j != i]
+    piece = pieces[i][0]
+    # knights, kings and capturing pawns jump to their targets
+    sliding = piece in slider_directions or piece == PieceType.PAWN and not captures
+    for k in range(slots.shape[1]):
+        target = slots[squares[i], k]
+        rows = np.flatnonzero(target >= 0)
+        target = target[rows]
+        origin = squares[i][rows]
+        other_squares = [squares[j][rows] for j in others]
+        clear = np.ones(len(rows), dtype=bool)
+        if sliding:
+            segment = origin << 12 | target << 6
+            for sq in other_squares:
+                clear &= ~on_segment[segment | sq]
+        if not captures:
+            for sq in other_squares:
+                clear &= sq != target
+            yield rows[clear], target[clear], None
+            continue
+        for j, sq in zip(others, other_squares):
+            if pieces[j][1] != pieces[i][1] and pieces[j][0] != PieceType.KING:
+                hit = clear & (sq == target)
+                yield rows[hit], target[hit], j
+
+
+def _lookup(wdl: np.ndarray, dtm: np.ndarray, stm: int, index: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    return (wdl[stm, index >> 2] >> 2 * (index & 3)) & 3, dtm[stm, index].astype(np.int16)
+
+
+def _probe_positions(pieces: Sequence[Tuple[PieceType, COLOR]], squares: List[np.ndarray], stm: int,
+                     tables: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Results and distances to mate of positions with other material, for the side to move, from the solved tables.
+    """
+    if len(pieces) == 2:
+        kings_touch = attacks[PieceType.KING][squares[0], squares[1]]
+        return np.where(kings_touch, ILLEGAL, DRAW), np.zeros(len(squares[0]), dtype=np.int16)
+    material, flip = canonical(pieces)
+    index = sum((squares[i] ^ 56 if flip else squares[i]) * w
+                for i, w in zip(material.permutation(pieces, flip), material.weights))
+    return _lookup(*tables[material.name], stm ^ flip, index)
+
+
+def generate(material: Material, tables: Dict[str, Tuple[np.ndarray, np.ndarray]],
+             verbose: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Solve a table by retrograde analysis. Each position with s to move keeps the number of its moves that stay in
+    the table and have not been shown to lose; the captures and promotions lead to other tables and are looked up
+    first. Then, for d = 0, 1, 2, ..., the positions lost or won in d plies are found and their predecessors updated:
+    those of a lost position are won in d + 1, those of a won position lose a move, and are lost when the last one
+    goes. The positions left at the end are draws.
+    :param material: signature of the table.
+    :param tables: solved tables, with the signatures reached by captures and promotions, as returned by generate.
+    :return: results for the side to move packed four per byte, and distances to mate in plies, both with shape
+    (2, ...) and the side to move first.
+    """
+    start = time.time()
+    pieces, n, size = material.pieces, material.n, material.size
+    squares = _squares(np.arange(size, dtype=np.int32), n)
+    valid = np.ones(size, dtype=bool)
+    for i, (piece, _) in enumerate(pieces):
+        for j in range(i):
+            valid &= squares[i] != squares[j]
+        if piece == PieceType.PAWN:
+            valid &= (squares[i] >= 8) & (squares[i] < 56)
+    in_check = [_in_check(pieces, squares, color) & valid for color in sides]
+    legal = [valid & ~in_check[1 - s] for s in range(2)]  # the side that just moved is not in check
+    del valid, squares
+
+    counters, win_at, loss_at, loss_base, can_lose = [], [], [], [], []
+    for s, color in enumerate(sides):
+        counter = np.zeros(size, dtype=np.int8)
+        wins = np.full(size, UNKNOWN, dtype=np.int16)  # shortest win by a capture or a promotion
+        losses = np.full(size, -1, dtype=np.int16)  # longest loss by a capture or a promotion
+        draws = np.zeros(size, dtype=bool)  # a capture or a promotion draws
+        positions = np.flatnonzero(legal[s]).astype(np.int32)
+        squares = _squares(positions, n)
+
+        def convert(rows, new_pieces, new_squares):
+            result, distance = _probe_positions(new_pieces, new_squares, 1 - s, tables)
+            p = positions[rows]
+            for value in (LOSS, DRAW, WIN):
+                m = result == value
+                if value == LOSS:
+                    wins[p[m]] = np.minimum(wins[p[m]], distance[m] + 1)
+                elif value == DRAW:
+                    draws[p[m]] = True
+                else:
+                    losses[p[m]] = np.maximum(losses[p[m]], distance[m] + 1)
+
+        for i, (piece, c) in enumerate(pieces):
+            if c != color:
+                continue
+            promotes = piece == PieceType.PAWN
+            quiet_slots = pawn_push_slots[c] if promotes else piece_slots[piece]
+            capture_slots = pawn_capture_slots[c] if promotes else piece_slots[piece]
+            for slots, captures in ((quiet_slots, False), (capture_slots, True)):
+                for rows, target, captured in _piece_moves(pieces, squares, i, slots, captures):
+                    last_rank = promotes & ((target >> 3) == (7 if c == COLOR.WHITE else 0))
+                    promoting, rest = np.flatnonzero(last_rank), np.flatnonzero(~last_rank)
+                    if captured is not None or len(promoting):
+                        moved = [target if m == i else sq[rows] for m, sq in enumerate(squares)]
+                        kept = [m for m in range(n) if m != captured]
+                    for promotion in signature_order[:-1] if len(promoting) else ():
+                        convert(rows[promoting], [(promotion, c) if m == i else pieces[m] for m in kept],
+                                [moved[m][promoting] for m in kept])
+                    if captured is not None:
+                        convert(rows[rest], [pieces[m] for m in kept], [moved[m][rest] for m in kept])
+                    else:
+                        child = positions[rows[rest]] + (target[rest] - squares[i][rows[rest]]) * material.weights[i]
+                        counter[positions[rows[rest]][legal[1 - s][child]]] += 1
+
+        # without moves, the side to move is mated or stalemated
+        stuck = legal[s] & (counter == 0) & (wins == UNKNOWN) & ~draws & (losses < 0)
+        losses[stuck & in_check[s]] = 0
+        draws |= stuck & ~in_check[s]
+        counters.append(counter)
+        win_at.append(wins)
+        loss_base.append(losses)
+        loss_at.append(np.where(counter == 0, losses, UNKNOWN).astype(np.int16))
+        can_lose.append(legal[s] & ~draws & (wins == UNKNOWN))
+    del positions, squares, in_check
+
+    results = [np.where(legal[s], DRAW, ILLEGAL).astype(np.uint8) for s in range(2)]
+    distances = [np.zeros(size, dtype=np.int16) for _ in range(2)]
+    decided = [~legal[s] for s in range(2)]
+    # last ply with results to find: the ones of the captures and promotions are known from the start, and every
+    # other one is found a ply after the result it follows from
+    horizon = max(int(a[a < UNKNOWN].max(initial=0)) for a in win_at + loss_base)
+    d = 0
+    while True:
+        frontier = []
+        for s in range(2):
+            open_positions = ~decided[s]
+            won = np.flatnonzero(open_positions & (win_at[s] == d)).astype(np.int32)
+            lost = np.flatnonzero(open_positions & can_lose[s] & (loss_at[s] == d)).astype(np.int32)
+            for found, value in ((won, WIN), (lost, LOSS)):
+                decided[s][found] = True
+                results[s][found] = value
+                distances[s][found] = d
+            frontier.append((won, lost))
+        if any(len(won) or len(lost) for won, lost in frontier):
+            horizon = max(horizon, d + 1)
+        elif d >= horizon:
+            break
+        for s, (won, lost) in enumerate(frontier):
+            o = 1 - s
+            previous = _predecessors(material, legal[o], lost, s)
+            win_at[o][previous] = np.minimum(win_at[o][previous], d + 1)
+            previous = _predecessors(material, legal[o], won, s)
+            previous, count = np.unique(previous, return_counts=True)
+            counters[o][previous] -= count.astype(np.int8)
+            last = previous[counters[o][previous] == 0]
+            loss_at[o][last] = np.maximum(loss_base[o][last], d + 1)
+        if verbose:
+            print(f"{material.name}: ply {d}, {sum(len(w) for w, _ in frontier)} won, "
+                  f"{sum(len(l) for _, l in frontier)} lost")
+        d += 1
+
+    codes = np.stack(results).reshape(2, -1, 4)
+    wdl = codes[..., 0] | codes[..., 1] << 2 | codes[..., 2] << 4 | codes[..., 3] << 6
+    dtm = np.stack(distances)
+    dtm = dtm.astype(np.uint8 if dtm.max() < 256 else np.uint16)
+    if verbose:
+        print(f"{material.name}: solved in {time.time() - start:.1f}s, longest mate {dtm.max()} plies")
+    return wdl, dtm
+
+
+def _predecessors(material: Material, legal: np.ndarray, positions: np.ndarray, s: int) -> np.ndarray:
+    """
+    Positions, with the other side to move, from which a move staying in the table leads to positions, that have s
+    to move. A move is undone by moving the same piece back to an empty square, as pieces move both ways; pawns are
+    pushed back.
+    """
+    pieces = material.pieces
+    squares = _squares(positions, material.n)
+    res = [np.zeros(0, dtype=np.int32)]
+    for i, (piece, color) in enumerate(pieces):
+        if color != sides[1 - s]:
+            continue
+        slots = pawn_unpush_slots[color] if piece == PieceType.PAWN else piece_slots[piece]
+        for rows, origin, _ in _piece_moves(pieces, squares, i, slots, False):
+            previous = positions[rows] + (origin - squares[i][rows]) * material.weights[i]
+            res.append(previous[legal[previous]])
+    return np.concatenate(res)
+
+
+def generate_all(directory: str = TABLEBASE_DIRECTORY, max_pieces: int = MAX_PIECES,
+                 names: Optional[Sequence[str]] = None, verbose: bool = False) -> List[str]:
+    """
+    Generate the missing tables in directory, as .npy files, together with the ones they depend on.
+    :param names: signatures to generate, all the ones of up to max_pieces pieces if None.
+    :return: names of the tables generated.
+    """
+    os.makedirs(directory, exist_ok=True)
+    materials = all_materials(max([max_pieces] + [Material.from_name(name).n for name in names or ()]))
+    if names is not None:
+        wanted = {canonical(Material.from_name(name).pieces)[0].name for name in names}
+        for material in reversed(materials):
+            if material.name in wanted:
+                wanted.update(m.name for m in dependencies(material))
+        materials = [m for m in materials if m.name in wanted]
+    tables, generated = {}, []
+    for material in materials:
+        path = os.path.join(directory, material.name)
+        if not os.path.exists(path + ".wdl.npy") or not os.path.exists(path + ".dtm.npy"):
+            wdl, dtm = generate(material, tables, verbose)
+            np.save(path + ".wdl.npy", wdl)
+            np.save(path + ".dtm.npy", dtm)
+            generated.append(material.name)
+        tables[material.name] = (np.load(path + ".wdl.npy", mmap_mode="r"), np.load(path + ".dtm.npy", mmap_mode="r"))
+    return generated
+
+
+class Tablebase:
+    """
+    Tables of a directory written by generate_all. A table is memory-mapped the first time a position with its
+    material is probed, and only the pages holding the probed positions are ever read from disk.
+    """
+
+    def __init__(self, directory: str = TABLEBASE_DIRECTORY):
+        self.directory = directory
+        self.tables: Dict[str, Optional[Tuple[np.ndarray, np.ndarray]]] = {}
+        names = [f[:-len(".wdl.npy")] for f in os.listdir(directory) if f.endswith(".wdl.npy")]
+        self.max_pieces = max((Material.from_name(name).n for name in names), default=2)
+        self.probes = 0
+        self.hits = 0
+
+    def table(self, name: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if name not in self.tables:
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path + ".wdl.npy") and os.path.exists(path + ".dtm.npy"):
+                self.tables[name] = (np.load(path + ".wdl.npy", mmap_mode="r"),
+                                     np.load(path + ".dtm.npy", mmap_mode="r"))
+            else:
+                self.tables[name] = None
+        return self.tables[name]
+
+    def probe(self, board) -> Optional[Tuple[int, int]]:
+        """
+        :param board: board of either backend.
+        :return: result (WIN, DRAW or LOSS) and distance to mate in plies of the position on the board, for the side
+        to move, or None if it is not in the tables.
+        """
+        if board.n_pieces > self.max_pieces or board.castling_rights or board.en_passant is not None:
+            return None
+        self.probes += 1
+        pieces, squares = [], []
+        for square in range(64):
+            piece, color = board.piece_at(square)
+            if piece is not None:
+                pieces.append((piece, color))
+                squares.append(square)
+        if len(pieces) == 2:
+            self.hits += 1
+            return DRAW, 0
+        material, flip = canonical(pieces)
+        table = self.table(material.name)
+        if table is None:
+            return None
+        index = 0
+        for i, w in zip(material.permutation(pieces, flip), material.weights):
+            index += (squares[i] ^ 56 if flip else squares[i]) * w
+        wdl, dtm = table
+        stm = sides.index(board.color_to_move) ^ flip
+        self.hits += 1
+        return (int(wdl[stm, index >> 2]) >> 2 * (index & 3)) & 3, int(dtm[stm, index])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help="signatures to generate, like KQvKR (default all)")
+    parser.add_argument("--directory", type=str, default=TABLEBASE_DIRECTORY, help="output directory")
+    parser.add_argument("--max-pieces", type=int, choices=[3, 4], default=MAX_PIECES,
+                        help="largest tables to generate when no signature is given (default 4)")
+    args = parser.parse_args()
+
+    generated = generate_all(args.directory, args.max_pieces, args.names or None, verbose=True)
+    print(f"generated {len(generated)} tables in {args.directory}")
@@ -1,6 +1,28 @@
+import random
+import threading
+import time
+
+import numpy as np
 import pytest
-from board import Board
-from constants import COLOR
+from board import Board, CastlingRights, eg_table, mg_table, phase_scores
+from constants import COLOR, PieceType, piece_bytes
+import perft
+from engine import Engine, backends
+import attack_bitboard
+import magic
+from attack_map import AttackMap
+import move_picker
+from eval_cache import EvalCache
+import batch_eval
+import nnue
+import pawn_structure
+import tablebase
+from transposition_table import TranspositionTable, BOUND_EXACT, BOUND_LOWER, BOUND_UPPER
+from engine import CHECK_NODES, MATING_SCORE, tablebase_score, uci_score
+from timer import Timer
+from orchestradirector import OrchestraDirector
+from lazy_smp import LazySMP
+from move import Move, uci_string
 
 
 def increase_by_one(x):
@@ -15,8 +37,596 @@ def test_increase_by_one(input, expected):
 def test_board_initialization():
     board = Board.from_startpos()
     assert board.color_to_move == COLOR.WHITE
-    assert board.castling_rights.white_king_side
-    assert board.castling_rights.white_queen_side
-    assert board.castling_rights.black_king_side
-    assert board.castling_rights.black_queen_side
+    assert board.castling_rights & CastlingRights.WHITE_KING_SIDE
+    assert board.castling_rights & CastlingRights.WHITE_QUEEN_SIDE
+    assert board.castling_rights & CastlingRights.BLACK_KING_SIDE
+    assert board.castling_rights & CastlingRights.BLACK_QUEEN_SIDE
     assert board.en_passant is None
+
+
+@pytest.mark.parametrize("backend", list(backends))
+@pytest.mark.parametrize("name, fen, counts", perft.positions)
+def test_perft(name, fen, counts, backend):
+    board = backends[backend].from_fen(fen)
+    for depth in range(3):
+        assert perft.perft(board, depth) == counts[depth]
+
+
+@pytest.mark.parametrize("name, fen, counts", perft.positions)
+def test_bitboard_backend_matches_mailbox(name, fen, counts):
+    mailbox = backends["mailbox"].from_fen(fen)
+    bitboard = backends["bitboard"].from_fen(fen)
+    assert mailbox.zobrist.get_hash() == bitboard.zobrist.get_hash()
+    assert mailbox.static_evaluation() == pytest.approx(bitboard.static_evaluation())
+    assert mailbox.is_check() == bitboard.is_check()
+    assert sorted(uci_string(m) for m in mailbox.generate_moves()) == \
+           sorted(uci_string(m) for m in bitboard.generate_moves())
+
+
+def test_perft_divide():
+    board = Board.from_startpos()
+    divide = perft.perft_divide(board, 2)
+    assert len(divide) == 20
+    assert divide["e2e4"] == 20
+    assert sum(divide.values()) == 400
+
+
+def test_magic_matches_classical_attacks():
+    rng = random.Random(0)
+    for _ in range(2000):
+        square, occupancy = rng.randrange(64), rng.getrandbits(64) & rng.getrandbits(64)
+        assert magic.magic_rook(square, occupancy) == attack_bitboard.rook_attacks(square, occupancy)
+        assert magic.magic_bishop(square, occupancy) == attack_bitboard.bishop_attacks(square, occupancy)
+
+
+@pytest.mark.parametrize("backend", list(backends))
+@pytest.mark.parametrize("fen, illegal", [
+    ("8/8/8/8/k2Pp2Q/8/8/3K4 b - d3 0 1", "e4d3"),  # en passant exposes the king along the rank
+    ("4k3/8/8/2KPp2r/8/8/8/8 w - e6 0 1", "d5e6"),
+    ("4k3/8/8/8/8/8/4r3/R3K3 w Q - 0 1", "a1a2"),  # does not stop the check
+    ("4k3/4r3/8/8/8/8/4B3/4K3 w - - 0 1", "e2d3"),  # pinned bishop leaves the pin ray
+])
+def test_illegal_moves_are_filtered(fen, illegal, backend):
+    board = backends[backend].from_fen(fen)
+    legal = [uci_string(m) for m in board.generate_moves()]
+    assert illegal not in legal
+
+
+def test_attack_map_incremental_updates():
+    rng = random.Random(0)
+    for _, fen, _ in perft.positions:
+        board = Board.from_fen(fen)
+        for ply in range(40):
+            moves = board.generate_moves()
+            if not moves:
+                break
+            board.make_move(rng.choice(moves))
+            assert board.attack_map.counts == AttackMap.from_board(board).counts
+        while board.ply:
+            board.unmake_move()
+        assert board.attack_map.counts == AttackMap.from_board(board).counts
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_staged_moves_yield_each_legal_move_once(backend):
+    rng = random.Random(1)
+    for _, fen, _ in perft.positions:
+        board = backends[backend].from_fen(fen)
+        legal = board.generate_moves()
+        hash_move = rng.choice(legal)
+        killers = [rng.choice(legal), Move.from_string("a1a2", board).to_packed()]
+        staged = list(move_picker.staged_moves(board, hash_move, killers))
+        assert staged[0] == hash_move
+        assert len(staged) == len(legal)
+        assert sorted(uci_string(m) for m in staged) == sorted(uci_string(m) for m in legal)
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_packed_moves_round_trip(backend):
+    for _, fen, _ in perft.positions:
+        board = backends[backend].from_fen(fen)
+        for move in board.generate_moves():
+            view = Move.from_packed(move)
+            assert view.to_string() == uci_string(move)
+            assert Move.from_string(uci_string(move), board).to_packed() == move
+
+
+def test_piece_lists_match_mailbox():
+    rng = random.Random(2)
+    for _, fen, _ in perft.positions:
+        board = Board.from_fen(fen)
+        for ply in range(40):
+            moves = board.generate_moves()
+            if not moves:
+                break
+            board.make_move(rng.choice(moves))
+            for (piece, color), squares in board.piece_to_squares.items():
+                assert sorted(squares) == [sq for sq in range(64) if board.piece_at(sq) == (piece, color)]
+                assert all(board.list_index[sq] == i for i, sq in enumerate(squares))
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_zobrist_incremental_matches_full(backend):
+    rng = random.Random(4)
+    for _, fen, _ in perft.positions:
+        board = backends[backend].from_fen(fen)
+        board.debug = True  # make_move and unmake_move recompute the hash from scratch and compare
+        for ply in range(60):
+            moves = board.generate_moves()
+            if not moves:
+                break
+            board.make_move(rng.choice(moves))
+        while board.ply:
+            board.unmake_move()
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_zobrist_distinguishes_castling_and_en_passant(backend):
+    def key(fen):
+        return backends[backend].from_fen(fen).zobrist.get_hash()
+
+    assert key("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1") != key("r3k2r/8/8/8/8/8/8/R3K2R w Kkq - 0 1")
+    assert key("4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1") != key("4k3/8/8/3pP3/8/8/8/4K3 w - - 0 1")
+    # nobody can capture en passant: same position
+    assert key("4k3/8/8/3p4/8/8/8/4K3 w - d6 0 1") == key("4k3/8/8/3p4/8/8/8/4K3 w - - 0 1")
+
+    board = backends[backend].from_startpos()
+    for move in ("g1f3", "g8f6", "f3g1", "f6g8"):
+        board.make_move(Move.from_string(move, board).to_packed())
+    assert board.zobrist.get_hash() == key("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1")
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_repetition_detection(backend):
+    board = backends[backend].from_startpos()
+    shuffle = ["g1f3", "g8f6", "f3g1", "f6g8"]
+
+    def play(moves):
+        for move in moves:
+            board.make_move(Move.from_string(move, board).to_packed())
+
+    play(shuffle)
+    assert board.is_repetition(root_ply=0)  # twofold, entirely inside the search
+    assert not board.is_3fold()
+    play(shuffle)
+    assert board.is_3fold()
+
+    # an irreversible move ends the lookback
+    play(["e2e4", "e7e5"] + shuffle)
+    assert board.is_repetition(root_ply=0)
+    assert not board.is_3fold()
+    while board.ply:
+        board.unmake_move()
+    assert not any(board.repetition_filter)
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_incremental_evaluation_matches_scan(backend):
+    rng = random.Random(6)
+    for _, fen, _ in perft.positions:
+        board = backends[backend].from_fen(fen)
+        for ply in range(60):
+            assert board.static_evaluation() == pytest.approx(board.static_evaluation_scan())
+            moves = board.generate_moves()
+            if not moves:
+                break
+            board.make_move(rng.choice(moves))
+        while board.ply:
+            board.unmake_move()
+            assert board.static_evaluation() == pytest.approx(board.static_evaluation_scan())
+
+
+@pytest.mark.parametrize("backend", list(backends))
+@pytest.mark.parametrize("fen, expected", [
+    # doubled isolated a-pawns, of which only a3 is passed, passed isolated e- and h-pawns
+    ("4k3/7p/8/8/4P3/P7/P7/4K3 w - - 0 1", (-5, 0)),
+    # doubled isolated passed e-pawns: one bonus, for e4
+    ("4k3/8/8/8/4P3/4P3/8/4K3 w - - 0 1", (-10, -10)),
+    # backward d3 pawn, passed e4 pawn, isolated c5 pawn
+    ("4k3/8/8/2p5/2P1P3/3P4/8/4K3 w - - 0 1", (22, 45)),
+])
+def test_pawn_structure_terms(backend, fen, expected):
+    board = backends[backend].from_fen(fen)
+    assert board.pawn_structure_eval() == expected
+    assert board.pawn_structure_eval() == expected
+    assert (board.pawn_table.probes, board.pawn_table.hits) == (2, 1)
+
+
+def test_pawn_hash_table_checks_keys():
+    table = pawn_structure.PawnHashTable(size_bits=4)
+    table.store(0x25, 1, 2)
+    assert table.probe(0x25) == (1, 2)
+    assert table.probe(0x35) is None  # same slot, different pawn structure
+    table.store(0x35, 3, 4)
+    assert table.probe(0x25) is None and table.probe(0x35) == (3, 4)
+    assert table.hit_rate() == pytest.approx(2 / 4)
+
+
+@pytest.mark.parametrize("backend", list(backends))
+@pytest.mark.parametrize("fen, move, expected", [
+    ("1k1r4/1pp4p/p7/4p3/8/P5P1/1PP4P/2K1R3 w - - 0 1", "e1e5", 100),  # undefended pawn
+    ("1k1r3q/1ppn3p/p4b2/4p3/8/P2N2P1/1PP1R1BP/2K1Q3 w - - 0 1", "d3e5", -220),  # knight for pawn
+    ("4r1k1/4r3/8/4p3/8/8/4R3/4R1K1 w - - 0 1", "e2e5", -400),  # both rooks x-ray through the ones in front
+    ("4k3/8/8/3pP3/8/8/8/4K3 w - d6 0 1", "e5d6", 100),  # en passant
+    ("4k3/8/8/8/8/8/3q4/3QK3 w - - 0 1", "e1d2", 900),  # the king takes an undefended queen
+])
+def test_static_exchange_evaluation(backend, fen, move, expected):
+    board = backends[backend].from_fen(fen)
+    move = next(m for m in board.generate_moves() if uci_string(m) == move)
+    assert board.see(move) == expected
+    assert move_picker.is_losing_capture(board, move) == (expected < 0)
+
+
+def test_eval_cache_does_not_change_the_search(capsys):
+    cache = EvalCache(size_bits=4)
+    cache.store(0x25, 1.5)
+    assert cache.probe(0x25) == 1.5 and cache.probe(0x35) is None
+
+    fen = "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1"
+    cached = Engine(Board.from_fen(fen))
+    uncached = Engine(Board.from_fen(fen), eval_cache_bits=0)  # a single slot: almost every probe misses
+    assert cached.search(3) == uncached.search(3)
+    assert cached.eval_cache.hits > uncached.eval_cache.hits
+    assert cached.eval_cache.probes == uncached.eval_cache.probes
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_quiescence_resolves_exchanges(backend, capsys):
+    # the pawn on d6 is defended: the queen is lost once the recapture below the horizon is searched
+    board = backends[backend].from_fen("4k3/2p5/3p4/8/8/8/8/3QK3 w - - 0 1")
+    assert uci_string(Engine(board).search(1)[1]) != "d1d6"
+    # a queen hanging to a pawn is won, while a quiet position keeps its static evaluation
+    board = backends[backend].from_fen("4k3/8/8/3q4/4P3/8/8/4K3 w - - 0 1")
+    assert Engine(board).quiescence(-MATING_SCORE, MATING_SCORE, COLOR.WHITE) > board.static_evaluation() + 800
+    board = backends[backend].from_startpos()
+    assert Engine(board).quiescence(-MATING_SCORE, MATING_SCORE, COLOR.WHITE) == board.static_evaluation()
+
+
+def test_timer_allocation():
+    timer = Timer.from_go("wtime 60000 btime 30000 winc 1000 binc 0 movestogo 10")
+    assert (timer.wtime, timer.btime, timer.winc, timer.binc, timer.movestogo) == (60000, 30000, 1000, 0, 10)
+    timer.start(COLOR.BLACK)
+    assert timer.soft_limit == pytest.approx((30000 - 50) / 10 / 1000)
+    assert timer.soft_limit < timer.hard_limit <= (30000 - 50) / 2 / 1000
+    timer.start(COLOR.WHITE)  # the increment counts too
+    assert timer.soft_limit == pytest.approx(((60000 - 50) / 10 + 750) / 1000)
+    timer = Timer.from_go("movetime 500")
+    timer.start(COLOR.WHITE)
+    assert timer.soft_limit == timer.hard_limit == pytest.approx(0.45)
+    # the last move before the time control keeps a share of the clock too
+    timer = Timer.from_go("wtime 10000 btime 10000 movestogo 1")
+    timer.start(COLOR.WHITE)
+    assert timer.soft_limit == timer.hard_limit == pytest.approx((10000 - 50) / 2 / 1000)
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_search_stops_at_the_limits(backend, capsys):
+    engine = Engine(backends[backend].from_startpos())
+    score, move = engine.search(64, Timer.from_go("nodes 3000"))
+    assert move is not None and 3000 <= engine.node_count < 3000 + CHECK_NODES
+    start = time.perf_counter()
+    score, move = engine.search(64, Timer.from_go("movetime 300"))
+    assert move is not None and time.perf_counter() - start < 1.5
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_stop_keeps_the_partial_iteration(backend):
+    engine = Engine(backends[backend].from_startpos())
+    thread = threading.Thread(target=engine.search, args=(64, Timer.from_go("infinite")))
+    thread.start()
+    time.sleep(0.5)
+    move = engine.stop_search()
+    thread.join(1)
+    assert not thread.is_alive()
+    assert move is not None and engine.current_best_move == move
+    assert move in engine.board.generate_moves()
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_director_answers_during_search(backend, capsys):
+    OrchestraDirector.backend = backend
+    OrchestraDirector.handle_command("position", "startpos moves e2e4")
+    OrchestraDirector.handle_command("go", "infinite")
+    time.sleep(0.2)
+    OrchestraDirector.handle_command("isready", "")
+    assert capsys.readouterr().out.splitlines()[-1] == "readyok"
+    OrchestraDirector.handle_command("stop", "")
+    assert capsys.readouterr().out.splitlines()[-1].startswith("bestmove ")
+    # a pondering search waits for ponderhit, then searches within the time of the move
+    OrchestraDirector.handle_command("go", "ponder wtime 1000 btime 1000")
+    time.sleep(0.2)
+    assert OrchestraDirector.search_thread.is_alive()
+    OrchestraDirector.handle_command("ponderhit", "")
+    OrchestraDirector.search_thread.join(2)
+    assert not OrchestraDirector.search_thread.is_alive()
+    assert capsys.readouterr().out.splitlines()[-1].startswith("bestmove ")
+
+
+def test_director_allocates_the_table_on_first_search():
+    OrchestraDirector.handle_command("setoption", "name Hash value 2")
+    assert OrchestraDirector.transposition_table is None
+    OrchestraDirector.handle_command("ucinewgame", "")
+    OrchestraDirector.handle_command("position", "startpos")
+    OrchestraDirector.handle_command("go", "depth 1")
+    OrchestraDirector.search_thread.join(5)
+    assert OrchestraDirector.transposition_table.size_mb == 2
+    OrchestraDirector.handle_command("setoption", "name Hash value 16")
+
+
+@pytest.mark.parametrize("backend", list(backends))
+@pytest.mark.parametrize("fen, score", [
+    ("7k/5Q2/6K1/8/8/8/8/8 b - - 0 1", "cp 0"),  # stalemate
+    ("7k/6Q1/6K1/8/8/8/8/8 b - - 0 1", "mate 0"),  # checkmate
+])
+def test_director_go_without_legal_moves(backend, fen, score, capsys):
+    OrchestraDirector.backend = backend
+    OrchestraDirector.handle_command("position", f"fen {fen} moves")
+    OrchestraDirector.handle_command("go", "depth 3")
+    OrchestraDirector.search_thread.join(5)
+    assert not OrchestraDirector.search_thread.is_alive()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[-1] == "bestmove 0000"
+    assert lines[-2].startswith(f"info depth 3 score {score} nodes ")
+    for piece in PieceType:
+        for square in range(64):
+            white = phase_scores(piece, COLOR.WHITE, square)
+            assert phase_scores(piece, COLOR.BLACK, square ^ 56) == (-white[0], -white[1])
+            byte = piece_bytes[(piece, COLOR.WHITE)]
+            assert (mg_table[byte << 6 | square], eg_table[byte << 6 | square]) == white
+
+
+def random_fens(n_games: int = 5, n_plies: int = 40):
+    rng = random.Random(7)
+    fens = []
+    for _, fen, _ in perft.positions:
+        for _ in range(n_games):
+            board = Board.from_fen(fen)
+            for ply in range(n_plies):
+                moves = board.generate_moves()
+                if not moves:
+                    break
+                board.make_move(rng.choice(moves))
+            fens.append(board.to_fen())
+    return fens
+
+
+def test_batch_evaluation_matches_static_evaluation():
+    # doubled passed pawns of both sides, only the front ones get the bonus
+    doubled = ["4k3/7p/7p/8/4P3/4P3/8/4K3 w - - 0 1", "4k3/p7/p7/p7/8/8/3PP3/4K3 b - - 0 1"]
+    fens = [fen for _, fen, _ in perft.positions] + random_fens() + doubled
+    scores = batch_eval.evaluate_fens(fens)
+    assert scores.shape == (len(fens),)
+    assert list(scores) == [Board.from_fen(fen).static_evaluation() for fen in fens]
+
+
+def test_batch_evaluation_streams_epd(tmp_path):
+    fens = random_fens(n_games=2)
+    path = tmp_path / "positions.epd"
+    path.write_text("".join(" ".join(fen.split()[:4]) + ' bm e4; id "x";\n\n' for fen in fens))
+    with open(path) as f:
+        chunks = list(batch_eval.evaluate_stream(f, chunk_size=5))
+    assert [len(c) for c in chunks[:-1]] == [5] * (len(chunks) - 1)
+    assert list(np.concatenate(chunks)) == list(batch_eval.evaluate_fens(fens))
+
+
+def random_network(half_dimensions: int = 32, seed: int = 0) -> nnue.Network:
+    rng = np.random.default_rng(seed)
+    layers = []
+    for _ in range(nnue.LAYER_STACKS):
+        arrays = []
+        for out_dims, in_dims in ((nnue.FC_0_OUT_DIMS + 1, half_dimensions), (nnue.FC_1_OUT_DIMS, 2 * nnue.FC_0_OUT_DIMS),
+                                  (1, nnue.FC_1_OUT_DIMS)):
+            arrays.append(rng.integers(-5000, 5000, out_dims, dtype=np.int32))
+            arrays.append(rng.integers(-128, 128, (out_dims, nnue.padded(in_dims)), dtype=np.int8))
+        layers.append(nnue.LayerStack(*arrays))
+    return nnue.Network(
+        rng.integers(0, 100, half_dimensions, dtype=np.int16),
+        rng.integers(-40, 40, (nnue.INPUT_DIMENSIONS, half_dimensions), dtype=np.int16),
+        rng.integers(-3000, 3000, (nnue.INPUT_DIMENSIONS, nnue.PSQT_BUCKETS), dtype=np.int32),
+        layers,
+        b"random test network",
+    )
+
+
+def test_leb128_round_trip(monkeypatch):
+    values = np.array([0, 1, -1, 63, 64, -64, -65, 8191, -8192, 32767, -32768, 2 ** 31 - 1, -2 ** 31], dtype=np.int64)
+    values = np.concatenate([values, np.random.default_rng(0).integers(-2 ** 31, 2 ** 31, 1000)])
+    encoded = nnue.encode_leb128(values)
+    assert np.array_equal(nnue.decode_leb128(np.frombuffer(encoded, dtype=np.uint8), np.int32), values)
+
+    # blocks are decoded in chunks cut after the last byte of a number
+    monkeypatch.setattr(nnue, "LEB128_CHUNK_SIZE", 7)
+    block = np.frombuffer(nnue.LEB128_MAGIC + np.array([len(encoded)], dtype="<u4").tobytes() + encoded, dtype=np.uint8)
+    decoded, offset = nnue.read_leb128(block, 0, len(values), np.int32)
+    assert np.array_equal(decoded, values) and offset == len(block)
+
+
+def test_nnue_file_round_trip(tmp_path):
+    network = random_network()
+    path = str(tmp_path / "test.nnue")
+    network.save(path)
+    fens = random_fens(n_games=1)
+    for _ in range(2):  # decompressed the first time, memory-mapped from the cache the second
+        loaded = nnue.Network.from_file(path, half_dimensions=network.half_dimensions)
+        assert loaded.description == network.description
+        for name in ("ft_bias", "ft_weights", "ft_psqt"):
+            assert np.array_equal(getattr(loaded, name), getattr(network, name))
+        assert np.array_equal(loaded.evaluate_fens(fens), network.evaluate_fens(fens))
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_nnue_accumulator_incremental_updates(backend, monkeypatch):
+    monkeypatch.setattr(backends[backend], "debug", True)  # every make and unmake verifies the accumulators
+    network = random_network()
+    rng = random.Random(8)
+    for _, fen, _ in perft.positions:
+        board = backends[backend].from_fen(fen)
+        board.set_network(network)
+        scores = []
+        for ply in range(40):
+            score = board.nnue_evaluation()
+            assert score * board.color_to_move.value == network.evaluate_fens([board.to_fen()])[0]
+            scores.append(score)
+            moves = board.generate_moves()
+            if not moves:
+                break
+            board.make_move(rng.choice(moves))
+        while board.ply:
+            board.unmake_move()
+            assert board.nnue_evaluation() == scores[board.ply]
+
+
+def test_transposition_table_replacement():
+    tt = TranspositionTable(size_mb=1)
+    assert len(tt.buffer) == 1 << 20
+    keys = [5 + tt.n_buckets * k for k in range(6)]  # all in the same bucket of four entries
+    tt.store(keys[0], 5, -12.34375, 0x1234, BOUND_EXACT)
+    tt.store(keys[1], 4, -249990, None, BOUND_UPPER)
+    tt.store(keys[2], 3, 0.5, 0x4567, BOUND_LOWER)
+    assert tt.probe(keys[0]) == (5, -12.34375, 0x1234, BOUND_EXACT)
+    assert tt.probe(keys[1]) == (4, -249990, None, BOUND_UPPER)
+
+    # the depth-preferred entries are full of deeper results: shallow ones share the always-replace entry
+    tt.store(keys[3], 1, 1, None, BOUND_EXACT)
+    tt.store(keys[4], 2, 2, None, BOUND_EXACT)
+    assert tt.probe(keys[3]) is None and tt.probe(keys[4]) == (2, 2, None, BOUND_EXACT)
+    # a shallower bound does not replace a deeper result, a new one keeps the move
+    tt.store(keys[2], 1, 9, None, BOUND_UPPER)
+    assert tt.probe(keys[2]) == (3, 0.5, 0x4567, BOUND_LOWER)
+    tt.store(keys[2], 6, 9, None, BOUND_UPPER)
+    assert tt.probe(keys[2]) == (6, 9, 0x4567, BOUND_UPPER)
+
+    # results of older searches are replaced first
+    tt.new_search()
+    tt.store(keys[5], 1, 0, None, BOUND_EXACT)
+    assert tt.probe(keys[0]) is None and tt.probe(keys[5]) is not None
+    assert tt.hashfull() == 1
+    tt.clear()
+    assert tt.probe(keys[5]) is None and tt.hashfull() == 0
+
+
+def test_shared_transposition_table():
+    tt = TranspositionTable(1, shared=True)
+    attached = TranspositionTable(1, name=tt.shared_memory.name)
+    tt.store(12345, 3, 1.5, None, BOUND_EXACT)
+    assert attached.probe(12345) == (3, 1.5, None, BOUND_EXACT)
+    # an entry torn by a concurrent write fails the xor validation against its key
+    i = 12345 % tt.n_buckets * 8
+    attached.words[i + 1] ^= 1 << 24
+    assert tt.probe(12345) is None
+    attached.close()
+    tt.close()
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_lazy_smp_search(backend):
+    tt = TranspositionTable(4, shared=True)
+    pool = LazySMP(2, tt)
+    try:
+        engine = Engine(backends[backend].from_startpos(), transposition_table=tt)
+        fen = engine.board.to_fen()
+        score, move = pool.search(engine, 4)
+        assert move in engine.board.generate_moves() and engine.completed_depth == 4
+        assert engine.board.to_fen() == fen
+    finally:
+        pool.close()
+        tt.close()
+
+
+@pytest.fixture(scope="module")
+def tablebase_directory(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("tablebases")
+    tablebase.generate_all(str(directory), max_pieces=3)
+    return str(directory)
+
+
+def test_tablebase_longest_mates(tablebase_directory):
+    longest = {"KQvK": 20, "KRvK": 32, "KBvK": 0, "KNvK": 0}  # plies, the losing side to move
+    for name, plies in longest.items():
+        assert np.load(f"{tablebase_directory}/{name}.dtm.npy").max() == plies
+
+
+def placement_fen(pieces, white_to_move: bool) -> str:
+    rows = []
+    for rank in range(7, -1, -1):
+        row = ""
+        for file in range(8):
+            piece = pieces.get(rank * 8 + file)
+            if piece is None:
+                row += "1"
+            else:
+                row += piece[0].to_char().upper() if piece[1] == COLOR.WHITE else piece[0].to_char()
+        rows.append(row)
+    return "/".join(rows) + (" w" if white_to_move else " b") + " - - 0 1"
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_tablebase_agrees_with_move_generation(backend, tablebase_directory):
+    # every result is the best one reached in a move, found with the move generator of the board
+    tb = tablebase.Tablebase(tablebase_directory)
+    rng = random.Random(3)
+    for material in tablebase.all_materials(3):
+        checked = 0
+        while checked < 40:
+            colors = [COLOR.WHITE, COLOR.BLACK] if rng.random() < 0.5 else [COLOR.BLACK, COLOR.WHITE]
+            squares = rng.sample(range(64), 3)
+            pieces = dict(zip(squares, [(p, colors[c == COLOR.BLACK]) for p, c in material.pieces]))
+            if any(p == PieceType.PAWN and not 8 <= sq < 56 for sq, (p, _) in pieces.items()):
+                continue
+            board = backends[backend].from_fen(placement_fen(pieces, rng.random() < 0.5))
+            result = tb.probe(board)
+            if result[0] == tablebase.ILLEGAL:
+                continue
+            children = []
+            for move in board.generate_moves():
+                board.make_move(move)
+                children.append(tb.probe(board))
+                board.unmake_move()
+            if not children:
+                expected = (tablebase.LOSS if board.is_check() else tablebase.DRAW, 0)
+            elif any(r == tablebase.LOSS for r, _ in children):
+                expected = (tablebase.WIN, 1 + min(d for r, d in children if r == tablebase.LOSS))
+            elif any(r == tablebase.DRAW for r, _ in children):
+                expected = (tablebase.DRAW, 0)
+            else:
+                expected = (tablebase.LOSS, 1 + max(d for _, d in children))
+            assert result == expected, board.to_fen()
+            checked += 1
+
+
+@pytest.fixture(scope="module")
+def four_piece_directory(tablebase_directory):
+    # the cheapest 4-piece table, still about 40 s to generate
+    tablebase.generate_all(tablebase_directory, names=["KBvKN"])
+    return tablebase_directory
+
+
+@pytest.mark.parametrize("fen, result", [
+    ("knB5/8/1K6/8/8/8/8/8 w - - 0 1", (tablebase.WIN, 1)),  # Bb7 mate
+    ("kn6/1B6/1K6/8/8/8/8/8 b - - 0 1", (tablebase.LOSS, 0)),
+    ("K1k5/B7/4n3/8/8/8/8/8 b - - 0 1", (tablebase.WIN, 1)),  # the knight mates too: Nc7
+    ("K1k5/B1n5/8/8/8/8/8/8 w - - 0 1", (tablebase.LOSS, 0)),
+    ("8/8/3k4/8/3n4/8/3BK3/8 w - - 0 1", (tablebase.DRAW, 0)),
+    # colour-swapped signature, KNvKB, probed through the KBvKN table
+    ("8/8/8/8/8/1k6/8/KNb5 b - - 0 1", (tablebase.WIN, 1)),
+    ("8/8/8/8/8/1k6/1b6/KN6 w - - 0 1", (tablebase.LOSS, 0)),
+    ("8/8/8/8/8/4N3/b7/k1K5 w - - 0 1", (tablebase.WIN, 1)),
+])
+def test_four_piece_tablebase(fen, result, four_piece_directory):
+    assert np.load(f"{four_piece_directory}/KBvKN.dtm.npy").max() == 1  # no longer mate with these pieces
+    board = Board.from_fen(fen)
+    assert tablebase.Tablebase(four_piece_directory).probe(board) == result
+
+
+@pytest.mark.parametrize("backend", list(backends))
+def test_engine_probes_tablebase(backend, tablebase_directory, capsys):
+    tb = tablebase.Tablebase(tablebase_directory)
+    board = backends[backend].from_fen("8/8/8/K7/8/8/7Q/1k6 b - - 0 1")
+    result = tb.probe(board)
+    assert result == (tablebase.LOSS, 8)
+    score, move = Engine(board, tablebase=tb).search(2)
+    assert score == tablebase_score(*result) == -(250000 - 4)
+    assert move is not None
+    assert "score mate -4 " in capsys.readouterr().out
+    assert uci_score(-(250000 - 4)) == "mate -4" and uci_score(MATING_SCORE - 3) == "mate 3"
+    assert uci_score(90.625) == "cp 91"
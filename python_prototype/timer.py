@@ -1,7 +1,83 @@
-class Timer:  # todo: static class? or maybe we instantiate it every time and make it a dataclass?
-    wtime: int
-    btime: int
-    winc: int
-    binc: int
-    depth: int
-    nodes: int
+import dataclasses
+import time
+from typing import Optional
+
+from constants import COLOR
+
+MOVE_OVERHEAD = 50  # ms kept for the communication with the GUI
+DEFAULT_MOVES_TO_GO = 30  # moves left to the time control, when the GUI does not say
+MAX_USAGE = 0.5  # largest share of the remaining time spent on a single move, even the last one of the time control
+HARD_LIMIT_FACTOR = 4  # the hard limit is at most this many times the soft limit
+
+
+@dataclasses.dataclass
+class Timer:
+    """
+    Limits of a search, from the UCI go command, with times in milliseconds and None for the ones not given.
+    start turns the clock of the side to move into two limits: the soft limit, past which no new iteration of the
+    search is started, and the hard limit, past which the running one is abandoned.
+    """
+    wtime: Optional[int] = None
+    btime: Optional[int] = None
+    winc: Optional[int] = None
+    binc: Optional[int] = None
+    movestogo: Optional[int] = None
+    movetime: Optional[int] = None
+    depth: Optional[int] = None
+    nodes: Optional[int] = None
+    infinite: bool = False
+    ponder: bool = False  # the search runs on the opponent's time, without limits until ponderhit
+
+    start_time: float = 0.0
+    soft_limit: Optional[float] = None  # seconds from start_time
+    hard_limit: Optional[float] = None
+
+    @classmethod
+    def from_go(cls, options: str):
+        """
+        :param options: arguments of the go command, e.g. "wtime 60000 btime 60000 winc 1000 binc 1000".
+        """
+        timer = cls()
+        words = options.split()
+        for i, word in enumerate(words):
+            if word in ("infinite", "ponder"):
+                setattr(timer, word, True)
+            elif word in ("wtime", "btime", "winc", "binc", "movestogo", "movetime", "depth", "nodes") and \
+                    i + 1 < len(words):
+                setattr(timer, word, int(words[i + 1]))
+        return timer
+
+    def start(self, color: COLOR):
+        """
+        Start the clock and allocate the time of the move: an even share of the remaining time over the moves left
+        to the time control, plus most of the increment. While pondering, the clock runs without limits.
+        :param color: side to move.
+        """
+        self.start_time = time.perf_counter()
+        self.soft_limit = self.hard_limit = None
+        if self.infinite or self.ponder:
+            return
+        if self.movetime is not None:
+            self.soft_limit = self.hard_limit = max(self.movetime - MOVE_OVERHEAD, 1) / 1000
+            return
+        remaining = self.wtime if color == COLOR.WHITE else self.btime
+        if remaining is None:
+            return
+        increment = (self.winc if color == COLOR.WHITE else self.binc) or 0
+        available = max(remaining - MOVE_OVERHEAD, 1)
+        moves_to_go = min(self.movestogo or DEFAULT_MOVES_TO_GO, DEFAULT_MOVES_TO_GO)
+        hard = min(available * MAX_USAGE, (available / moves_to_go + increment) * HARD_LIMIT_FACTOR)
+        self.hard_limit = hard / 1000
+        self.soft_limit = min(available / moves_to_go + increment * 3 / 4, hard) / 1000
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start_time
+
+    def out_of_time(self) -> bool:
+        return self.hard_limit is not None and self.elapsed() >= self.hard_limit
+
+    def has_time_for(self, seconds: float) -> bool:
+        """
+        :return: whether a computation of this length, started now, would end within the soft limit.
+        """
+        return self.soft_limit is None or self.elapsed() + seconds <= self.soft_limit
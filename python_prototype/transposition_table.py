@@ -0,0 +1,152 @@
+from multiprocessing import shared_memory
+from typing import Optional, Tuple
+
+DEFAULT_HASH_MB = 16
+BUCKET_ENTRIES = 4  # the first ones are kept for the deepest results, the last one is always replaced
+ENTRY_WORDS = 2  # 64-bit words: the full zobrist key xor the data below, and the data
+
+# kind of score stored. 0 marks an empty slot
+BOUND_EXACT = 1
+BOUND_LOWER = 2  # the search failed high: the score is at least this
+BOUND_UPPER = 3  # the search failed low: the score is at most this
+
+# scores are stored as integers: static evaluations are multiples of 1/32, see Board.static_evaluation
+SCORE_SCALE = 32
+SCORE_BITS = 24
+
+# layout of the data word:
+#   0-23   best move, packed, 0 if none
+#   24-31  depth
+#   32-33  bound
+#   34-39  age of the search that stored the entry
+#   40-63  score * SCORE_SCALE, two's complement
+MOVE_MASK = (1 << 24) - 1
+AGE_MASK = 63
+
+
+def pack_entry(depth: int, score: float, move: Optional[int], bound: int, age: int) -> int:
+    return (move or 0) | min(depth, 255) << 24 | bound << 32 | age << 34 | \
+        (round(score * SCORE_SCALE) & ((1 << SCORE_BITS) - 1)) << 40
+
+
+def unpack_entry(data: int) -> Tuple[int, float, Optional[int], int]:
+    """
+    :return: depth, score, move and bound of a data word.
+    """
+    raw = data >> 40
+    if raw >= 1 << (SCORE_BITS - 1):
+        raw -= 1 << SCORE_BITS
+    score = raw // SCORE_SCALE if raw % SCORE_SCALE == 0 else raw / SCORE_SCALE
+    return (data >> 24) & 255, score, (data & MOVE_MASK) or None, (data >> 32) & 3
+
+
+class TranspositionTable:
+    """
+    Search results in a preallocated buffer of a fixed number of megabytes, that never grows. A position hashes to a
+    bucket of BUCKET_ENTRIES entries of two 64-bit words each: the zobrist key xor the packed result, to tell a hit
+    from a collision, and the packed result.
+    A new result replaces the entry of the same position, if any. Otherwise it takes the shallowest of the
+    depth-preferred entries, entries left by older searches first, if it is at least as deep; if not, it goes to the
+    always-replace entry, so that recent results are kept as well.
+    A shared table lives in shared memory, where the processes of a Lazy SMP search read and write it without locks:
+    the two words of an entry are written one at a time, and an entry torn by a concurrent write no longer validates
+    against its key, so that it reads as a miss.
+    """
+
+    def __init__(self, size_mb: int = DEFAULT_HASH_MB, shared: bool = False, name: Optional[str] = None):
+        """
+        :param size_mb: size of the table
+        :param shared: whether to allocate the table in shared memory
+        :param name: name of the shared memory of an existing shared table of the same size, to attach to
+        """
+        self.size_mb = size_mb
+        self.n_buckets = max(1, (size_mb << 20) // (BUCKET_ENTRIES * ENTRY_WORDS * 8))
+        size = self.n_buckets * BUCKET_ENTRIES * ENTRY_WORDS * 8
+        self.shared_memory = None
+        self.owner = name is None  # whether the shared memory is freed on close
+        if shared or name is not None:
+            self.shared_memory = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+            self.buffer = self.shared_memory.buf
+        else:
+            self.buffer = bytearray(size)
+        self.words = memoryview(self.buffer)[:size].cast("Q")
+        self.age = 0  # counts the searches, modulo 64
+        self.probes = 0
+        self.hits = 0
+
+    def new_search(self):
+        self.age = (self.age + 1) & AGE_MASK
+
+    def probe(self, key: int) -> Optional[Tuple[int, float, Optional[int], int]]:
+        """
+        :return: depth, score, move and bound stored for the position with this key, None on a miss.
+        """
+        self.probes += 1
+        words = self.words
+        first = (key % self.n_buckets) * BUCKET_ENTRIES * ENTRY_WORDS
+        for i in range(first, first + BUCKET_ENTRIES * ENTRY_WORDS, ENTRY_WORDS):
+            data = words[i + 1]
+            if (data >> 32) & 3 and words[i] ^ data == key:
+                self.hits += 1
+                return unpack_entry(data)
+        return None
+
+    def store(self, key: int, depth: int, score: float, move: Optional[int], bound: int):
+        words = self.words
+        first = (key % self.n_buckets) * BUCKET_ENTRIES * ENTRY_WORDS
+        last = first + (BUCKET_ENTRIES - 1) * ENTRY_WORDS  # the always-replace entry
+        target, target_depth = last, depth + 1
+        for i in range(first, last + ENTRY_WORDS, ENTRY_WORDS):
+            data = words[i + 1]
+            used = (data >> 32) & 3
+            if used and words[i] ^ data == key:
+                if bound != BOUND_EXACT and depth < (data >> 24) & 255 and (data >> 34) & AGE_MASK == self.age:
+                    return  # keep the deeper result of this search
+                if move is None:
+                    move = (data & MOVE_MASK) or None
+                target = i
+                break
+            if i != last:
+                # empty entries go first, then the ones of older searches, then the shallowest
+                if not used:
+                    entry_depth = -2
+                elif (data >> 34) & AGE_MASK != self.age:
+                    entry_depth = -1
+                else:
+                    entry_depth = (data >> 24) & 255
+                if entry_depth < target_depth:
+                    target, target_depth = i, entry_depth
+        data = pack_entry(depth, score, move, bound, self.age)
+        words[target] = key ^ data
+        words[target + 1] = data
+
+    def hashfull(self) -> int:
+        """
+        :return: permille of the first thousand entries used by the current search, as in the UCI info command.
+        """
+        n = min(1000, len(self.words) // ENTRY_WORDS)
+        used = sum(
+            1 for i in range(0, n * ENTRY_WORDS, ENTRY_WORDS)
+            if (self.words[i + 1] >> 32) & 3 and (self.words[i + 1] >> 34) & AGE_MASK == self.age
+        )
+        return used * 1000 // n
+
+    def clear(self):
+        self.words[:] = memoryview(bytes(len(self.words) * 8)).cast("Q")
+        self.age = 0
+        self.probes = 0
+        self.hits = 0
+
+    def close(self):
+        """
+        Release the shared memory of a shared table, and free it if this table allocated it. The table is unusable
+        afterwards.
+        """
+        if self.shared_memory is None:
+            return
+        self.words.release()
+        self.buffer = None
+        self.shared_memory.close()
+        if self.owner:
+            self.shared_memory.unlink()
+        self.shared_memory = None